@@ -1,6 +1,6 @@
 import logging
-import pickle
 from functools import partial
+from pathlib import Path
 
 import det3d.core.sampler.preprocess as prep
 import numpy as np
@@ -53,6 +53,8 @@ def build_similarity_metric(similarity_config):
         return region_similarity.RotateIouSimilarity()
     elif similarity_type == "nearest_iou_similarity":
         return region_similarity.NearestIouSimilarity()
+    elif similarity_type == "grid_nearest_iou_similarity":
+        return region_similarity.GridNearestIouSimilarity()
     elif similarity_type == "distance_similarity":
         cfg = similarity_config.distance_similarity
         return region_similarity.DistanceSimilarity(
@@ -388,20 +390,30 @@ def build_dbsampler(cfg, logger=None):
     info_path = cfg.db_info_path                                    # object/dbinfos_train.pickle
     gt_random_drop = cfg.gt_random_drop
 
+    # imported here: det3d.datasets imports this module through its pipelines.
+    from det3d.datasets.utils.info_store import is_info_store, load_infos
+
     gt_aug_with_context = cfg.gt_aug_with_context
     if gt_aug_with_context > 0.0:
-        info_path = info_path[:-17] + "dbinfos_enlarged_train.pkl"
+        if is_info_store(info_path):
+            info_path = str(Path(info_path).parent / "dbinfos_enlarged_train")
+        else:
+            info_path = info_path[:-17] + "dbinfos_enlarged_train.pkl"
 
     gt_aug_similar_type = cfg.gt_aug_similar_type
 
-    with open(info_path, "rb") as f:
-        db_infos = pickle.load(f)
+    # dbinfos_*.pkl, or its memory-mapped info store (see det3d/datasets/utils/info_store.py).
+    db_infos = load_infos(info_path)
+    if is_info_store(info_path):
+        db_infos = dict(db_infos.items())   # {class: DbInfoColumns}, the db prep steps replace the filtered classes.
 
     if len(grot_range) == 0:
         grot_range = None
 
     sampler = DataBaseSamplerV2(db_infos, groups, db_prepor, rate, grot_range, logger=logger, gt_random_drop=gt_random_drop,\
-        gt_aug_with_context=gt_aug_with_context, gt_aug_similar_type=gt_aug_similar_type)
+        gt_aug_with_context=gt_aug_with_context, gt_aug_similar_type=gt_aug_similar_type,\
+        placement=cfg.get("placement", "batch"), placement_time_budget=cfg.get("placement_time_budget", None),\
+        placement_max_candidates=cfg.get("placement_max_candidates", 100))
 
     return sampler
 
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Anchors only depend on the anchor generator configs and the feature map size, so they are built once per process
+# and shared by AssignTarget (in every dataloader worker) and MultiGroupHead (as a device buffer), instead of being
+# copied into every sample and collated per batch.
+_ANCHOR_CACHE = {}
+
+
+def _cache_key(target_assigner_cfg, feature_map_size):
+    return repr(target_assigner_cfg["anchor_generators"]), repr(target_assigner_cfg["tasks"]), tuple(feature_map_size)
+
+
+def _generate_anchors_dict(anchor_generators, feature_map_size):
+    '''
+        Same layout as TargetAssigner.generate_anchors_dict:
+            {'Car': {'anchors': (1, 200, 176, 2, 7), 'matched_thresholds': (70400,), 'unmatched_thresholds': (70400,)}}
+    '''
+    anchors_dict = OrderedDict((a.class_name, {}) for a in anchor_generators)
+    for anchor_generator in anchor_generators:
+        anchors = anchor_generator.generate(feature_map_size)
+        anchors = anchors.reshape([*anchors.shape[:3], -1, anchors.shape[-1]])
+        num_anchors = np.prod(anchors.shape[:-1])
+        matched_thresholds = np.full([num_anchors], anchor_generator.match_threshold, anchors.dtype)
+        unmatched_thresholds = np.full([num_anchors], anchor_generator.unmatch_threshold, anchors.dtype)
+
+        # shared by every sample, make sure nobody modifies them in place.
+        for arr in [anchors, matched_thresholds, unmatched_thresholds]:
+            arr.setflags(write=False)
+
+        anchors_dict[anchor_generator.class_name]["anchors"] = anchors
+        anchors_dict[anchor_generator.class_name]["matched_thresholds"] = matched_thresholds
+        anchors_dict[anchor_generator.class_name]["unmatched_thresholds"] = unmatched_thresholds
+    return anchors_dict
+
+
+def get_anchors_dict_by_task(target_assigner_cfg, feature_map_size=(1, 200, 176)):
+    '''
+        target_assigner_cfg: target_assigner in config, with anchor_generators & tasks;
+        return: list (one per task) of anchors_dict, same as TargetAssigner.generate_anchors_dict.
+    '''
+    key = _cache_key(target_assigner_cfg, feature_map_size)
+    if key not in _ANCHOR_CACHE:
+        from det3d.builder import build_anchor_generator
+
+        anchor_generators = [build_anchor_generator(a_cfg) for a_cfg in target_assigner_cfg["anchor_generators"]]
+        anchor_dicts_by_task, flag = [], 0
+        for task in target_assigner_cfg["tasks"]:  # { num_class=1, class_names=["Car"] }
+            num_class = task["num_class"]
+            anchor_dicts_by_task.append(_generate_anchors_dict(anchor_generators[flag: flag + num_class], feature_map_size))
+            flag += num_class
+        _ANCHOR_CACHE[key] = anchor_dicts_by_task
+    return _ANCHOR_CACHE[key]
+
+
+def get_anchors_by_task(target_assigner_cfg, feature_map_size=(1, 200, 176)):
+    '''
+        return: list (one per task) of flattened anchors, [70400, 7] for car, in the order of the head outputs.
+    '''
+    anchors_by_task = []
+    for anchors_dict in get_anchors_dict_by_task(target_assigner_cfg, feature_map_size):
+        anchors = np.concatenate([v["anchors"] for v in anchors_dict.values()], axis=-2)  # (1, 200, 176, 2, 7)
+        anchors_by_task.append(anchors.reshape(-1, anchors.shape[-1]))
+    return anchors_by_task
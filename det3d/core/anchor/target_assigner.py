@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from functools import partial
 
 import numpy as np
 from det3d.core.anchor.target_ops_v2 import create_target_np
@@ -65,7 +66,8 @@ class TargetAssigner:
             box_code_size=self.box_coder.code_size,
         )
 
-    def assign_v2(self, anchors_dict, gt_boxes, anchors_mask=None, gt_classes=None, gt_names=None, enable_similar_type=False):
+    def assign_v2(self, anchors_dict, gt_boxes, anchors_mask=None, gt_classes=None, gt_names=None, enable_similar_type=False,
+                  sparse=False):
         '''
             anchors_dict: {
                             'Car': {
@@ -74,6 +76,7 @@ class TargetAssigner:
                                       'unmatched_thresholds': (70400,),
                                     }
                            }
+            sparse: return int8 labels plus targets & indices of positive anchors only, see create_target_np.
         '''
 
         def similarity_fn(anchors, gt_boxes):
@@ -81,10 +84,16 @@ class TargetAssigner:
             gt_boxes_rbv = gt_boxes[:, [0, 1, 3, 4, -1]]
             return self._region_similarity_calculator.compare(anchors_rbv, gt_boxes_rbv)
 
+        def grid_similarity_fn(anchors, gt_boxes, anchors_grid):
+            # anchors: (70400, 7) is anchors_grid: (1, 200, 176, 2, 7) flattened, only the gt windows are evaluated.
+            gt_boxes_rbv = gt_boxes[:, [0, 1, 3, 4, -1]]
+            return self._region_similarity_calculator.compare_grid(anchors_grid, gt_boxes_rbv)
+
         def box_encoding_fn(boxes, anchors):
             return self._box_coder.encode(boxes, anchors)
 
-        targets_list = []
+        use_grid_similarity = hasattr(self._region_similarity_calculator, "compare_grid") and anchors_mask is None
+        targets_list, anchor_loc_offsets = [], []
         anchor_loc_idx = 0
         for class_name, anchor_dict in anchors_dict.items():
             mask = np.array([c == class_name for c in gt_names], dtype=np.bool_)  # to obtain specific class, like car
@@ -103,10 +112,15 @@ class TargetAssigner:
             else:
                 prune_anchor_fn = None
 
+            if use_grid_similarity:
+                class_similarity_fn = partial(grid_similarity_fn, anchors_grid=anchor_dict["anchors"])
+            else:
+                class_similarity_fn = similarity_fn
+
             targets = create_target_np(
                 anchor_dict["anchors"].reshape(-1, self.box_coder.code_size),   # (1, 200, 176, 2, 7) -> (70400, 7)
                 gt_boxes[mask],
-                similarity_fn,
+                class_similarity_fn,
                 box_encoding_fn,
                 prune_anchor_fn=prune_anchor_fn,            # None
                 gt_classes=gt_classes[mask],
@@ -116,10 +130,15 @@ class TargetAssigner:
                 rpn_batch_size=self._sample_size,           # 512
                 norm_by_num_examples=False,
                 box_code_size=self.box_coder.code_size,     # 7
+                sparse=sparse,
             )
+            anchor_loc_offsets.append((anchor_loc_idx, num_loc))
             anchor_loc_idx += num_loc
             targets_list.append(targets)
 
+        if sparse:
+            return self._merge_sparse_targets(targets_list, anchor_loc_offsets, anchor_loc_idx, feature_map_size)
+
         targets_dict = {
             "labels": [t["labels"] for t in targets_list],
             "bbox_targets": [t["bbox_targets"] for t in targets_list],
@@ -135,6 +154,25 @@ class TargetAssigner:
 
         return targets_dict
 
+    def _merge_sparse_targets(self, targets_list, anchor_loc_offsets, num_anchors_per_loc, feature_map_size):
+        '''
+            Merge sparse targets of each class into the anchor order of the head, [*feature_map_size, num_anchors_per_loc].
+        '''
+        pos_inds_list = []
+        for targets, (offset, num_class_anchors) in zip(targets_list, anchor_loc_offsets):
+            inds = targets["assigned_anchors_inds"]  # index among anchors of this class
+            pos_inds_list.append(inds // num_class_anchors * num_anchors_per_loc + offset + inds % num_class_anchors)
+        pos_inds = np.concatenate(pos_inds_list, axis=0)
+        order = np.argsort(pos_inds, kind="stable")
+
+        labels = np.concatenate([t["labels"].reshape(*feature_map_size, -1) for t in targets_list], axis=-1)
+        return {
+            "labels": labels.reshape(-1),                                                       # [70400,], int8
+            "pos_inds": pos_inds[order],                                                        # [num_pos_anchors,]
+            "bbox_targets": np.concatenate([t["bbox_targets"] for t in targets_list], axis=0)[order],  # [num_pos_anchors, 7]
+            "positive_gt_id": [t["positive_gt_id"] for t in targets_list],
+        }
+
     def generate_anchors(self, feature_map_size):
         anchors_list = []
         matched_thresholds = [a.match_threshold for a in self._anchor_generators]    # 0.6: larger -> positive
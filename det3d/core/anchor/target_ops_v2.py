@@ -22,9 +22,14 @@ def create_target_np(
     rpn_batch_size=300,     # 512
     norm_by_num_examples=False,
     box_code_size=7,
+    sparse=False,           # True: only keep targets of positive anchors, and int8 labels.
 ):
     """
-
+        sparse=True returns
+            labels: (70400,) int8, -1: ignore, 0: negative, >0: positive class;
+            bbox_targets: (num_pos_anchors, 7), encoded targets of positive anchors only;
+            assigned_anchors_inds: (num_pos_anchors,), indices of positive anchors in all_anchors;
+        and no bbox_outside_weights, which is 1.0 for all positive anchors anyway.
     """
     num_anchors = all_anchors.shape[0]   # 70400
     anchors = all_anchors                # [70400, 7]
@@ -101,6 +106,16 @@ def create_target_np(
         # notice fg_inds and gt_ids keep unchanged for positive targets with assignment of negative labels.
         labels[pos_inds_force] = gt_classes[gt_inds_force]
 
+    if sparse:
+        bbox_targets = np.zeros((len(fg_inds), box_code_size), dtype=all_anchors.dtype)  # (num_pos_anchors, 7)
+        if len(gt_boxes) > 0:
+            bbox_targets[:] = box_encoding_fn(gt_boxes[anchor_to_gt_argmax[fg_inds], :], anchors[fg_inds, :])
+        return {"labels": labels.astype(np.int8),                # [70400,]
+                "bbox_targets": bbox_targets,                    # [num_pos_anchors, 7]
+                "assigned_anchors_overlap": fg_max_overlap,      # [num_pos_anchors,]
+                "positive_gt_id": gt_pos_inds,                   # [num_pos_anchors,]
+                "assigned_anchors_inds": fg_inds.astype(np.int64),}  # [num_pos_anchors, ]
+
     bbox_targets = np.zeros((num_anchors, box_code_size), dtype=all_anchors.dtype)   # (70400, 7)
     if len(gt_boxes) > 0:
         # see box_np_ops.second_box_encode
@@ -39,12 +39,13 @@
 #     box3d_to_bbox, change_box3d_center_)
 # from .box_coders import (GroundBox3dCoder, BevBoxCoder, GroundBox3dCoderTorch,
 #                          BevBoxCoderTorch)
-from . import box_coders, box_np_ops, box_torch_ops, geometry, region_similarity
+from . import box_coders, box_np_ops, box_torch_ops, geometry, point_box_index, region_similarity
 
 # from .region_similarity import (RegionSimilarityCalculator,
 #                                 RotateIouSimilarity, NearestIouSimilarity,
 #                                 DistanceSimilarity)
 from .iou import bbox_overlaps
+from .point_box_index import PointBoxIndex
 
 # from .geometry import (
 #     points_count_convex_polygon_3d_jit, is_line_segment_intersection_jit,
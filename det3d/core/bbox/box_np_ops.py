@@ -4,6 +4,7 @@ import numba
 import numpy as np
 from det3d.core.bbox.geometry import (
     points_count_convex_polygon_3d_jit,
+    points_in_convex_polygon_3d_grid,
     points_in_convex_polygon_3d_jit,
 )
 from spconv.utils import rbbox_intersection, rbbox_iou
@@ -1046,6 +1047,63 @@ def iou_jit(boxes, query_boxes, eps=1.0):
     return overlaps
 
 
+@numba.jit(nopython=True)
+def iou_jit_grid_window(boxes, query_boxes, x_centers, y_centers, extents, eps=1.0):
+    """same as iou_jit, but boxes lie on a regular bev grid, so each query box is only compared with the
+    anchors in its window of grid cells; all the others have no overlap and are left to zero.
+    Parameters
+    ----------
+    boxes: (H, W, A, 4) ndarray of float, [xmin, ymin, xmax, ymax] of anchors on the grid
+    query_boxes: (K, 4) ndarray of float
+    x_centers: (W,) / y_centers: (H,) ndarray of float, evenly spaced centers of grid cells
+    extents: (A, 4) ndarray of float, max [cx - xmin, cy - ymin, xmax - cx, ymax - cy] of each anchor type
+    Returns
+    -------
+    overlaps: (H * W * A, K) ndarray of overlap between boxes and query_boxes, bit-identical to iou_jit
+    """
+    H, W, A = boxes.shape[0], boxes.shape[1], boxes.shape[2]
+    K = query_boxes.shape[0]
+    overlaps = np.zeros((H * W * A, K), dtype=boxes.dtype)
+    stride_x = (x_centers[W - 1] - x_centers[0]) / (W - 1) if W > 1 else 1.0
+    stride_y = (y_centers[H - 1] - y_centers[0]) / (H - 1) if H > 1 else 1.0
+    for k in range(K):
+        box_area = (query_boxes[k, 2] - query_boxes[k, 0] + eps) * (
+            query_boxes[k, 3] - query_boxes[k, 1] + eps
+        )
+        for a in range(A):
+            # an anchor can only overlap if xmax > query xmin - eps and xmin < query xmax + eps (same for y),
+            # the window is widened by one cell to be robust to rounding of the cell centers.
+            x_lo = np.floor((query_boxes[k, 0] - eps - extents[a, 2] - x_centers[0]) / stride_x) - 1
+            x_hi = np.ceil((query_boxes[k, 2] + eps + extents[a, 0] - x_centers[0]) / stride_x) + 1
+            y_lo = np.floor((query_boxes[k, 1] - eps - extents[a, 3] - y_centers[0]) / stride_y) - 1
+            y_hi = np.ceil((query_boxes[k, 3] + eps + extents[a, 1] - y_centers[0]) / stride_y) + 1
+            i_start, i_end = int(max(x_lo, 0)), int(min(x_hi, W - 1))
+            j_start, j_end = int(max(y_lo, 0)), int(min(y_hi, H - 1))
+            for j in range(j_start, j_end + 1):
+                for i in range(i_start, i_end + 1):
+                    n = (j * W + i) * A + a
+                    iw = (
+                        min(boxes[j, i, a, 2], query_boxes[k, 2])
+                        - max(boxes[j, i, a, 0], query_boxes[k, 0])
+                        + eps
+                    )
+                    if iw > 0:
+                        ih = (
+                            min(boxes[j, i, a, 3], query_boxes[k, 3])
+                            - max(boxes[j, i, a, 1], query_boxes[k, 1])
+                            + eps
+                        )
+                        if ih > 0:
+                            ua = (
+                                (boxes[j, i, a, 2] - boxes[j, i, a, 0] + eps)
+                                * (boxes[j, i, a, 3] - boxes[j, i, a, 1] + eps)
+                                + box_area
+                                - iw * ih
+                            )
+                            overlaps[n, k] = iw * ih / ua
+    return overlaps
+
+
 @numba.jit(nopython=True)
 def iou_3d_jit(boxes, query_boxes, add1=True):
     """calculate box iou3d,
@@ -1149,11 +1207,11 @@ def iou_nd_jit(boxes, query_boxes, add1=True):
     return overlaps
 
 
-def points_in_rbbox(points, rbbox, z_axis=2, origin=(0.5, 0.5, 0.5)):
-    # get point indexs in the rotated boxes
+def points_in_rbbox(points, rbbox, z_axis=2, origin=(0.5, 0.5, 0.5), parallel=False):
+    # get point indexs in the rotated boxes, only the points in the bev cells under each box are checked.
     rbbox_corners = center_to_corner_box3d(rbbox[:, :3], rbbox[:, 3:6], rbbox[:, -1], origin=origin, axis=z_axis)
     surfaces = corner_to_surfaces_3d(rbbox_corners)
-    indices = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+    indices = points_in_convex_polygon_3d_grid(points[:, :3], surfaces, parallel=parallel)
     return indices
 
 
@@ -1229,7 +1287,7 @@ def assign_label_to_voxel(gt_boxes, coors, voxel_size, coors_range):
         axis=2,
     )
     gt_surfaces = corner_to_surfaces_3d(gt_box_corners)
-    ret = points_in_convex_polygon_3d_jit(voxel_centers, gt_surfaces)
+    ret = points_in_convex_polygon_3d_grid(voxel_centers, gt_surfaces)
     return np.any(ret, axis=1).astype(np.int64)
 
 
@@ -1253,7 +1311,7 @@ def assign_label_to_voxel_v3(gt_boxes, coors, voxel_size, coors_range):
     )
     gt_surfaces = corner_to_surfaces_3d(gt_box_corners)
     voxel_corners_flat = voxel_corners.reshape([-1, 3])
-    ret = points_in_convex_polygon_3d_jit(voxel_corners_flat, gt_surfaces)
+    ret = points_in_convex_polygon_3d_grid(voxel_corners_flat, gt_surfaces)
     ret = ret.reshape([-1, 8, ret.shape[-1]])
     return ret.any(-1).any(-1).astype(np.int64)
 
@@ -3,8 +3,7 @@ from functools import reduce
 
 import numpy as np
 import torch
-from det3d.ops.nms.nms_cpu import rotate_nms_cc, rotate_weighted_nms_cc
-from det3d.ops.nms.nms_gpu import nms_gpu, rotate_iou_gpu, rotate_nms_gpu
+from det3d.ops.nms.nms_cpu import nms_extension_available, rotate_nms_cc, rotate_weighted_nms_cc
 from torch import stack as tstack
 
 
@@ -345,6 +344,23 @@ def rotation_points_single_angle(points, angle, axis=0):
     return points @ rot_mat_T.to(points.device)
 
 
+def global_transform_boxes(boxes, matrix, noise_scale, yaw_sign, yaw_offset):
+    """apply the global augmentation of each sample (GlobalTransform.to_dict of det3d.core.sampler.preprocess)
+    to its boxes, the centers with one batched matmul.
+    Args:
+        boxes: [B, N, 7] or [B, N, 9] tensor, [x, y, z, w, l, h, (vx, vy,) ry].
+        matrix: [B, 4, 4] affine transforms; noise_scale, yaw_sign, yaw_offset: [B].
+    Returns:
+        [B, N, 7] or [B, N, 9] transformed boxes.
+    """
+    ret = [boxes[..., :3] @ matrix[:, :3, :3].transpose(1, 2) + matrix[:, None, :3, 3],
+           boxes[..., 3:6] * noise_scale[:, None, None]]
+    if boxes.shape[-1] > 7:
+        ret.append(boxes[..., 6:8] @ matrix[:, :2, :2].transpose(1, 2))
+    ret.append(boxes[..., -1:] * yaw_sign[:, None, None] + yaw_offset[:, None, None])
+    return torch.cat(ret, dim=-1)
+
+
 def rotation_2d(points, angles):
     """rotation 2d points based on origin point clockwise when angle positive.
 
@@ -513,6 +529,7 @@ def nms(bboxes, scores, pre_max_size=None, post_max_size=None, iou_threshold=0.5
     if len(dets_np) == 0:
         keep = np.array([], dtype=np.int64)
     else:
+        from det3d.ops.nms.nms_gpu import nms_gpu
         ret = np.array(nms_gpu(dets_np, iou_threshold), dtype=np.int64)
         keep = ret[:post_max_size]
     if keep.shape[0] == 0:
@@ -532,6 +549,11 @@ def rotate_nms(
         pre_max_size = min(num_keeped_scores, pre_max_size)
         scores, indices = torch.topk(scores, k=pre_max_size)
         rbboxes = rbboxes[indices]
+    if not nms_extension_available():
+        keep = rotate_nms_batched(rbboxes[None], scores[None], iou_threshold=iou_threshold, post_max_size=post_max_size)[0]
+        keep = keep.nonzero()[:, 0]
+        keep = keep[torch.argsort(scores[keep], descending=True)]  # by decreasing score, as rotate_nms_cc.
+        return indices[keep] if pre_max_size is not None else keep
     dets = torch.cat([rbboxes, scores.unsqueeze(-1)], dim=1)
     dets_np = dets.data.cpu().numpy()
     if len(dets_np) == 0:
@@ -579,6 +601,22 @@ def rotate_weighted_nms(
         box_preds = box_preds[indices]
         anchors = anchors[indices]
 
+    if not nms_extension_available():
+        order, keep, box_ret, scores_ret = rotate_weighted_nms_batched(
+            box_preds[None], rbboxes[None], scores[None], iou_preds[None], labels_preds[None],
+            anchors[None] if anchors is not None else None,
+            enable_centerness=enable_centerness,
+            centerness_pow=centerness_pow,
+            centerness_c=centerness_c,
+            nms_cnt_thresh=nms_cnt_thresh,
+            nms_sigma_dist_interval=nms_sigma_dist_interval,
+            nms_sigma_square=nms_sigma_square,
+            suppressed_thresh=suppressed_thresh,
+        )
+        selected = order[0][keep[0]]
+        return box_ret[0][keep[0]], dir_labels[selected], labels_preds[selected], scores_ret[0][keep[0]], \
+               indices[selected] if pre_max_size is not None else selected
+
     if enable_centerness and not centerness_c:
         dist_boxes_anchors = torch.abs(box_preds - anchors)
         dist_metric = torch.softmax(torch.pow(torch.pow(dist_boxes_anchors[:, 0:2], 2).sum(-1), 0.5), dim=0)
@@ -618,4 +656,250 @@ def rotate_weighted_nms(
         dir_ret_np = np.array(nms_result[3])
         keep = np.array(nms_result[4])
         return torch.from_numpy(box_ret_np).cuda(), torch.from_numpy(dir_ret_np).cuda(), torch.from_numpy(labels_ret_np).cuda(), \
-               torch.from_numpy(scores_ret_np).cuda(), indices[keep]
\ No newline at end of file
+               torch.from_numpy(scores_ret_np).cuda(), indices[keep]
+
+def points_in_convex_polygon_3d(points, polygon_surfaces):
+    """tensor version of geometry.points_in_convex_polygon_3d_jit (same arithmetic, in the dtype of the surfaces),
+    for a batch of samples.
+    Args:
+        points: [B, N, 3] tensor.
+        polygon_surfaces: [B, num_polygon, num_surfaces, num_points_of_surface, 3] tensor, all surfaces' normal
+            vector must direct to internal.
+    Returns:
+        [B, N, num_polygon] bool tensor.
+    """
+    sv0 = polygon_surfaces[..., 0, :] - polygon_surfaces[..., 1, :]  # [B, num_polygon, num_surfaces, 3]
+    sv1 = polygon_surfaces[..., 1, :] - polygon_surfaces[..., 2, :]
+    normal_vec = tstack([sv0[..., 1] * sv1[..., 2] - sv0[..., 2] * sv1[..., 1],
+                         sv0[..., 2] * sv1[..., 0] - sv0[..., 0] * sv1[..., 2],
+                         sv0[..., 0] * sv1[..., 1] - sv0[..., 1] * sv1[..., 0]], dim=-1)
+    surface_0 = polygon_surfaces[..., 0, :]
+    d = -surface_0[..., 0] * normal_vec[..., 0] - surface_0[..., 1] * normal_vec[..., 1] - surface_0[..., 2] * normal_vec[..., 2]
+    points = points.to(normal_vec.dtype)[:, :, None, None, :]  # [B, N, 1, 1, 3]
+    normal_vec, d = normal_vec.unsqueeze(1), d.unsqueeze(1)
+    sign = points[..., 0] * normal_vec[..., 0] + points[..., 1] * normal_vec[..., 1] + points[..., 2] * normal_vec[..., 2] + d
+    return (sign < 0).all(-1)
+
+
+def box_intersection_area_2d(corners1, corners2):
+    """intersection area of N pairs of convex quadrilaterals (bev box corners) with tensor ops: the corners of
+    each one inside the other one and the intersections of their edges, sorted by angle around their center.
+    Args:
+        corners1, corners2: [N, 4, 2] tensors, corners in order around the box.
+    Returns:
+        [N] tensor.
+    """
+    def inside(pts, rect, eps=1e-5):
+        # pts: [N, 4, 2] in rect (edges ab & ad), boundary included with a relative tolerance for the shared corners.
+        ab, ad = rect[:, 1:2] - rect[:, 0:1], rect[:, 3:4] - rect[:, 0:1]
+        ap = pts - rect[:, 0:1]
+        abap, adap, abab, adad = (ab * ap).sum(-1), (ad * ap).sum(-1), (ab * ab).sum(-1), (ad * ad).sum(-1)
+        return (abap >= -eps * abab) & (abap <= (1 + eps) * abab) & (adap >= -eps * adad) & (adap <= (1 + eps) * adad)
+
+    def cross(o, a, b):
+        return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+    N = corners1.shape[0]
+    A, B = corners1.unsqueeze(2), corners1[:, [1, 2, 3, 0]].unsqueeze(2)  # [N, 4, 1, 2], edges of box 1
+    C, D = corners2.unsqueeze(1), corners2[:, [1, 2, 3, 0]].unsqueeze(1)  # [N, 1, 4, 2], edges of box 2
+    cda, cdb, abc, abd = cross(C, D, A), cross(C, D, B), cross(A, B, C), cross(A, B, D)  # [N, 4, 4]
+    flags_inters = ((cda > 0) != (cdb > 0)) & ((abc > 0) != (abd > 0))
+    t = cda / torch.where(flags_inters, cda - cdb, torch.ones_like(cda))
+    inters = A + t.unsqueeze(-1) * (B - A)  # [N, 4, 4, 2]
+
+    pts = torch.cat([corners1, corners2, inters.view(N, 16, 2)], dim=1)  # [N, 24, 2]
+    valid = torch.cat([inside(corners1, corners2), inside(corners2, corners1), flags_inters.view(N, 16)], dim=1)
+    valid_f = valid.type_as(pts).unsqueeze(-1)
+    center = (pts * valid_f).sum(1, keepdim=True) / torch.clamp(valid_f.sum(1, keepdim=True), min=1)
+    angle = torch.atan2(pts[..., 1] - center[..., 1], pts[..., 0] - center[..., 0])
+    angle = torch.where(valid, angle, torch.full_like(angle, 10.0))  # unused points last.
+    sorted_index = torch.argsort(angle, dim=1)
+    sorted_pts = torch.gather(pts, 1, sorted_index.unsqueeze(-1).expand(-1, -1, 2))
+    # the unused points are replaced by the first one, so that they add nothing to the shoelace formula.
+    valid = torch.gather(valid, 1, sorted_index)
+    sorted_pts = torch.where(valid.unsqueeze(-1), sorted_pts, sorted_pts[:, 0:1].expand_as(sorted_pts))
+    next_pts = sorted_pts[:, [*range(1, 24), 0]]
+    area = (sorted_pts[..., 0] * next_pts[..., 1] - next_pts[..., 0] * sorted_pts[..., 1]).sum(1)
+    return torch.abs(area) / 2.0
+
+
+def _rotated_iou_pairs(rbboxes_a, rbboxes_b, candidates):
+    """rotated bev iou of the candidate pairs of boxes of each sample whose standup boxes overlap, the only ones which
+    can overlap: pairs without intersection are dropped.
+    Args:
+        rbboxes_a: [B, N, 5] tensor, rbboxes_b: [B, M, 5] tensor, [x, y, w, l, ry].
+        candidates: [B, N, M] bool tensor.
+    Returns:
+        b, i, j, iou: [num_pairs] tensors, the pairs (rbboxes_a[b, i], rbboxes_b[b, j]).
+    """
+    def to_corners(rbboxes):
+        batch_size, num_boxes = rbboxes.shape[:2]
+        return center_to_corner_box2d(rbboxes[..., :2].reshape(-1, 2), rbboxes[..., 2:4].reshape(-1, 2),
+                                      rbboxes[..., 4].reshape(-1)).view(batch_size, num_boxes, 4, 2)
+
+    corners_a, corners_b = to_corners(rbboxes_a), to_corners(rbboxes_b)
+    standup_a = torch.cat([corners_a.min(2)[0], corners_a.max(2)[0]], dim=-1)  # [B, N, 4]
+    standup_b = torch.cat([corners_b.min(2)[0], corners_b.max(2)[0]], dim=-1)  # [B, M, 4]
+    iw = torch.min(standup_a[:, :, None, 2], standup_b[:, None, :, 2]) - torch.max(standup_a[:, :, None, 0], standup_b[:, None, :, 0])
+    ih = torch.min(standup_a[:, :, None, 3], standup_b[:, None, :, 3]) - torch.max(standup_a[:, :, None, 1], standup_b[:, None, :, 1])
+    b, i, j = ((iw > 0) & (ih > 0) & candidates).nonzero(as_tuple=True)
+
+    inter = box_intersection_area_2d(corners_a[b, i], corners_b[b, j])
+    union = rbboxes_a[b, i, 2] * rbboxes_a[b, i, 3] + rbboxes_b[b, j, 2] * rbboxes_b[b, j, 3] - inter
+    overlap = (inter > 0) & (union > 0)
+    return b[overlap], i[overlap], j[overlap], inter[overlap] / union[overlap]
+
+
+def rotate_iou_bev_batched(boxes_a, boxes_b, valid_a=None, valid_b=None):
+    """rotated bev iou of two padded batches of boxes with tensor ops, on any device (same bev boxes as
+    iou3d_utils.boxes_iou_bev_gpu), the rotated iou only computed for the pairs whose standup boxes overlap.
+    Args:
+        boxes_a: [B, N, 7] tensor, boxes_b: [B, M, 7] tensor, [x, y, z, w, l, h, ry].
+        valid_a: [B, N] bool tensor, valid_b: [B, M] bool tensor, False for the padding.
+    Returns:
+        [B, N, M] tensor, 0 for the padding.
+    """
+    candidates = torch.ones(boxes_a.shape[:2] + boxes_b.shape[1:2], dtype=torch.bool, device=boxes_a.device)
+    if valid_a is not None:
+        candidates &= valid_a[:, :, None]
+    if valid_b is not None:
+        candidates &= valid_b[:, None, :]
+    b, i, j, iou = _rotated_iou_pairs(boxes_a[..., [0, 1, 3, 4, -1]], boxes_b[..., [0, 1, 3, 4, -1]], candidates)
+    ret = boxes_a.new_zeros(candidates.shape)
+    ret[b, i, j] = iou
+    return ret
+
+
+def _greedy_keep(valid, b, i, j, good=None):
+    """greedy suppression of the boxes of each sample in nms order, solved as the fixed point of
+    picked[j] = valid[j] and not any(picked[i] and good[i], (b, i, j) in the suppressing pairs), iterated from all the
+    valid boxes picked: the k first boxes are final after k iterations, and the greedy result is the only fixed point.
+    """
+    picked = valid
+    while True:
+        suppressor = picked[b, i] if good is None else picked[b, i] & good[b, i]
+        suppressed = torch.zeros_like(picked)
+        suppressed[b[suppressor], j[suppressor]] = True
+        new_picked = valid & ~suppressed
+        if torch.equal(new_picked, picked):
+            return picked
+        picked = new_picked
+
+
+def rotate_nms_batched(rbboxes, scores, valid=None, iou_threshold=0.5, post_max_size=None):
+    """rotate nms of a padded batch of samples with tensor ops only (on the device of the inputs, without the nms
+    extension), same selection as rotate_nms (rotate_nms_cc) on each sample: the rotated iou is only computed for
+    the pairs whose standup boxes overlap, then the greedy suppression is solved as the fixed point of
+    keep[j] = not any(keep[i] and iou[i, j] >= iou_threshold, i before j), iterated from all boxes kept.
+    Args:
+        rbboxes: [B, K, 5] tensor, [x, y, w, l, ry].
+        scores: [B, K] tensor.
+        valid: [B, K] bool tensor, False for the padding.
+    Returns:
+        [B, K] bool tensor, the kept boxes (at most post_max_size per sample, the ones with higher scores).
+    """
+    if valid is None:
+        valid = torch.ones_like(scores, dtype=torch.bool)
+    order = torch.argsort(torch.where(valid, scores, torch.full_like(scores, -float("inf"))), dim=1, descending=True)
+    rbboxes = torch.gather(rbboxes, 1, order.unsqueeze(-1).expand(-1, -1, 5))
+    valid_sorted = torch.gather(valid, 1, order)
+
+    K = scores.shape[1]
+    candidates = valid_sorted[:, :, None] & valid_sorted[:, None, :] & torch.ones(K, K, dtype=torch.bool, device=scores.device).triu(1)
+    b, i, j, iou = _rotated_iou_pairs(rbboxes, rbboxes, candidates)
+    overlap = iou >= iou_threshold
+    keep = _greedy_keep(valid_sorted, b[overlap], i[overlap], j[overlap])
+    if post_max_size is not None:
+        keep = keep & (torch.cumsum(keep.long(), dim=1) <= post_max_size)
+    return torch.zeros_like(keep).scatter_(1, order, keep)
+
+
+def rotate_weighted_nms_batched(
+    box_preds,
+    rbboxes,
+    scores,
+    iou_preds,
+    labels_preds,
+    anchors=None,
+    valid=None,
+    enable_centerness=True,
+    centerness_pow=1,
+    centerness_c=False,
+    nms_cnt_thresh=2.6,
+    nms_sigma_dist_interval=(0, 20, 40, 60),
+    nms_sigma_square=(0.0009, 0.009, 0.1, 1),
+    suppressed_thresh=0.3
+):
+    """DI-NMS of rotate_weighted_nms (IOU_weighted_rotate_non_max_suppression_cpu) for a padded batch of samples with
+    tensor ops only. The boxes are picked by decreasing score; a picked box is kept if the sum of iou * iou_pred of
+    the boxes of the same label overlapping it exceeds nms_cnt_thresh, and then suppresses the following boxes with
+    iou >= suppressed_thresh, and is replaced by the average of the boxes of its cluster (same label,
+    iou > suppressed_thresh), weighted by iou_pred * exp(-(1 - iou)^2 / sigma^2), sigma^2 given by the distance of
+    the picked box to the origin. The cluster terms only depend on the pairs of boxes, so they are computed for all
+    the boxes at once from the standup-overlapping pairs, and the picking is the fixed point of _greedy_keep.
+    Args:
+        box_preds: [B, K, 7] tensor, rbboxes: [B, K, 5] tensor, [x, y, w, l, ry] of box_preds.
+        scores, iou_preds: [B, K] tensors, labels_preds: [B, K] long tensor.
+        anchors: [B, K, 7] tensor, needed by enable_centerness.
+        valid: [B, K] bool tensor, False for the padding.
+    Returns:
+        order: [B, K] long tensor, the boxes in picking order (indices in the inputs); keep: [B, K] bool tensor,
+        boxes: [B, K, 7] tensor & scores: [B, K] tensor, the kept boxes & their scores, all in picking order.
+    """
+    batch_size, K = scores.shape
+    if valid is None:
+        valid = torch.ones_like(scores, dtype=torch.bool)
+    scores_rw = scores
+    if enable_centerness:
+        dist = torch.norm(box_preds[..., 0:2] - anchors[..., 0:2], dim=-1)
+        centerness = torch.softmax(torch.where(valid, dist, torch.full_like(dist, -float("inf"))), dim=1)
+        centerness = torch.where(valid, centerness, torch.zeros_like(centerness))
+        if centerness_c:
+            scores_rw = scores * (1 - centerness)  # only the returned scores.
+        else:
+            scores = scores * torch.pow(1 - centerness, centerness_pow)
+            scores_rw = scores
+    # normalized by the max score and scaled back, same rounding as the nms extension.
+    score_max4norm = torch.where(valid, scores_rw, torch.full_like(scores_rw, -10000)).max(1, keepdim=True)[0] \
+        if K > 0 else scores_rw.new_zeros([batch_size, 1])
+    scores_rw = scores_rw / score_max4norm
+
+    order = torch.argsort(torch.where(valid, scores, torch.full_like(scores, -float("inf"))), dim=1, descending=True)
+    box_preds = torch.gather(box_preds, 1, order.unsqueeze(-1).expand(-1, -1, box_preds.shape[-1]))
+    rbboxes = torch.gather(rbboxes, 1, order.unsqueeze(-1).expand(-1, -1, 5))
+    scores_rw, iou_preds, labels_preds, valid = [torch.gather(t, 1, order) for t in (scores_rw, iou_preds, labels_preds, valid)]
+
+    # all the ordered pairs of overlapping boxes, each box with itself included (iou 1).
+    candidates = valid[:, :, None] & valid[:, None, :] & torch.ones(K, K, dtype=torch.bool, device=scores.device).triu(1)
+    b, i, j, iou = _rotated_iou_pairs(rbboxes, rbboxes, candidates)
+    b_self, i_self = valid.nonzero(as_tuple=True)
+    b, i, j = torch.cat([b, b, b_self]), torch.cat([i, j, i_self]), torch.cat([j, i, i_self])
+    iou = torch.cat([iou, iou, torch.ones_like(iou_preds[b_self, i_self])])
+    same_label = labels_preds[b, i] == labels_preds[b, j]
+    index = b * K + i
+
+    # counter of each box: sum of iou * iou_pred of the boxes of the same label overlapping it.
+    cnt = torch.zeros_like(scores_rw).view(-1).index_add_(0, index[same_label], (iou * iou_preds[b, j])[same_label])
+    good = cnt.view(batch_size, K) > nms_cnt_thresh
+    # a picked box suppresses the following ones only if it is kept (otherwise they are recovered).
+    suppress = (i < j) & (iou >= suppressed_thresh)
+    picked = _greedy_keep(valid, b[suppress], i[suppress], j[suppress], good)
+
+    # weighted average of the cluster, sigma^2 from the distance of the picked box to the origin.
+    cluster = same_label & (iou > suppressed_thresh)
+    b, i, j, iou, index = b[cluster], i[cluster], j[cluster], iou[cluster], index[cluster]
+    dist2origin = torch.norm(box_preds[b, i, 0:2], dim=-1)
+    interval = torch.tensor(nms_sigma_dist_interval, dtype=dist2origin.dtype, device=dist2origin.device)
+    sigma_square = torch.tensor(nms_sigma_square, dtype=dist2origin.dtype, device=dist2origin.device)
+    k = torch.clamp(torch.bucketize(dist2origin, interval, right=True) - 1, 0, len(nms_sigma_square) - 1)
+    in_interval = (dist2origin >= interval[0]) & (dist2origin < interval[-1])
+    iou_weight = torch.where(in_interval, torch.exp(-torch.pow(1 - iou, 2) / sigma_square[k]), torch.zeros_like(iou))
+    weight = iou_weight * iou_preds[b, j]
+    avg_pos = torch.zeros_like(box_preds).view(-1, box_preds.shape[-1]).index_add_(0, index, weight.unsqueeze(-1) * box_preds[b, j])
+    weight_pos = torch.zeros_like(scores_rw).view(-1).index_add_(0, index, weight)
+    boxes_ret = (avg_pos / weight_pos.unsqueeze(-1)).view(batch_size, K, -1)
+    # max score of the cluster as a dense masked max, K is at most nms_pre_max_size.
+    cluster_scores = scores_rw.new_full([batch_size, K, K], -1)
+    cluster_scores[b, i, j] = scores_rw[b, j]
+    scores_ret = cluster_scores.max(2)[0] * score_max4norm if K > 0 else scores_rw * score_max4norm
+    return order, picked & good, boxes_ret, scores_ret
@@ -276,6 +276,135 @@ def _points_in_convex_polygon_3d_jit(
     return ret
 
 
+def points_in_convex_polygon_3d_grid(points, polygon_surfaces, cell_size=1.0, parallel=False):
+    """check points is in 3d convex polygons, same result as points_in_convex_polygon_3d_jit,
+    but the points are first bucketed into a coarse bev grid so that each polygon only checks
+    the points of the cells under its bounding box (gt boxes are small compared to the scene).
+    Args:
+        points: [num_points, 3] array.
+        polygon_surfaces: [num_polygon, max_num_surfaces,
+            max_num_points_of_surface, 3]
+            array. all surfaces' normal vector must direct to internal.
+            max_num_points_of_surface must at least 3.
+        cell_size: size of the bev cells (in meter).
+        parallel: distribute the polygons over numba threads.
+    Returns:
+        [num_points, num_polygon] bool array.
+    """
+    num_points = points.shape[0]
+    num_polygons = polygon_surfaces.shape[0]
+    ret = np.zeros((num_points, num_polygons), dtype=np.bool_)
+    if num_points == 0 or num_polygons == 0:
+        return ret
+    normal_vec, d, polygon_min, polygon_max = polygon_surfaces_bounds(polygon_surfaces)
+    grid_min, cell_size, grid_shape = bev_grid_params(polygon_min[:, :2].min(axis=0), polygon_max[:, :2].max(axis=0), cell_size)
+    order, cell_start = bucket_points_bev(points, grid_min, cell_size, grid_shape)
+    check_fn = _points_in_polygons_grid_parallel if parallel else _points_in_polygons_grid
+    check_fn(points, normal_vec, d, polygon_min, polygon_max, order, cell_start, grid_min, cell_size, grid_shape, ret)
+    return ret
+
+
+def polygon_surfaces_bounds(polygon_surfaces):
+    # face equations (same as points_in_convex_polygon_3d_jit) and padded bounding boxes of the polygons,
+    # padded so that rounding in the face test can never reach outside of the bounding boxes.
+    num_polygons = polygon_surfaces.shape[0]
+    normal_vec, d = surface_equ_3d_jitv2(polygon_surfaces[:, :, :3, :])
+    corners = polygon_surfaces.reshape(num_polygons, -1, 3)
+    polygon_min = corners.min(axis=1).astype(np.float64) - 1e-2
+    polygon_max = corners.max(axis=1).astype(np.float64) + 1e-2
+    return normal_vec, d, polygon_min, polygon_max
+
+
+def bev_grid_params(grid_min, grid_max, cell_size):
+    # grid covering [grid_min, grid_max] in bev, at most ~1M cells (for far away or broken boxes).
+    grid_min = np.asarray(grid_min, dtype=np.float64)
+    grid_size = np.asarray(grid_max, dtype=np.float64) - grid_min
+    cell_size = max(cell_size, np.sqrt(grid_size[0] * grid_size[1] / (1 << 20)))
+    grid_shape = np.maximum(np.ceil(grid_size / cell_size).astype(np.int64), 1)
+    return grid_min, cell_size, grid_shape
+
+
+def points_in_convex_polygon_3d_buckets(points, polygon_surfaces, order, cell_start, grid_min, cell_size, grid_shape):
+    """same as points_in_convex_polygon_3d_grid, with the points already bucketed by bucket_points_bev
+    (e.g. once per sample); the entries of order < 0 (removed points) are skipped.
+    Returns:
+        [num_points, num_polygon] bool array.
+    """
+    ret = np.zeros((points.shape[0], polygon_surfaces.shape[0]), dtype=np.bool_)
+    if points.shape[0] == 0 or polygon_surfaces.shape[0] == 0:
+        return ret
+    normal_vec, d, polygon_min, polygon_max = polygon_surfaces_bounds(polygon_surfaces)
+    _points_in_polygons_grid(points, normal_vec, d, polygon_min, polygon_max, order, cell_start, grid_min, cell_size,
+                             grid_shape, ret)
+    return ret
+
+
+@numba.njit
+def bucket_points_bev(points, grid_min, cell_size, grid_shape):
+    # counting sort of the points by bev cell, the points outside of the grid are dropped.
+    # return order: [num_points_in_grid,] point indices sorted by cell, cell_start: [num_cells + 1,].
+    num_points = points.shape[0]
+    nx, ny = grid_shape[0], grid_shape[1]
+    point_cell = np.full((num_points,), -1, dtype=np.int64)
+    cell_start = np.zeros((nx * ny + 1,), dtype=np.int64)
+    for i in range(num_points):
+        cx = np.floor((points[i, 0] - grid_min[0]) / cell_size)
+        cy = np.floor((points[i, 1] - grid_min[1]) / cell_size)
+        if cx < 0 or cy < 0 or cx >= nx or cy >= ny:
+            continue
+        point_cell[i] = int(cy) * nx + int(cx)
+        cell_start[point_cell[i] + 1] += 1
+    for c in range(nx * ny):
+        cell_start[c + 1] += cell_start[c]
+    fill = cell_start[:-1].copy()
+    order = np.empty((cell_start[-1],), dtype=np.int64)
+    for i in range(num_points):
+        if point_cell[i] >= 0:
+            order[fill[point_cell[i]]] = i
+            fill[point_cell[i]] += 1
+    return order, cell_start
+
+
+def _points_in_polygons_grid_kernel(points, normal_vec, d, polygon_min, polygon_max, order, cell_start, grid_min,
+                                    cell_size, grid_shape, ret):
+    max_num_surfaces = normal_vec.shape[1]
+    nx, ny = grid_shape[0], grid_shape[1]
+    for j in numba.prange(normal_vec.shape[0]):
+        cx0 = max(int(np.floor((polygon_min[j, 0] - grid_min[0]) / cell_size)), 0)
+        cy0 = max(int(np.floor((polygon_min[j, 1] - grid_min[1]) / cell_size)), 0)
+        cx1 = min(int(np.floor((polygon_max[j, 0] - grid_min[0]) / cell_size)), nx - 1)
+        cy1 = min(int(np.floor((polygon_max[j, 1] - grid_min[1]) / cell_size)), ny - 1)
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                c = cy * nx + cx
+                for n in range(cell_start[c], cell_start[c + 1]):
+                    i = order[n]
+                    if i < 0:
+                        continue
+                    if (points[i, 0] < polygon_min[j, 0] or points[i, 0] > polygon_max[j, 0]
+                            or points[i, 1] < polygon_min[j, 1] or points[i, 1] > polygon_max[j, 1]
+                            or points[i, 2] < polygon_min[j, 2] or points[i, 2] > polygon_max[j, 2]):
+                        continue
+                    # same face equations & arithmetic as _points_in_convex_polygon_3d_jit.
+                    inside = True
+                    for k in range(max_num_surfaces):
+                        sign = (
+                            points[i, 0] * normal_vec[j, k, 0]
+                            + points[i, 1] * normal_vec[j, k, 1]
+                            + points[i, 2] * normal_vec[j, k, 2]
+                            + d[j, k]
+                        )
+                        if sign >= 0:
+                            inside = False
+                            break
+                    ret[i, j] = inside
+
+
+# each polygon only writes its own column of ret, so the polygons can be checked in parallel.
+_points_in_polygons_grid = numba.njit(_points_in_polygons_grid_kernel)
+_points_in_polygons_grid_parallel = numba.njit(parallel=True)(_points_in_polygons_grid_kernel)
+
+
 @numba.jit
 def points_in_convex_polygon_jit(points, polygon, clockwise=True):
     """check points is in 2d convex polygons. True when point in polygon
@@ -0,0 +1,173 @@
+import numpy as np
+from det3d.core.bbox import box_np_ops
+from det3d.core.bbox.geometry import (
+    bev_grid_params,
+    bucket_points_bev,
+    points_in_convex_polygon_3d_buckets,
+    points_in_convex_polygon_3d_grid,
+)
+
+
+def rbbox_surfaces(boxes, origin=(0.5, 0.5, 0.5)):
+    # same surfaces as points_in_rbbox, boxes: [N, 7], [x, y, z, w, l, h, ry] in velo coord.
+    corners = box_np_ops.center_to_corner_box3d(boxes[:, :3], boxes[:, 3:6], boxes[:, 6], origin=origin, axis=2)
+    return box_np_ops.corner_to_surfaces_3d(corners)
+
+
+class PointBoxIndex(object):
+    '''
+        Sparse point -> box membership of one sample (same as points_in_rbbox), built once after GT-AUG and kept in
+        res["lidar"]["point_box_index"], so that the following stages of the pipeline update it when they remove,
+        reorder, add or move points and boxes, instead of testing the whole cloud against the boxes again.
+
+        point_ids, box_ids: [num_pairs,] the (point, box) pairs, sorted by point then box.
+
+        The bev buckets of the points used to build it are kept to find the points entering moved boxes; they are only
+        valid while the points keep their coordinates (see invalidate_grid), the points that moved or were added later
+        are kept aside ("loose") and always checked.
+    '''
+
+    def __init__(self, points, boxes, cell_size=1.0):
+        self.num_points = points.shape[0]
+        self.num_boxes = boxes.shape[0]
+        self._grid = None
+        self._build_to_current = np.arange(self.num_points, dtype=np.int64)
+        self._loose = np.zeros((self.num_points,), dtype=np.bool_)
+        if self.num_points > 0:
+            grid_min, cell_size, grid_shape = bev_grid_params(points[:, :2].min(axis=0), points[:, :2].max(axis=0) + 1e-3, cell_size)
+            order, cell_start = bucket_points_bev(points, grid_min, cell_size, grid_shape)
+            self._grid = (order, cell_start, grid_min, cell_size, grid_shape)
+        masks = self._query_grid(points, rbbox_surfaces(boxes)) if self.num_boxes > 0 else \
+            np.zeros((self.num_points, 0), dtype=np.bool_)
+        self.point_ids, self.box_ids = np.nonzero(masks)
+
+    def masks(self):
+        # dense [num_points, num_boxes] bool array, as points_in_rbbox.
+        masks = np.zeros((self.num_points, self.num_boxes), dtype=np.bool_)
+        masks[self.point_ids, self.box_ids] = True
+        return masks
+
+    def points_in_boxes(self, box_mask=None):
+        # [num_points,] bool, points in any of the boxes (selected by box_mask).
+        pair_mask = np.ones_like(self.box_ids, dtype=np.bool_) if box_mask is None else box_mask[self.box_ids]
+        ret = np.zeros((self.num_points,), dtype=np.bool_)
+        ret[self.point_ids[pair_mask]] = True
+        return ret
+
+    def first_box(self, box_mask=None):
+        # [num_points,] the first box (selected by box_mask) containing each point, -1 if none.
+        pair_mask = np.ones_like(self.box_ids, dtype=np.bool_) if box_mask is None else box_mask[self.box_ids]
+        point_ids, box_ids = self.point_ids[pair_mask], self.box_ids[pair_mask]
+        ret = np.full((self.num_points,), -1, dtype=np.int64)
+        ret[point_ids[::-1]] = box_ids[::-1]  # pairs are sorted, the last write is the first box.
+        return ret
+
+    def box_point_ids(self):
+        # list of the point ids in each box.
+        order = np.argsort(self.box_ids, kind="stable")
+        split = np.searchsorted(self.box_ids[order], np.arange(1, self.num_boxes))
+        return np.split(self.point_ids[order], split)
+
+    def take_points(self, indices):
+        # points = points[indices] (index array, possibly with duplicates, or bool mask).
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            current_to_new = np.cumsum(indices) - 1
+            current_to_new[np.logical_not(indices)] = -1
+            pair_mask = indices[self.point_ids]
+            self.point_ids, self.box_ids = current_to_new[self.point_ids[pair_mask]], self.box_ids[pair_mask]
+            self._loose = self._loose[indices]
+            self._build_to_current = np.where(self._build_to_current >= 0, current_to_new[self._build_to_current], -1)
+            self.num_points = self._loose.shape[0]
+            return
+        indices = indices.astype(np.int64)
+        num_pairs = np.bincount(self.point_ids, minlength=self.num_points)
+        first_pair = np.cumsum(num_pairs) - num_pairs
+        new_num_pairs = num_pairs[indices]
+        pair_offsets = np.arange(new_num_pairs.sum()) - np.repeat(np.cumsum(new_num_pairs) - new_num_pairs, new_num_pairs)
+        pairs = np.repeat(first_pair[indices], new_num_pairs) + pair_offsets
+        self.point_ids = np.repeat(np.arange(indices.shape[0]), new_num_pairs)
+        self.box_ids = self.box_ids[pairs]
+
+        current_to_new = np.full((self.num_points,), -1, dtype=np.int64)
+        current_to_new[indices] = np.arange(indices.shape[0])
+        self._build_to_current = np.where(self._build_to_current >= 0, current_to_new[self._build_to_current], -1)
+        # duplicated points are not in the buckets.
+        self._loose = self._loose[indices] | (current_to_new[indices] != np.arange(indices.shape[0]))
+        self.num_points = indices.shape[0]
+
+    def add_points(self, points, boxes, front=False):
+        # points = np.concatenate([points, old_points]) if front else np.concatenate([old_points, points]).
+        num_new = points.shape[0]
+        masks = points_in_convex_polygon_3d_grid(points[:, :3], rbbox_surfaces(boxes))
+        new_point_ids, new_box_ids = np.nonzero(masks)
+        point_ids = self.point_ids
+        if front:
+            point_ids = point_ids + num_new
+            self._build_to_current = np.where(self._build_to_current >= 0, self._build_to_current + num_new, -1)
+            self._loose = np.concatenate([np.ones((num_new,), dtype=np.bool_), self._loose])
+        else:
+            new_point_ids = new_point_ids + self.num_points
+            self._loose = np.concatenate([self._loose, np.ones((num_new,), dtype=np.bool_)])
+        self._set_pairs(np.concatenate([point_ids, new_point_ids]), np.concatenate([self.box_ids, new_box_ids]))
+        self.num_points += num_new
+
+    def select_boxes(self, keep):
+        # boxes = boxes[keep], keep: bool mask.
+        box_to_new = np.full((self.num_boxes,), -1, dtype=np.int64)
+        box_to_new[keep] = np.arange(keep.sum())
+        box_ids = box_to_new[self.box_ids]
+        valid = box_ids >= 0
+        self.point_ids, self.box_ids = self.point_ids[valid], box_ids[valid]
+        self.num_boxes = int(keep.sum())
+
+    def move_boxes(self, points, boxes, moved_boxes, moved_points):
+        '''
+            update the index after some boxes and points moved (per-object noise), points / boxes: the current ones.
+            moved_boxes: [num_boxes,] bool, moved_points: [num_points,] bool.
+            only the moved boxes are checked against the points (bucketed ones around them & loose ones), and only
+            the moved points against the other boxes.
+        '''
+        keep = np.logical_not(moved_boxes[self.box_ids] | moved_points[self.point_ids])
+        point_ids, box_ids = [self.point_ids[keep]], [self.box_ids[keep]]
+        self._loose |= moved_points
+        in_grid = self._build_to_current >= 0
+        in_grid[in_grid] = moved_points[self._build_to_current[in_grid]]
+        self._build_to_current[in_grid] = -1
+
+        moved_box_ids = np.nonzero(moved_boxes)[0]
+        if moved_box_ids.shape[0] > 0:
+            masks = self._query_grid(points, rbbox_surfaces(boxes[moved_box_ids]))
+            p, b = np.nonzero(masks)
+            point_ids.append(p)
+            box_ids.append(moved_box_ids[b])
+
+        static_box_ids = np.nonzero(np.logical_not(moved_boxes))[0]
+        moved_point_ids = np.nonzero(moved_points)[0]
+        if static_box_ids.shape[0] > 0 and moved_point_ids.shape[0] > 0:
+            masks = points_in_convex_polygon_3d_grid(points[moved_point_ids, :3], rbbox_surfaces(boxes[static_box_ids]))
+            p, b = np.nonzero(masks)
+            point_ids.append(moved_point_ids[p])
+            box_ids.append(static_box_ids[b])
+        self._set_pairs(np.concatenate(point_ids), np.concatenate(box_ids))
+
+    def invalidate_grid(self):
+        # the points were transformed as a whole (global augmentation): membership is unchanged, the buckets are not.
+        self._grid = None
+        self._loose[:] = True
+
+    def _query_grid(self, points, surfaces):
+        # dense [num_points, num_surfaces] membership, with the buckets for the points still in them.
+        if self._grid is None:
+            return points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
+        order, cell_start, grid_min, cell_size, grid_shape = self._grid
+        masks = points_in_convex_polygon_3d_buckets(points[:, :3], surfaces, self._build_to_current[order], cell_start,
+                                                    grid_min, cell_size, grid_shape)
+        loose_ids = np.nonzero(self._loose)[0]
+        if loose_ids.shape[0] > 0:
+            masks[loose_ids] = points_in_convex_polygon_3d_grid(points[loose_ids, :3], surfaces)
+        return masks
+
+    def _set_pairs(self, point_ids, box_ids):
+        order = np.lexsort((box_ids, point_ids))
+        self.point_ids, self.box_ids = point_ids[order], box_ids[order]
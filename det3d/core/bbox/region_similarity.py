@@ -19,6 +19,7 @@ between the boxes in two BoxLists.
 """
 from abc import ABCMeta, abstractmethod
 
+import numpy as np
 from det3d.core.bbox import box_np_ops
 
 
@@ -98,6 +99,67 @@ class NearestIouSimilarity(RegionSimilarityCalculator):
         return ret
 
 
+class GridNearestIouSimilarity(NearestIouSimilarity):
+    """Same nearest bev iou as NearestIouSimilarity, but anchors generated on a regular bev grid
+  (AnchorGeneratorRange) can be compared with compare_grid: each gt box only evaluates the iou with
+  the anchors in its window of grid cells, instead of all 70400 anchors. The result is bit-identical
+  to the dense version.
+  """
+
+    def __init__(self):
+        # id(anchors) -> (anchors, prepared grid), only for read-only anchors (the shared anchor cache).
+        self._grid_cache = {}
+
+    def compare_grid(self, anchors, boxes2):
+        """Compute pairwise nearest bev iou between anchors on a grid and the boxes.
+
+    Args:
+      anchors: [D, H, W, A, 7] anchors in the grid layout of the anchor generator.
+      boxes2: [M, 5] [x,y,w,l,r] boxes.
+
+    Returns:
+      A tensor with shape [D * H * W * A, M], same as compare(anchors[..., [0, 1, 3, 4, -1]].reshape(-1, 5), boxes2).
+    """
+        grid = self._prepare_grid(anchors)
+        if grid is None:
+            return self._compare(anchors.reshape(-1, anchors.shape[-1])[:, [0, 1, 3, 4, -1]], boxes2)
+
+        anchors_bv, x_centers, y_centers, extents = grid
+        boxes2_bv = box_np_ops.rbbox2d_to_near_bbox(boxes2)
+        return box_np_ops.iou_jit_grid_window(anchors_bv, boxes2_bv, x_centers, y_centers, extents, eps=0.0)
+
+    def _prepare_grid(self, anchors):
+        cached = self._grid_cache.get(id(anchors))
+        if cached is not None and cached[0] is anchors:
+            return cached[1]
+
+        D, H, W, A = anchors.shape[:4]
+        x_centers = anchors[0, 0, :, 0, 0]  # [W,]
+        y_centers = anchors[0, :, 0, 0, 1]  # [H,]
+        if D != 1 or not (self._is_regular(x_centers) and self._is_regular(y_centers)):
+            grid = None
+        else:
+            anchors_bv = box_np_ops.rbbox2d_to_near_bbox(anchors.reshape(-1, anchors.shape[-1])[:, [0, 1, 3, 4, -1]])
+            anchors_bv = anchors_bv.reshape(H, W, A, 4)
+            centers = np.stack(np.meshgrid(x_centers, y_centers), axis=-1)[:, :, np.newaxis, :]  # [H, W, 1, 2]
+            extents = np.concatenate([centers - anchors_bv[..., :2], anchors_bv[..., 2:] - centers], axis=-1)
+            extents = extents.reshape(-1, A, 4).max(axis=0)  # [A, 4]
+            grid = (anchors_bv, x_centers, y_centers, extents)
+
+        if not anchors.flags.writeable:
+            self._grid_cache[id(anchors)] = (anchors, grid)
+        return grid
+
+    @staticmethod
+    def _is_regular(centers):
+        # evenly spaced and increasing, up to half a cell (the window is widened by one cell).
+        if len(centers) < 2:
+            return True
+        stride = (centers[-1] - centers[0]) / (len(centers) - 1)
+        expected = centers[0] + stride * np.arange(len(centers))
+        return stride > 0 and np.abs(centers - expected).max() < 0.5 * stride
+
+
 class DistanceSimilarity(RegionSimilarityCalculator):
     """Class to compute similarity based on Intersection over Area (IOA) metric.
 
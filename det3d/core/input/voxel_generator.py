@@ -4,11 +4,11 @@ import numpy as np
 #from det3d.ops.point_cloud.point_cloud_ops import points_to_voxel
 
 # fast version:
-from det3d.ops.point_cloud.point_cloud_ops_v2 import points_to_voxel
+from det3d.ops.point_cloud.point_cloud_ops_v2 import Voxelizer
 
 
 class VoxelGenerator:
-    def __init__(self, voxel_size, point_cloud_range, max_num_points, max_voxels=20000):
+    def __init__(self, voxel_size, point_cloud_range, max_num_points, max_voxels=20000, mode="numba"):
         point_cloud_range = np.array(point_cloud_range, dtype=np.float32)
         # [0, -40, -3, 70.4, 40, 1]
         voxel_size = np.array(voxel_size, dtype=np.float32)
@@ -20,16 +20,15 @@ class VoxelGenerator:
         self._max_num_points = max_num_points
         self._max_voxels = max_voxels
         self._grid_size = grid_size
+        # mode: "numba" or "numpy" (sort based, no jit warm-up in new workers), see Voxelizer.
+        self._voxelizer = Voxelizer(voxel_size, point_cloud_range, max_num_points, True, max_voxels, mode=mode)
 
     def generate(self, points, max_voxels=20000):
-        return points_to_voxel(
-            points,
-            self._voxel_size,
-            self._point_cloud_range,
-            self._max_num_points,
-            True,
-            self._max_voxels,
-        )
+        return self._voxelizer.generate(points)
+
+    def generate_batch(self, points_list):
+        # voxelize several point clouds in one pass, returns a list of (voxels, coordinates, num_points_per_voxel).
+        return self._voxelizer.generate_batch(points_list)
 
     @property
     def voxel_size(self):
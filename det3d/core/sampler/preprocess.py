@@ -11,12 +11,55 @@ import torch
 from det3d.core.bbox import box_np_ops
 from det3d.core.bbox.geometry import (
     is_line_segment_intersection_jit,
-    points_in_convex_polygon_3d_jit,
+    points_in_convex_polygon_3d_grid,
     points_in_convex_polygon_jit,
 )
 import copy
 
 
+class DbColumns:
+    '''
+        Struct of arrays of the gt database infos of one class, columns[key]: [N, ...] for each db_info key
+        (box3d_lidar [N, 7], num_points_in_gt [N], difficulty [N], path [N], packed_offset [N], ...), so that the
+        db filters and the sampling are fancy-indexing instead of lists of per-object dicts.
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+        assert len(set(len(column) for column in columns.values())) <= 1, "columns of different lengths"
+
+    @classmethod
+    def from_infos(cls, db_infos):
+        # db_infos: [db_info, ...] of dbinfos_*.pkl, or the DbInfoColumns of an info store (memory-mapped columns).
+        if isinstance(db_infos, DbColumns):
+            return db_infos
+        if hasattr(db_infos, "columns"):
+            return cls(dict(db_infos.columns))
+        if len(db_infos) == 0:
+            return cls({})
+        return cls({key: np.stack([np.asarray(info[key]) for info in db_infos], axis=0) for key in db_infos[0].keys()})
+
+    @staticmethod
+    def concatenate(db_columns):
+        db_columns = [c for c in db_columns if len(c) > 0]
+        if len(db_columns) == 0:
+            return DbColumns({})
+        return DbColumns({key: np.concatenate([c[key] for c in db_columns], axis=0) for key in db_columns[0].columns})
+
+    def take(self, indices):
+        # indices: int array or bool mask, returns new arrays (fancy indexing copies).
+        return DbColumns({key: np.asarray(column)[indices] for key, column in self.columns.items()})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if len(self.columns) > 0 else 0
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+
 class BatchSampler:
     def __init__(
         self, sampled_list, name=None, epoch=None, shuffle=True, drop_reminder=False
@@ -55,6 +98,8 @@ class BatchSampler:
 
     def sample(self, num):
         indices = self._sample(num)
+        if isinstance(self._sampled_list, DbColumns):
+            return self._sampled_list.take(indices)
         return [self._sampled_list[i] for i in indices]
         # return np.random.choice(self._sampled_list, num)
 
@@ -76,11 +121,15 @@ class DBFilterByDifficulty(DataBasePreprocessing):
     def _preprocess(self, db_infos):
         new_db_infos = {}
         for key, dinfos in db_infos.items():  # multiple classes
-            new_db_infos[key] = [
-                info
-                for info in dinfos
-                if info["difficulty"] not in self._removed_difficulties
-            ]
+            if isinstance(dinfos, DbColumns):
+                removed = np.isin(dinfos["difficulty"], self._removed_difficulties) if len(dinfos) > 0 else []
+                new_db_infos[key] = dinfos.take(np.logical_not(removed))
+            else:
+                new_db_infos[key] = [
+                    info
+                    for info in dinfos
+                    if info["difficulty"] not in self._removed_difficulties
+                ]
         return new_db_infos
 
 
@@ -91,7 +140,10 @@ class DBFilterByMinNumPoint(DataBasePreprocessing):
 
     def _preprocess(self, db_infos):
         for name, min_num in self._min_gt_point_dict.items():  # [Car, 5]
-            if min_num > 0:
+            if min_num > 0 and isinstance(db_infos[name], DbColumns):
+                dinfos = db_infos[name]
+                db_infos[name] = dinfos.take(dinfos["num_points_in_gt"] >= min_num if len(dinfos) > 0 else [])
+            elif min_num > 0:
                 filtered_infos = []
                 for info in db_infos[name]:
                     if info["num_points_in_gt"] >= min_num:
@@ -193,7 +245,7 @@ def filter_gt_low_points(gt_boxes, points, num_gt_points, point_num_threshold=2)
 
 def mask_points_in_corners(points, box_corners):
     surfaces = box_np_ops.corner_to_surfaces_3d(box_corners)
-    mask = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+    mask = points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
     return mask
 
 
@@ -559,6 +611,25 @@ def points_transform_(points, centers, point_masks, loc_transform, rot_transform
                     points[i, :3] += loc_transform[j]
                     break
 
+@numba.njit
+def points_transform_sparse_(points, centers, point_box_ids, loc_transform, rot_transform):
+    '''
+        same as points_transform_, with the box of each point given by point_box_ids: [num_points,], the first valid
+        box containing the point or -1 (PointBoxIndex.first_box).
+    '''
+    num_box = centers.shape[0]
+    rot_mat_T = np.zeros((num_box, 3, 3), dtype=points.dtype)
+    for i in range(num_box):
+        _rotation_matrix_3d_(rot_mat_T[i], rot_transform[i], 2)
+    for i in range(points.shape[0]):
+        j = point_box_ids[i]
+        if j >= 0:
+            points[i, :3] -= centers[j, :3]
+            points[i : i + 1, :3] = points[i : i + 1, :3] @ rot_mat_T[j]
+            points[i, :3] += centers[j, :3]
+            points[i, :3] += loc_transform[j]
+
+
 @numba.njit
 def box3d_transform_(boxes, loc_transform, rot_transform, valid_mask):
     num_box = boxes.shape[0]
@@ -591,7 +662,9 @@ def noise_per_box(boxes, valid_mask, loc_noises, rot_noises):
     num_boxes = boxes.shape[0]
     num_tests = loc_noises.shape[1]   # num_try: 100
     box_corners = box_np_ops.box2d_to_corner_jit(boxes)  # rotation has been performed
+    boxes_standup = box_np_ops.corner_to_standup_nd_jit(box_corners)  # kept in sync with box_corners
     current_corners = np.zeros((4, 2), dtype=boxes.dtype)
+    current_standup = np.zeros((4,), dtype=boxes.dtype)
     rot_mat_T = np.zeros((2, 2), dtype=boxes.dtype)
     success_mask = -np.ones((num_boxes,), dtype=np.int64)  # default: -1
     # print(valid_mask)
@@ -602,11 +675,17 @@ def noise_per_box(boxes, valid_mask, loc_noises, rot_noises):
                 current_corners -= boxes[i, :2]                                    # see last line of box2d_to_corner_jit
                 _rotation_box2d_jit_(current_corners, rot_noises[i, j], rot_mat_T) # rotation with rot_noises,
                 current_corners += boxes[i, :2] + loc_noises[i, j, :2]             # translation with loc_noises,
-                coll_mat = box_collision_test(current_corners.reshape(1, 4, 2), box_corners)  # [1, num_valid_box]
-                coll_mat[0, i] = False
-                if not coll_mat.any():                # no collision; if loop ends without break -> no noise performed.
+                current_standup[0], current_standup[1] = current_corners[:, 0].min(), current_corners[:, 1].min()
+                current_standup[2], current_standup[3] = current_corners[:, 0].max(), current_corners[:, 1].max()
+                collision = False                     # stop at the first collided box.
+                for k in range(num_boxes):
+                    if k != i and box_sat_collision(current_corners, box_corners[k], current_standup, boxes_standup[k]):
+                        collision = True
+                        break
+                if not collision:                     # no collision; if loop ends without break -> no noise performed.
                     success_mask[i] = j               # index of selected noise
                     box_corners[i] = current_corners  # i-th box updated
+                    boxes_standup[i] = current_standup
                     break
     return success_mask
 
@@ -614,7 +693,7 @@ def noise_per_box(boxes, valid_mask, loc_noises, rot_noises):
 
 def noise_per_object_v4_(gt_boxes, points=None, valid_mask=None, rotation_perturb=np.pi / 4, center_noise_std=1.0,\
                           global_random_rot_range=np.pi / 4, num_try=5, group_ids=None, data_aug_with_context=-1.0,\
-                         data_aug_random_drop=-1.0):
+                         data_aug_random_drop=-1.0, point_box_index=None):
     """
         perform random rotation and translation on each groundtruth independently.
 
@@ -625,6 +704,8 @@ def noise_per_object_v4_(gt_boxes, points=None, valid_mask=None, rotation_pertur
             center_noise_std: [1.0, 1.0, 0.5],
             global_random_rot_range: [0, 0]
             num_try: 100
+            point_box_index: PointBoxIndex of points & gt_boxes, used instead of testing all the points against the
+                boxes and updated after the noise (not with data_aug_with_context, the boxes are enlarged).
     """
     num_boxes = gt_boxes.shape[0]
 
@@ -645,9 +726,16 @@ def noise_per_object_v4_(gt_boxes, points=None, valid_mask=None, rotation_pertur
 
     loc_transforms = _select_transform(loc_noises, selected_noise)
     rot_transforms = _select_transform(rot_noises, selected_noise)
+    if points is not None and point_box_index is not None and data_aug_with_context <= 0:
+        point_box_ids = point_box_index.first_box(valid_mask)
+        points_transform_sparse_(points, gt_boxes[:, :3], point_box_ids, loc_transforms, rot_transforms)
+        box3d_transform_(gt_boxes, loc_transforms, rot_transforms, valid_mask)
+        point_box_index.move_boxes(points, gt_boxes, valid_mask, point_box_ids >= 0)
+        return
+
     surfaces = box_np_ops.corner_to_surfaces_3d_jit(gt_box_corners)
     if points is not None:
-        point_masks = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+        point_masks = points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
 
         # todo: perform random drop here.
         if data_aug_random_drop > 0.0:
@@ -656,6 +744,8 @@ def noise_per_object_v4_(gt_boxes, points=None, valid_mask=None, rotation_pertur
         points_transform_(points, gt_boxes[:, :3], point_masks, loc_transforms, rot_transforms, valid_mask, )
 
     box3d_transform_(gt_boxes, loc_transforms, rot_transforms, valid_mask)
+    if point_box_index is not None:
+        point_box_index.move_boxes(points, gt_boxes, np.ones((num_boxes,), dtype=np.bool_), np.ones((points.shape[0],), dtype=np.bool_))
 
 
 def noise_per_object_v5_(gt_boxes, points=None, valid_mask=None, rotation_perturb=np.pi / 4, center_noise_std=1.0, \
@@ -694,7 +784,7 @@ def noise_per_object_v5_(gt_boxes, points=None, valid_mask=None, rotation_pertur
     rot_transforms = _select_transform(rot_noises, selected_noise)
     surfaces = box_np_ops.corner_to_surfaces_3d_jit(gt_box_corners)
     if points is not None:
-        point_masks = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+        point_masks = points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
 
         # todo: perform random drop here.
         if data_aug_random_drop > 0.0:
@@ -778,7 +868,7 @@ def noise_per_object_v3_( gt_boxes, points=None, valid_mask=None, rotation_pertu
     rot_transforms = _select_transform(rot_noises, selected_noise)
     surfaces = box_np_ops.corner_to_surfaces_3d_jit(gt_box_corners)
     if points is not None:
-        point_masks = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+        point_masks = points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
         points_transform_(points, gt_boxes[:, :3], point_masks, loc_transforms, rot_transforms, valid_mask, )
 
     box3d_transform_(gt_boxes, loc_transforms, rot_transforms, valid_mask)
@@ -845,7 +935,7 @@ def noise_per_object_v2_(
     rot_transforms = _select_transform(rot_noises, selected_noise)
     if points is not None:
         surfaces = box_np_ops.corner_to_surfaces_3d_jit(gt_box_corners)
-        point_masks = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
+        point_masks = points_in_convex_polygon_3d_grid(points[:, :3], surfaces)
         points_transform_(
             points,
             gt_boxes[:, :3],
@@ -941,6 +1031,64 @@ def global_rotation_v3(gt_boxes, points, rotation=np.pi / 4):
     return gt_boxes, points, noise_rotation
 
 
+@numba.njit
+def _affine_transform_points_(points, matrix):
+    # points[:, :3] = points[:, :3] @ matrix[:3, :3].T + matrix[:3, 3], in place.
+    for i in range(points.shape[0]):
+        x, y, z = points[i, 0], points[i, 1], points[i, 2]
+        for j in range(3):
+            points[i, j] = matrix[j, 0] * x + matrix[j, 1] * y + matrix[j, 2] * z + matrix[j, 3]
+
+
+class GlobalTransform:
+    '''
+        Global augmentation of a frame: random flip (y -> -y), rotation around z and scaling, sampled with the same
+        random draws as random_flip_v2, global_rotation_v3 and global_scaling_v3 in a row, and composed into one affine
+        transform applied in a single pass:
+            xyz' = matrix[:3, :3] @ xyz + matrix[:3, 3], size' = noise_scale * size, yaw' = yaw_sign * yaw + yaw_offset.
+        to_dict() is stored in res["lidar"]["transformation"], the head applies it to the teacher boxes
+        (box_torch_ops.global_transform_boxes).
+    '''
+    def __init__(self, flipped=False, noise_rotation=0.0, noise_scale=1.0):
+        self.flipped = bool(flipped)
+        self.noise_rotation = float(noise_rotation)
+        self.noise_scale = float(noise_scale)
+        rot_sin, rot_cos = np.sin(self.noise_rotation), np.cos(self.noise_rotation)
+        flip = np.diag([1.0, -1.0 if self.flipped else 1.0, 1.0])
+        rotation = np.array([[rot_cos, rot_sin, 0], [-rot_sin, rot_cos, 0], [0, 0, 1]])  # as rotation_points_single_angle
+        self.matrix = np.eye(4)
+        self.matrix[:3, :3] = self.noise_scale * rotation @ flip
+        self.yaw_sign = -1.0 if self.flipped else 1.0
+        self.yaw_offset = (np.pi if self.flipped else 0.0) + self.noise_rotation
+
+    @classmethod
+    def sample(cls, rotation=np.pi / 4, min_scale=0.95, max_scale=1.05, flip_probability=0.5):
+        flipped = np.random.choice([False, True], replace=False, p=[1 - flip_probability, flip_probability])
+        if not isinstance(rotation, list):
+            rotation = [-rotation, rotation]
+        noise_rotation = np.random.uniform(rotation[0], rotation[1])
+        noise_scale = np.random.uniform(min_scale, max_scale)
+        return cls(flipped, noise_rotation, noise_scale)
+
+    def apply_(self, gt_boxes=None, points=None):
+        '''
+            gt_boxes: [N, 7] or [N, 9], [x, y, z, w, l, h, (vx, vy,) ry], points: [M, 3+], both transformed in place.
+        '''
+        if points is not None:
+            _affine_transform_points_(points, self.matrix)
+        if gt_boxes is not None:
+            gt_boxes[:, :3] = gt_boxes[:, :3] @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+            gt_boxes[:, 3:6] *= self.noise_scale
+            if gt_boxes.shape[1] > 7:
+                gt_boxes[:, 6:8] = gt_boxes[:, 6:8] @ self.matrix[:2, :2].T
+            gt_boxes[:, -1] = self.yaw_sign * gt_boxes[:, -1] + self.yaw_offset
+        return gt_boxes, points
+
+    def to_dict(self):
+        return {"flipped": self.flipped, "noise_rotation": self.noise_rotation, "noise_scale": self.noise_scale,
+                "matrix": self.matrix.astype(np.float32), "yaw_sign": self.yaw_sign, "yaw_offset": self.yaw_offset}
+
+
 @numba.jit(nopython=True)
 def box_collision_test(boxes, qboxes, clockwise=True):
     N = boxes.shape[0]
@@ -1027,6 +1175,157 @@ def box_collision_test(boxes, qboxes, clockwise=True):
     return ret
 
 
+@numba.njit
+def _box_sat_separated(box, qbox):
+    '''
+        box, qbox: [4, 2] corners of convex quadrilaterals;
+        return: True if one of the edge normals of box is a separating axis (touching boxes are separated).
+    '''
+    for k in range(4):
+        nx = box[k, 1] - box[(k + 1) % 4, 1]
+        ny = box[(k + 1) % 4, 0] - box[k, 0]
+        box_min = box_max = box[0, 0] * nx + box[0, 1] * ny
+        qbox_min = qbox_max = qbox[0, 0] * nx + qbox[0, 1] * ny
+        for l in range(1, 4):
+            proj = box[l, 0] * nx + box[l, 1] * ny
+            box_min, box_max = min(box_min, proj), max(box_max, proj)
+            proj = qbox[l, 0] * nx + qbox[l, 1] * ny
+            qbox_min, qbox_max = min(qbox_min, proj), max(qbox_max, proj)
+        if box_max <= qbox_min or qbox_max <= box_min:
+            return True
+    return False
+
+
+@numba.njit
+def box_sat_collision(box, qbox, box_standup, qbox_standup):
+    '''
+        Exact collision test of two bev boxes ([4, 2] corners) with the separating axis theorem, after a cheap
+        rejection by their standup boxes ([4], xmin, ymin, xmax, ymax). Unlike box_collision_test, the overlaps of
+        boxes with collinear edges (e.g. two aligned cars in one lane) are collisions: that test only looks for strict
+        edge crossings & corners strictly inside, and misses them. Touching boxes are not collisions.
+    '''
+    iw = min(box_standup[2], qbox_standup[2]) - max(box_standup[0], qbox_standup[0])
+    if iw <= 0:
+        return False
+    ih = min(box_standup[3], qbox_standup[3]) - max(box_standup[1], qbox_standup[1])
+    if ih <= 0:
+        return False
+    return not (_box_sat_separated(box, qbox) or _box_sat_separated(qbox, box))
+
+
+def _box_collision_test_sweep(boxes, qboxes):
+    N = boxes.shape[0]
+    K = qboxes.shape[0]
+    ret = np.zeros((N, K), dtype=np.bool_)
+    if N == 0 or K == 0:
+        return ret
+    boxes_standup = box_np_ops.corner_to_standup_nd_jit(boxes)
+    qboxes_standup = box_np_ops.corner_to_standup_nd_jit(qboxes)
+
+    # broad phase: qboxes sorted by xmin, each box only visits the qboxes whose xmin is in (xmin - max_width, xmax).
+    order = np.argsort(qboxes_standup[:, 0])
+    qboxes_xmin = qboxes_standup[order, 0]
+    max_width = (qboxes_standup[:, 2] - qboxes_standup[:, 0]).max() + 1e-3
+    for i in numba.prange(N):
+        start = np.searchsorted(qboxes_xmin, boxes_standup[i, 0] - max_width)
+        end = np.searchsorted(qboxes_xmin, boxes_standup[i, 2])
+        for idx in range(start, end):
+            j = order[idx]
+            # narrow phase: exact sat test.
+            if box_sat_collision(boxes[i], qboxes[j], boxes_standup[i], qboxes_standup[j]):
+                ret[i, j] = True
+    return ret
+
+
+# Collision matrix of box_collision_test, with sort-and-sweep culling on the standup boxes and sat tests (see
+# box_sat_collision for where the decisions differ) on the candidate pairs only; the parallel version distributes the
+# boxes over threads, useful for large sets (> 100 boxes).
+box_collision_test_sweep = numba.njit(_box_collision_test_sweep)
+box_collision_test_sweep_parallel = numba.njit(parallel=True)(_box_collision_test_sweep)
+
+
+@numba.njit
+def _occupancy_grid_place_(boxes, boxes_standup, check, corners, standups, heads, entry_box, entry_next, counts, cell_size):
+    '''
+        Place boxes one by one into the grid hash, see BevOccupancyGrid.place; counts: [num_placed, num_entries].
+    '''
+    num_boxes = boxes.shape[0]
+    table_mask = heads.shape[0] - 1
+    accepted = np.zeros((num_boxes,), dtype=np.bool_)
+    for i in range(num_boxes):
+        x_start = int(np.floor(boxes_standup[i, 0] / cell_size))
+        y_start = int(np.floor(boxes_standup[i, 1] / cell_size))
+        x_end = int(np.floor(boxes_standup[i, 2] / cell_size))
+        y_end = int(np.floor(boxes_standup[i, 3] / cell_size))
+        collision = False
+        if check:
+            for x in range(x_start, x_end + 1):
+                for y in range(y_start, y_end + 1):
+                    e = heads[((x * 73856093) ^ (y * 19349663)) & table_mask]
+                    while e >= 0 and not collision:
+                        k = entry_box[e]
+                        collision = box_sat_collision(boxes[i], corners[k], boxes_standup[i], standups[k])
+                        e = entry_next[e]
+        if not collision:
+            k = counts[0]
+            corners[k] = boxes[i]
+            standups[k] = boxes_standup[i]
+            counts[0] += 1
+            for x in range(x_start, x_end + 1):
+                for y in range(y_start, y_end + 1):
+                    h = ((x * 73856093) ^ (y * 19349663)) & table_mask
+                    e = counts[1]
+                    entry_box[e] = k
+                    entry_next[e] = heads[h]
+                    heads[h] = e
+                    counts[1] += 1
+            accepted[i] = True
+    return accepted
+
+
+class BevOccupancyGrid:
+    '''
+        Grid hash of the placed bev boxes for incremental collision tests: each cell of cell_size (m) links the
+        boxes whose standup box overlaps it, so a new box is only tested (box_sat_collision) against its neighbours.
+    '''
+    def __init__(self, cell_size=4.0, capacity=64, table_size=1024):
+        assert table_size & (table_size - 1) == 0, "table_size should be a power of 2"
+        self.cell_size = cell_size
+        self._corners = np.zeros((capacity, 4, 2), dtype=np.float32)   # corners of placed boxes
+        self._standups = np.zeros((capacity, 4), dtype=np.float32)     # xmin, ymin, xmax, ymax of placed boxes
+        self._heads = -np.ones((table_size,), dtype=np.int64)          # hashed cell -> first entry
+        self._entry_box = np.zeros((capacity * 4,), dtype=np.int64)    # entry -> placed box
+        self._entry_next = np.zeros((capacity * 4,), dtype=np.int64)   # entry -> next entry in the same cell
+        self._counts = np.zeros((2,), dtype=np.int64)                  # num_placed, num_entries
+
+    def __len__(self):
+        return int(self._counts[0])
+
+    def _reserve(self, num_boxes, num_entries):
+        if self._counts[0] + num_boxes > self._corners.shape[0]:
+            capacity = max(2 * self._corners.shape[0], int(self._counts[0]) + num_boxes)
+            self._corners = np.concatenate([self._corners, np.zeros((capacity - self._corners.shape[0], 4, 2), np.float32)])
+            self._standups = np.concatenate([self._standups, np.zeros((capacity - self._standups.shape[0], 4), np.float32)])
+        if self._counts[1] + num_entries > self._entry_box.shape[0]:
+            capacity = max(2 * self._entry_box.shape[0], int(self._counts[1]) + num_entries)
+            self._entry_box = np.concatenate([self._entry_box, np.zeros((capacity - self._entry_box.shape[0],), np.int64)])
+            self._entry_next = np.concatenate([self._entry_next, np.zeros((capacity - self._entry_next.shape[0],), np.int64)])
+
+    def place(self, boxes, check=True):
+        '''
+            boxes: [N, 4, 2] bev corners, placed in order; a box is placed if it collides with none of the placed
+                   boxes (box_sat_collision), or always if check is False (like gt boxes).
+            return: [N], mask of the placed boxes.
+        '''
+        boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+        boxes_standup = np.concatenate([boxes.min(axis=1), boxes.max(axis=1)], axis=1)
+        cells = np.floor(boxes_standup / self.cell_size)
+        num_entries = int(((cells[:, 2] - cells[:, 0] + 1) * (cells[:, 3] - cells[:, 1] + 1)).sum())
+        self._reserve(boxes.shape[0], num_entries)
+        return _occupancy_grid_place_(boxes, boxes_standup, check, self._corners, self._standups, self._heads,
+                                      self._entry_box, self._entry_next, self._counts, self.cell_size)
+
+
 def global_translate_(gt_boxes, points, noise_translate_std):
     """
     Apply global translation to gt_boxes and points.
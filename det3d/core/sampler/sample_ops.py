@@ -266,7 +266,7 @@ class DataBaseSamplerV2:
         total_bv = np.concatenate([gt_boxes_bv, sp_boxes_bv], axis=0)
 
         # collision test on bev (stricter than 3d)
-        coll_mat = prep.box_collision_test(total_bv, total_bv)   # todo: too slow here
+        coll_mat = prep.box_collision_test_sweep(total_bv, total_bv)
         diag = np.arange(total_bv.shape[0])
         coll_mat[diag, diag] = False
 
@@ -334,7 +334,7 @@ class DataBaseSamplerV2:
         )
         total_bv = np.concatenate([gt_boxes_bv, sp_boxes_bv], axis=0)
         # coll_mat = collision_test_allbox(total_bv)
-        coll_mat = prep.box_collision_test(total_bv, total_bv)
+        coll_mat = prep.box_collision_test_sweep(total_bv, total_bv)
         diag = np.arange(total_bv.shape[0])
         coll_mat[diag, diag] = False
         valid_samples = []
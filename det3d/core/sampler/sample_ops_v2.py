@@ -1,4 +1,3 @@
-import copy
 import pathlib
 import pickle
 import time
@@ -23,8 +22,12 @@ class DataBaseSamplerV2:
         gt_random_drop=-1.0,
         gt_aug_with_context=-1.0,
         gt_aug_similar_type=False,
+        placement="batch",               # "batch": sample_class_v2, "incremental": sample_class_incremental
+        placement_time_budget=None,      # seconds per class, for incremental placement (None: no limit, reproducible)
+        placement_max_candidates=100,    # candidates drawn per class, for incremental placement
     ):
-        # load all gt database here.
+        # load all gt database here, as struct of arrays per class (boxes, num_points, difficulty, path / packed offset).
+        db_infos = {k: prep.DbColumns.from_infos(v) for k, v in db_infos.items()}
         for k, v in db_infos.items():
             logger.info(f"load {len(v)} {k} database infos")
 
@@ -44,6 +47,10 @@ class DataBaseSamplerV2:
         self._sample_max_nums = []
         self.gt_point_random_drop = gt_random_drop
         self.gt_aug_with_context = gt_aug_with_context
+        assert placement in ["batch", "incremental"], f"unknown gt-aug placement: {placement}"
+        self.placement = placement
+        self.placement_time_budget = placement_time_budget
+        self.placement_max_candidates = placement_max_candidates
 
         # get group_name: Car and group_max_num: 15
         self._group_db_infos = self.db_infos  # just use db_infos
@@ -58,7 +65,46 @@ class DataBaseSamplerV2:
             self._sampler_dict[k] = prep.BatchSampler(v, k)
 
         if gt_aug_similar_type:
-            self._sampler_dict["Car"] = prep.BatchSampler(self._group_db_infos["Car"] + self._group_db_infos["Van"], "Car")
+            self._sampler_dict["Car"] = prep.BatchSampler(prep.DbColumns.concatenate([self._group_db_infos["Car"], self._group_db_infos["Van"]]), "Car")
+
+        # memory-mapped packed gt databases (gt_database.bin), opened lazily in each dataloader worker.
+        self._packed_points = {}
+
+    def __getstate__(self):
+        # np.memmap would be pickled as a full in-memory copy, let every worker open its own map instead.
+        state = self.__dict__.copy()
+        state["_packed_points"] = {}
+        return state
+
+    def _get_packed_points(self, root_path, sampled, i, num_point_features):
+        '''
+            Return the memory-mapped packed gt database that the i-th sampled object belongs to, or None when it is
+            not available (db infos created before the packed file, or file missing) so that the per-object .bin
+            file is used.
+        '''
+        if "packed_offset" not in sampled:
+            return None
+        db_path = pathlib.Path(sampled["path"][i]).parent                  # gt_database
+        packed_path = pathlib.Path(root_path) / (str(db_path) + ".bin")   # object/gt_database.bin
+        key = (str(packed_path), num_point_features)
+        if key not in self._packed_points:
+            if packed_path.exists() and packed_path.stat().st_size > 0:
+                self._packed_points[key] = np.memmap(packed_path, dtype=np.float32, mode="r").reshape(-1, num_point_features)
+            else:
+                self._packed_points[key] = None
+        return self._packed_points[key]
+
+    def load_gt_points(self, root_path, sampled, i, num_point_features):
+        '''
+            Load the points of the i-th sampled gt object (sampled: DbColumns), saved with relative distance to its box
+            center.
+            return: [num_points, num_point_features], a new array which can be modified in place.
+        '''
+        packed_points = self._get_packed_points(root_path, sampled, i, num_point_features)
+        if packed_points is not None:
+            start = sampled["packed_offset"][i]
+            return np.array(packed_points[start: start + sampled["packed_num_points"][i]])
+        return np.fromfile(str(pathlib.Path(root_path) / sampled["path"][i]), dtype=np.float32).reshape(-1, num_point_features)
 
     def sample_all(
         self,
@@ -108,43 +154,42 @@ class DataBaseSamplerV2:
             #         all_gt_boxes = np.concatenate([all_gt_boxes, sampled_boxes], axis=0)
 
             # ensure final num_boxes fulfill the num requirement after collision test.
+            # incremental placement keeps drawing candidates itself until the quota is met.
+            sample_class_fn = self.sample_class_incremental if self.placement == "incremental" else self.sample_class_v2
+            max_times = 1 if self.placement == "incremental" else 2
             times = 0
-            while sampled_num > 0 and times < 2:
-                sampled_objects = self.sample_class_v2(class_name, sampled_num, all_gt_boxes)
-                sampled += sampled_objects
-            
+            while sampled_num > 0 and times < max_times:
+                sampled_objects = sample_class_fn(class_name, sampled_num, all_gt_boxes)   # DbColumns
+                sampled += [sampled_objects]
+
                 if len(sampled_objects) > 0:
-                    if len(sampled_objects) == 1:
-                        sampled_boxes = sampled_objects[0]["box3d_lidar"][np.newaxis, ...]
-                    else:
-                        sampled_boxes = np.stack([s["box3d_lidar"] for s in sampled_objects], axis=0)
-            
+                    sampled_boxes = sampled_objects["box3d_lidar"]
                     sampled_gt_boxes += [sampled_boxes]
                     all_gt_boxes = np.concatenate([all_gt_boxes, sampled_boxes], axis=0)
                 sampled_num -= len(sampled_objects)
                 times += 1
 
+        sampled = prep.DbColumns.concatenate(sampled)
         if len(sampled) > 0:
             ''' get points in sampled gt_boxes '''
             sampled_gt_boxes = np.concatenate(sampled_gt_boxes, axis=0)
             num_sampled = len(sampled)
             s_points_list = []
             # get points in sampled gt-boxes from pre-generated gt database.
-            for info in sampled:
+            for i in range(num_sampled):
                 try:
-                    s_points = np.fromfile(str(pathlib.Path(root_path) / info["path"]), dtype=np.float32).reshape(-1, num_point_features)
+                    s_points = self.load_gt_points(root_path, sampled, i, num_point_features)
                     # gt_points are saved with relative distance; so need to recover by adding box center.
-                    s_points[:, :3] += info["box3d_lidar"][:3]
+                    s_points[:, :3] += sampled["box3d_lidar"][i, :3]
 
                     if with_road_plane_cam is not None:
                         a, b, c, d = with_road_plane_cam
-                        box3d_cam_center = info['box3d_cam'][0:3]  # x,y,z with cam coord. bottom center.
+                        box3d_cam_center = sampled['box3d_cam'][i, 0:3]  # x,y,z with cam coord. bottom center.
                         cur_height_cam = (-d - a * box3d_cam_center[0] - c * box3d_cam_center[2]) / b
-                        move_height_cam = info['box3d_cam'][1] - cur_height_cam  # cal y dist, > 0: move up, < 0: move down.
+                        move_height_cam = sampled['box3d_cam'][i, 1] - cur_height_cam  # cal y dist, > 0: move up, < 0: move down.
 
                         s_points[:, 2] += move_height_cam
-                        index = sampled.index(info)
-                        sampled_gt_boxes[index, 2] += move_height_cam
+                        sampled_gt_boxes[i, 2] += move_height_cam
 
 
 
@@ -159,7 +204,7 @@ class DataBaseSamplerV2:
 
 
                 except Exception:
-                    print(info["path"])
+                    print(sampled["path"][i])
                     continue
 
             '''todo: do something about random crop'''
@@ -181,8 +226,8 @@ class DataBaseSamplerV2:
                 s_points_list = s_points_list_new
 
             ret = {
-                "gt_names": np.array([s["name"] for s in sampled]),
-                "difficulty": np.array([s["difficulty"] for s in sampled]),
+                "gt_names": np.array(sampled["name"]),
+                "difficulty": np.array(sampled["difficulty"]),
                 "gt_boxes": sampled_gt_boxes,
                 "points": np.concatenate(s_points_list, axis=0),
                 "gt_masks": np.ones((num_sampled,), dtype=np.bool_),
@@ -197,15 +242,16 @@ class DataBaseSamplerV2:
             This func aims to select fixed number of gt boxes from gt database with collision (bev iou) test performed.
         '''
 
-        # sample num gt_boxes from gt_database
+        # sample num gt_boxes from gt_database, DbColumns of new arrays.
         sampled = self._sampler_dict[name].sample(num)
-        sampled = copy.deepcopy(sampled)
+        if len(sampled) == 0:
+            return sampled
 
         num_sampled = len(sampled)
         num_gt = gt_boxes.shape[0]
 
         # get all boxes: gt_boxes + sp_boxes
-        sp_boxes = np.stack([i["box3d_lidar"] for i in sampled], axis=0)  # todo: need modification here
+        sp_boxes = sampled["box3d_lidar"]
         boxes = np.concatenate([gt_boxes, sp_boxes], axis=0).copy()
 
         offset = [0.0, 0.0]
@@ -219,12 +265,12 @@ class DataBaseSamplerV2:
         total_bv = np.concatenate([gt_boxes_bv, sp_boxes_bv], axis=0)
 
         # collision test on bev (stricter than 3d)
-        coll_mat = prep.box_collision_test(total_bv, total_bv)  # todo: too slow here
+        coll_mat = prep.box_collision_test_sweep(total_bv, total_bv)
         diag = np.arange(total_bv.shape[0])
         coll_mat[diag, diag] = False
 
         # get valid samples
-        valid_samples = []
+        valid = np.zeros((num_sampled,), dtype=np.bool_)
         for i in range(num_gt, num_gt + num_sampled):  # todo: the overall box num may not meet the requirement
             if coll_mat[i].any():
                 # i-th sampled box is not considered into auged gt-boxes.
@@ -232,19 +278,54 @@ class DataBaseSamplerV2:
                 coll_mat[:, i] = False
             else:
                 # i-th sampled box is considered into auged gt-boxes.
-                valid_samples.append(sampled[i - num_gt])
+                valid[i - num_gt] = True
 
-        return valid_samples
+        return sampled.take(valid)
 
 
+    def sample_class_incremental(self, name, num, gt_boxes):
+        '''
+            This func aims to place num gt boxes from gt database one by one: each candidate is only tested against
+            its neighbours in a grid hash of the placed boxes (gt_boxes + accepted ones), and more candidates are
+            drawn until num boxes are placed, placement_max_candidates are tried or placement_time_budget runs out.
+            The time budget makes the number of placed boxes (and the random stream after it) depend on the machine
+            load: leave it None for reproducible runs, placement_max_candidates bounds the work deterministically.
+        '''
+        start_time = time.time()
+        offset = [0.0, 0.0]
+        if self.gt_aug_with_context > 0.0:
+            offset = [self.gt_aug_with_context, self.gt_aug_with_context]
+
+        occupancy = prep.BevOccupancyGrid()
+        gt_boxes_bv = box_np_ops.center_to_corner_box2d(gt_boxes[:, 0:2], gt_boxes[:, 3:5], gt_boxes[:, -1])
+        occupancy.place(gt_boxes_bv, check=False)
+
+        valid_samples = []
+        num_valid = 0
+        num_candidates = 0
+        while num_valid < num and num_candidates < self.placement_max_candidates:
+            sampled = self._sampler_dict[name].sample(min(num - num_valid, self.placement_max_candidates - num_candidates))
+            if len(sampled) == 0:
+                break
+            num_candidates += len(sampled)
+            sp_boxes = sampled["box3d_lidar"]
+            sp_boxes_bv = box_np_ops.center_to_corner_box2d(sp_boxes[:, 0:2], sp_boxes[:, 3:5] + offset, sp_boxes[:, -1])
+            placed = occupancy.place(sp_boxes_bv)
+            valid_samples.append(sampled.take(np.asarray(placed, dtype=np.bool_)))
+            num_valid += len(valid_samples[-1])
+            if self.placement_time_budget is not None and time.time() - start_time > self.placement_time_budget:
+                break
+
+        return prep.DbColumns.concatenate(valid_samples)
+
     def sample_class_v3(self, name, num, gt_boxes):
         '''
             This func aims to selected fixed number of gt boxes from gt database with collision test performed.
         '''
 
         # sample num gt_boxes from gt_database
-        sampled_objects = copy.deepcopy(self._sampler_dict[name].sample(num))
-        sampled_boxes = np.stack([i["box3d_lidar"] for i in sampled_objects], axis=0)  # todo: need modification here
+        sampled_objects = self._sampler_dict[name].sample(num)
+        sampled_boxes = sampled_objects["box3d_lidar"]
         all_boxes = np.concatenate([gt_boxes, sampled_boxes], axis=0).copy()
         all_boxes_torch = torch.from_numpy(all_boxes).float()
 
@@ -255,9 +336,9 @@ class DataBaseSamplerV2:
         coll_mat[diag, diag] = False
 
         # get valid samples
-        valid_samples = []
         num_gt = gt_boxes.shape[0]
         num_sampled = len(sampled_objects)
+        valid = np.zeros((num_sampled,), dtype=np.bool_)
         for i in range(num_gt, num_gt + num_sampled):  # todo: without multiple try times, sometimes, the overall box num may not meet the requirement
             if coll_mat[i].any():
                 # i-th sampled box is not considered into auged gt-boxes.
@@ -265,7 +346,7 @@ class DataBaseSamplerV2:
                 coll_mat[:, i] = False
             else:
                 # i-th sampled box is considered into auged gt-boxes.
-                valid_samples.append(sampled_objects[i - num_gt])
+                valid[i - num_gt] = True
 
-        return valid_samples
+        return sampled_objects.take(valid)
 
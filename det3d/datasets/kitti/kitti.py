@@ -1,5 +1,4 @@
 import numpy as np
-import pickle
 import os
 
 import warnings
@@ -9,6 +8,8 @@ from copy import deepcopy
 from det3d.core.bbox import box_np_ops
 from det3d.datasets.custom import PointCloudDataset
 from det3d.datasets.registry import DATASETS
+from det3d.datasets.utils.info_store import InfoStore, load_infos
+from det3d.datasets.utils.sample_cache import load_sample_cache
 
 
 from det3d.datasets.kitti.kitti_common import *
@@ -24,19 +25,30 @@ class KittiDataset(PointCloudDataset):
         super(KittiDataset, self).__init__(root_path, info_path, pipeline, test_mode=test_mode)
         assert self._info_path is not None
         if not hasattr(self, "_kitti_infos"):
-            with open(self._info_path, "rb") as f:
-                infos = pickle.load(f)
-            self._kitti_infos = infos
+            # info_path: kitti_infos_*.pkl, or its memory-mapped info store (see utils/info_store.py).
+            self._kitti_infos = load_infos(self._info_path)
         self._num_point_features = __class__.NumPointFeatures
         # print("remain number of infos:", len(self._kitti_infos))
         self._class_names = class_names
         self.labeled = kwargs.get("labeled", True)
         self.plane_dir = root_path + "/training/planes"   # todo: check whether need it on val or test datasets
 
+        # frame-static values (resolved cloud path & rows, frustum, lidar gt boxes), computed once for all the frames
+        # and stored next to the infos (kitti_infos_*_static/), given to the pipeline as info["static"].
+        self._frame_static = None
+        if kwargs.get("frame_static_cache", False):
+            self._frame_static = load_frame_static_cache(root_path, self._info_path, self._kitti_infos, __class__.NumPointFeatures)
+
+        # deterministic pipelines (val / test): the Reformat output of all the frames, computed once and packed next to
+        # the infos (sample_cache/kitti_infos_*_<pipeline hash>/, see utils/sample_cache.py), read instead of the pipeline.
+        self._sample_cache = None
+        if kwargs.get("sample_cache", False):
+            self._sample_cache = load_sample_cache(self, pipeline, kwargs.get("sample_cache_dir", None),
+                                                   kwargs.get("sample_cache_workers", 8), kwargs.get("sample_cache_compact", False))
+
     def __len__(self):
         if not hasattr(self, "_kitti_infos"):
-            with open(self._info_path, "rb") as f:
-                self._kitti_infos = pickle.load(f)
+            self._kitti_infos = load_infos(self._info_path)
 
         return len(self._kitti_infos)
 
@@ -59,6 +71,12 @@ class KittiDataset(PointCloudDataset):
     def num_point_features(self):
         return self._num_point_features
 
+    @property
+    def image_idxes(self):
+        if isinstance(self._kitti_infos, InfoStore):
+            return self._kitti_infos.image_idxes
+        return [info["image"]["image_idx"] for info in self._kitti_infos]
+
     @property
     def ground_truth_annotations(self):
         if "annos" not in self._kitti_infos[0]:
@@ -71,7 +89,7 @@ class KittiDataset(PointCloudDataset):
     def convert_detection_to_kitti_annos(self, detection, partial=False):
         class_names = self._class_names
         det_image_idxes = [k for k in detection.keys()]
-        gt_image_idxes = [str(info["image"]["image_idx"]) for info in self._kitti_infos]
+        gt_image_idxes = [str(image_idx) for image_idx in self.image_idxes]
         image_idxes = [gt_image_idxes, det_image_idxes]
         # print(f"det_image_idxes: {det_image_idxes[:10]}")
         # print(f"gt_image_idxes: {gt_image_idxes[:10]}")
@@ -167,17 +185,19 @@ class KittiDataset(PointCloudDataset):
         return results, dt_annos
 
     def __getitem__(self, idx):
+        if self._sample_cache is not None:
+            return self._sample_cache[idx]
         return self.get_sensor_data(idx, with_gp=False)
 
     def get_sensor_data(self, idx, with_image=False, with_gp=False, by_index=False):
         # NOTICE: only for debug, eg. idx=000009, switch off in training/test.
         if by_index:
-            indices = []
-            for info in self._kitti_infos:
-                indices.append(int(info['image']['image_idx']))
+            indices = [int(image_idx) for image_idx in self.image_idxes]
             idx = indices.index(idx)
 
         info = self._kitti_infos[idx]
+        if self._frame_static is not None:
+            info = dict(info, static=self._frame_static[idx])
 
         if with_gp:
             gp = self.get_road_plane(idx)
@@ -1,6 +1,9 @@
+import concurrent.futures as futures
+import os
 import pathlib
 import pickle
 import re
+import shutil
 import numpy as np
 
 from collections import OrderedDict
@@ -9,6 +12,8 @@ from skimage import io
 from tqdm import tqdm
 
 from det3d.core.bbox import box_np_ops
+from det3d.datasets.utils.info_store import InfoStore, info_files, is_info_store, save_info_store
+from det3d.datasets.utils.parallel_prep import PrepManifest, content_hash, run_frames
 
 
 def convert_to_kitti_info_version2(info):
@@ -59,40 +64,46 @@ def _read_imageset_file(path):
     return [int(line) for line in lines]
 
 
-def _calculate_num_points_in_gt(data_path, infos, relative_path, remove_outside=True, num_features=4):
+def _num_points_in_gt_frame(data_path, relative_path, remove_outside, num_features, info):
+    pc_info = info["point_cloud"]
+    image_info = info["image"]
+    calib = info["calib"]
+    if relative_path:
+        v_path = str(Path(data_path) / pc_info["velodyne_path"])
+    else:
+        v_path = pc_info["velodyne_path"]
+    points_v = np.fromfile(v_path, dtype=np.float32, count=-1).reshape([-1, num_features])
+    rect = calib["R0_rect"]
+    Trv2c = calib["Tr_velo_to_cam"]
+    P2 = calib["P2"]
+    if remove_outside:
+        points_v = box_np_ops.remove_outside_points(points_v, rect, Trv2c, P2, image_info["image_shape"])
 
-    for info in infos:
-        pc_info = info["point_cloud"]
-        image_info = info["image"]
-        calib = info["calib"]
-        if relative_path:
-            v_path = str(Path(data_path) / pc_info["velodyne_path"])
-        else:
-            v_path = pc_info["velodyne_path"]
-        points_v = np.fromfile(v_path, dtype=np.float32, count=-1).reshape([-1, num_features])
-        rect = calib["R0_rect"]
-        Trv2c = calib["Tr_velo_to_cam"]
-        P2 = calib["P2"]
-        if remove_outside:
-            points_v = box_np_ops.remove_outside_points(points_v, rect, Trv2c, P2, image_info["image_shape"])
-
-        # points_v = points_v[points_v[:, 0] > 0]
-        annos = info["annos"]
-        num_obj = len([n for n in annos["name"] if n != "DontCare"])
-        # annos = kitti.filter_kitti_anno(annos, ['DontCare'])
-        dims = annos["dimensions"][:num_obj]
-        loc = annos["location"][:num_obj]
-        rots = annos["rotation_y"][:num_obj]
-        gt_boxes_camera = np.concatenate([loc, dims, rots[..., np.newaxis]], axis=1)
-        gt_boxes_lidar = box_np_ops.box_camera_to_lidar(gt_boxes_camera, rect, Trv2c)
-        indices = box_np_ops.points_in_rbbox(points_v[:, :3], gt_boxes_lidar)
-        num_points_in_gt = indices.sum(0)
-        num_ignored = len(annos["dimensions"]) - num_obj
-        num_points_in_gt = np.concatenate([num_points_in_gt, -np.ones([num_ignored])])
-        annos["num_points_in_gt"] = num_points_in_gt.astype(np.int32)
-
-
-def create_kitti_info_file(data_path, save_path=None, relative_path=True):
+    # points_v = points_v[points_v[:, 0] > 0]
+    annos = info["annos"]
+    num_obj = len([n for n in annos["name"] if n != "DontCare"])
+    # annos = kitti.filter_kitti_anno(annos, ['DontCare'])
+    dims = annos["dimensions"][:num_obj]
+    loc = annos["location"][:num_obj]
+    rots = annos["rotation_y"][:num_obj]
+    gt_boxes_camera = np.concatenate([loc, dims, rots[..., np.newaxis]], axis=1)
+    gt_boxes_lidar = box_np_ops.box_camera_to_lidar(gt_boxes_camera, rect, Trv2c)
+    indices = box_np_ops.points_in_rbbox(points_v[:, :3], gt_boxes_lidar)
+    num_points_in_gt = indices.sum(0)
+    num_ignored = len(annos["dimensions"]) - num_obj
+    num_points_in_gt = np.concatenate([num_points_in_gt, -np.ones([num_ignored])])
+    return num_points_in_gt.astype(np.int32)
+
+
+def _calculate_num_points_in_gt(data_path, infos, relative_path, remove_outside=True, num_features=4, num_workers=8):
+    # frames in a process pool, see det3d/datasets/utils/parallel_prep.py.
+    num_points = run_frames(_num_points_in_gt_frame, [(info,) for info in infos], shared=(data_path, relative_path, remove_outside, num_features),
+                            num_workers=num_workers, desc="num points in gt")
+    for info, num_points_in_gt in zip(infos, num_points):
+        info["annos"]["num_points_in_gt"] = num_points_in_gt
+
+
+def create_kitti_info_file(data_path, save_path=None, relative_path=True, num_workers=8):
     imageset_folder = Path(__file__).resolve().parent.parent / "ImageSets"
     train_img_ids = _read_imageset_file(str(imageset_folder / "train.txt"))
     val_img_ids = _read_imageset_file(str(imageset_folder / "val.txt"))
@@ -114,7 +125,7 @@ def create_kitti_info_file(data_path, save_path=None, relative_path=True):
         image_ids=train_img_ids,
         relative_path=relative_path,
     )
-    _calculate_num_points_in_gt(data_path, kitti_infos_train, relative_path)
+    _calculate_num_points_in_gt(data_path, kitti_infos_train, relative_path, num_workers=num_workers)
     filename = save_path / "kitti_infos_train.pkl"
     print(f"Kitti info train file is saved to {filename}")
     with open(filename, "wb") as f:
@@ -127,7 +138,7 @@ def create_kitti_info_file(data_path, save_path=None, relative_path=True):
                                            calib=True,
                                            image_ids=val_img_ids,
                                            relative_path=relative_path)
-    _calculate_num_points_in_gt(data_path, kitti_infos_val, relative_path)
+    _calculate_num_points_in_gt(data_path, kitti_infos_val, relative_path, num_workers=num_workers)
     filename = save_path / 'kitti_infos_val.pkl'
     print(f"Kitti info val file is saved to {filename}")
     with open(filename, 'wb') as f:
@@ -151,38 +162,70 @@ def create_kitti_info_file(data_path, save_path=None, relative_path=True):
         pickle.dump(kitti_infos_test, f)
 
 
-def _create_reduced_point_cloud(data_path, info_path, save_path=None, back=False):
+def _reduce_point_cloud_frame(data_path, save_path, back, info, prev_hash):
+    '''
+        Write the points of the frame inside the image (velodyne_reduced/xxxxxx.bin), unless they are unchanged
+        since the run of the manifest. return: save_filename, frame_hash, processed.
+    '''
+    pc_info = info["point_cloud"]
+    image_info = info["image"]
+    calib = info["calib"]
+
+    v_path = pc_info["velodyne_path"]
+    v_path = Path(data_path) / v_path
+    rect = calib["R0_rect"]
+    P2 = calib["P2"]
+    Trv2c = calib["Tr_velo_to_cam"]
+
+    if save_path is None:
+        save_filename = str(v_path.parent.parent / (v_path.parent.stem + "_reduced") / v_path.name)
+    else:
+        save_filename = str(Path(save_path) / v_path.name)
+    if back:
+        save_filename += "_back"
+
+    frame_hash = content_hash(rect, P2, Trv2c, image_info["image_shape"], back, files=[v_path])
+    if frame_hash == prev_hash and Path(save_filename).exists():
+        return save_filename, frame_hash, False
+
+    points_v = np.fromfile(str(v_path), dtype=np.float32, count=-1).reshape([-1, 4])
+    # first remove z < 0 points
+    # keep = points_v[:, -1] > 0
+    # points_v = points_v[keep]
+    # then remove outside.
+    if back:
+        points_v[:, 0] = -points_v[:, 0]
+    points_v = box_np_ops.remove_outside_points(points_v, rect, Trv2c, P2, image_info["image_shape"])
+
+    Path(save_filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(save_filename, "w") as f:
+        points_v.tofile(f)
+    return save_filename, frame_hash, True
+
+
+def _create_reduced_point_cloud(data_path, info_path, save_path=None, back=False, num_workers=8):
+    '''
+        The frames are reduced in a process pool; reduced_point_cloud_manifest.pkl (in save_path, or data_path)
+        records the content hash of the cloud & calib of each reduced file, so that a rerun only redoes the frames
+        which changed.
+    '''
     with open(info_path, "rb") as f:
         kitti_infos = pickle.load(f)
-    for info in tqdm(kitti_infos):
-        pc_info = info["point_cloud"]
-        image_info = info["image"]
-        calib = info["calib"]
 
-        v_path = pc_info["velodyne_path"]
-        v_path = Path(data_path) / v_path
-        points_v = np.fromfile(str(v_path), dtype=np.float32, count=-1).reshape([-1, 4])
-        rect = calib["R0_rect"]
-        P2 = calib["P2"]
-        Trv2c = calib["Tr_velo_to_cam"]
-        # first remove z < 0 points
-        # keep = points_v[:, -1] > 0
-        # points_v = points_v[keep]
-        # then remove outside.
-        if back:
-            points_v[:, 0] = -points_v[:, 0]
-        points_v = box_np_ops.remove_outside_points(points_v, rect, Trv2c, P2, image_info["image_shape"])
+    manifest = PrepManifest(Path(save_path or data_path) / "reduced_point_cloud_manifest.pkl")
+    items = []
+    for info in kitti_infos:
+        key = (str(info["point_cloud"]["velodyne_path"]), back)
+        items.append((info, manifest.hash(key)))
+    results = run_frames(_reduce_point_cloud_frame, items, shared=(data_path, save_path, back), num_workers=num_workers,
+                         desc=f"reduce {Path(info_path).name}")
 
-        if save_path is None:
-            save_filename = (v_path.parent.parent / (v_path.parent.stem + "_reduced") / v_path.name)
-            if back:
-                save_filename += "_back"
-        else:
-            save_filename = str(Path(save_path) / v_path.name)
-            if back:
-                save_filename += "_back"
-        with open(save_filename, "w") as f:
-            points_v.tofile(f)
+    entries = {}
+    for info, (save_filename, frame_hash, processed) in zip(kitti_infos, results):
+        entries[(str(info["point_cloud"]["velodyne_path"]), back)] = (frame_hash, save_filename)
+    manifest.save(entries, update=True)
+    num_processed = sum(processed for _, _, processed in results)
+    print(f"{num_processed} point clouds reduced, {len(results) - num_processed} unchanged since the last run")
 
 
 def create_reduced_point_cloud(
@@ -192,6 +235,7 @@ def create_reduced_point_cloud(
     test_info_path=None,
     save_path=None,
     with_back=False,
+    num_workers=8,
 ):
     if train_info_path is None:
         train_info_path = Path(data_path) / "kitti_infos_train.pkl"
@@ -200,18 +244,121 @@ def create_reduced_point_cloud(
     if test_info_path is None:
         test_info_path = Path(data_path) / "kitti_infos_test.pkl"
 
-    _create_reduced_point_cloud(data_path, train_info_path, save_path)
-    _create_reduced_point_cloud(data_path, val_info_path, save_path)
-    _create_reduced_point_cloud(data_path, test_info_path, save_path)
+    _create_reduced_point_cloud(data_path, train_info_path, save_path, num_workers=num_workers)
+    _create_reduced_point_cloud(data_path, val_info_path, save_path, num_workers=num_workers)
+    _create_reduced_point_cloud(data_path, test_info_path, save_path, num_workers=num_workers)
     if with_back:
-        _create_reduced_point_cloud(data_path, train_info_path, save_path, back=True)
-        _create_reduced_point_cloud(data_path, val_info_path, save_path, back=True)
-        _create_reduced_point_cloud(data_path, test_info_path, save_path, back=True)
+        _create_reduced_point_cloud(data_path, train_info_path, save_path, back=True, num_workers=num_workers)
+        _create_reduced_point_cloud(data_path, val_info_path, save_path, back=True, num_workers=num_workers)
+        _create_reduced_point_cloud(data_path, test_info_path, save_path, back=True, num_workers=num_workers)
 
     def load_annotations(self, ann_file):
         pass
 
 
+def get_gt_boxes_lidar(annos, calib):
+    '''
+        annos: with DontCare removed, gt boxes x,y,z(cam), l, h, w, ry -> x,y,z(velo), w, l, h, ry [N, 7] float32,
+        moved to the real center of the boxes (z_value + h/2).
+    '''
+    locs = annos["location"]   # x, y, z (cam)
+    dims = annos["dimensions"] # l, h, w
+    rots = annos["rotation_y"] # ry in label file, count from neg y-axis (0 degree), clockwise is postive,
+                               # anti-clockwise is negative.
+    gt_boxes = np.concatenate([locs, dims, rots[..., np.newaxis]], axis=1).astype(np.float32)
+    gt_boxes = box_np_ops.box_camera_to_lidar(gt_boxes, calib["R0_rect"], calib["Tr_velo_to_cam"])
+    box_np_ops.change_box3d_center_(gt_boxes, [0.5, 0.5, 0], [0.5, 0.5, 0.5])
+    return gt_boxes
+
+
+def get_reduced_velodyne_path(velodyne_path):
+    velodyne_path = Path(velodyne_path)
+    return velodyne_path.parent.parent / (velodyne_path.parent.stem + "_reduced") / velodyne_path.name
+
+
+def _frame_static_info(data_path, num_features, info):
+    '''
+        The values of a frame which do not depend on the augmentation, for the loading pipelines:
+            point_cloud.velodyne_path: the reduced cloud if it exists, else the raw one (as in the info: relative).
+            point_cloud.num_points: rows of that file, -1 if it is missing.
+            calib.frustum: [1, 6, 4, 3] surfaces of the camera frustum in lidar coord.
+            annos.gt_boxes_lidar: [N, 7] gt boxes in lidar coord, DontCare removed (labeled infos only).
+    '''
+    pc_info = info["point_cloud"]
+    calib = info["calib"]
+    velodyne_path = Path(pc_info["velodyne_path"])
+    file_path = velodyne_path if velodyne_path.is_absolute() else Path(data_path) / velodyne_path
+    if get_reduced_velodyne_path(file_path).exists():
+        velodyne_path, file_path = get_reduced_velodyne_path(velodyne_path), get_reduced_velodyne_path(file_path)
+    num_points = file_path.stat().st_size // (4 * num_features) if file_path.exists() else -1
+
+    static_info = {
+        "image": {"image_idx": info["image"]["image_idx"]},
+        "point_cloud": {"velodyne_path": str(velodyne_path), "num_points": num_points},
+        "calib": {"frustum": box_np_ops.get_valid_frustum(calib["R0_rect"], calib["Tr_velo_to_cam"], calib["P2"], info["image"]["image_shape"])},
+    }
+    if "annos" in info:
+        static_info["annos"] = {"gt_boxes_lidar": get_gt_boxes_lidar(remove_dontcare(info["annos"]), calib)}
+    return static_info
+
+
+def frame_static_cache_path(info_path):
+    # kitti_infos_train.pkl (or its info store kitti_infos_train/) -> kitti_infos_train_static/
+    return str(Path(info_path).parent / (Path(info_path).stem + "_static"))
+
+
+def frame_static_cache_key(data_path, info_path, infos, num_features=4):
+    '''
+        Hash of what the frame-static values depend on: the content of the info file, and the size & mtime of the raw
+        and reduced point cloud of each frame (cheaper than their content, enough to see them recreated).
+    '''
+    if isinstance(infos, InfoStore):
+        velodyne_paths = np.asarray(infos.columns["point_cloud.velodyne_path"]).tolist()
+    else:
+        velodyne_paths = [info["point_cloud"]["velodyne_path"] for info in infos]
+    clouds = []
+    for velodyne_path in velodyne_paths:
+        file_path = Path(velodyne_path) if Path(velodyne_path).is_absolute() else Path(data_path) / velodyne_path
+        for path in [file_path, get_reduced_velodyne_path(file_path)]:
+            stat = path.stat() if path.exists() else None
+            clouds.append((stat.st_size, stat.st_mtime_ns) if stat is not None else None)
+    return content_hash(str(data_path), num_features, clouds, files=info_files(info_path))
+
+
+def create_frame_static_cache(data_path, infos, cache_path, num_features=4, num_workers=8, key=None):
+    '''
+        Precompute the frame-static values of infos (see _frame_static_info) into the info store cache_path, with key
+        (frame_static_cache_key) in its meta.json; return the store, or the list of values when it can not be written.
+    '''
+    static_infos = run_frames(_frame_static_info, [(info,) for info in infos], shared=(data_path, num_features),
+                              num_workers=num_workers, desc="frame static cache")
+    # written aside then renamed: several processes (distributed ranks) may build the same cache.
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    try:
+        save_info_store(static_infos, tmp_path, meta=dict(key=key))
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not is_info_store(cache_path):
+            return static_infos
+    return InfoStore(cache_path)
+
+
+def load_frame_static_cache(data_path, info_path, infos, num_features=4, num_workers=0):
+    '''
+        The frame-static cache of info_path (kitti_infos_*_static/), created if missing, and recreated if its key
+        (frame_static_cache_key) does not match: infos or point clouds changed since it was built.
+    '''
+    cache_path = frame_static_cache_path(info_path)
+    key = frame_static_cache_key(data_path, info_path, infos, num_features)
+    if is_info_store(cache_path):
+        cache = InfoStore(cache_path)
+        if cache.meta.get("key") == key and len(cache) == len(infos):
+            return cache
+        shutil.rmtree(cache_path, ignore_errors=True)
+    return create_frame_static_cache(data_path, infos, cache_path, num_features, num_workers, key)
+
+
 def area(boxes, add1=False):
     """Computes area of boxes.
 
@@ -443,9 +590,9 @@ def get_kitti_image_info(
             add_difficulty_to_annos(info)  # info['diff']: including difficulty level
         return info
 
-    image_infos = []
-    for i in tqdm(image_ids):
-        image_infos.append(map_func(i))
+    # io bound (label, calib & image header reads): threads, in the order of image_ids.
+    with futures.ThreadPoolExecutor(num_worker) as executor:
+        image_infos = list(tqdm(executor.map(map_func, image_ids), total=len(image_ids)))
 
     return image_infos
 
@@ -19,7 +19,6 @@ class Reformat(object):
         meta = res["metadata"]
         points = res["lidar"]["points"]
         voxels = res["lidar"]["voxels"]
-        anchors = res["lidar"]["targets"]["anchors"]
 
         data_bundle = dict(
             metadata=meta,                     # image_prefix/shape/id/num_points_features;
@@ -29,7 +28,6 @@ class Reformat(object):
             num_points=voxels["num_points"],   # record num_points in each voxel;
             num_voxels=voxels["num_voxels"],   # num_voxels in each sample;
             coordinates=voxels["coordinates"], # coor and batch_id of each voxel;
-            anchors=anchors,                   # anchors, only one group
         )
 
         if "points_raw" in res["lidar"].keys():
@@ -39,7 +37,6 @@ class Reformat(object):
             data_bundle["num_points_raw"] = res["lidar"]["voxels_raw"]["num_points"]
             data_bundle["num_voxels_raw"] = res["lidar"]["voxels_raw"]["num_voxels"]
             data_bundle["coordinates_raw"] = res["lidar"]["voxels_raw"]["coordinates"]
-            data_bundle["anchors_raw"] = res["lidar"]["targets_raw"]["anchors"]
 
         if "anchors_mask" in res["lidar"]["targets"].keys():
             anchors_mask = res["lidar"]["targets"]["anchors_mask"]
@@ -63,22 +60,27 @@ class Reformat(object):
             labels = res["lidar"]["targets"].get("labels", None)
             reg_targets = res["lidar"]["targets"].get("reg_targets", None)
             reg_weights = res["lidar"]["targets"].get("reg_weights", None)
+            pos_inds = res["lidar"]["targets"].get("pos_inds", None)                # only for sparse targets
+            pos_reg_targets = res["lidar"]["targets"].get("pos_reg_targets", None)  # only for sparse targets
             positive_gt_id = dict(positive_gt_id=res["lidar"]["targets"].get("positive_gt_id", None))
 
             data_bundle.update(dict(ground_plane=ground_plane)) if ground_plane is not None else None
             data_bundle.update(dict(labels=labels)) if labels is not None else None
             data_bundle.update(dict(reg_targets=reg_targets)) if reg_targets is not None else None
             data_bundle.update(dict(reg_weights=reg_weights)) if reg_weights is not None else None
+            data_bundle.update(dict(pos_inds=pos_inds)) if pos_inds is not None else None
+            data_bundle.update(dict(pos_reg_targets=pos_reg_targets)) if pos_reg_targets is not None else None
             data_bundle.update(dict(positive_gt_id=positive_gt_id)) if positive_gt_id is not None else None
 
             # import ipdb; ipdb.set_trace()
 
-            if "targets_raw" in res["lidar"].keys():
-                data_bundle.update(dict(labels_raw=res["lidar"]["targets_raw"]["labels"]))
-                data_bundle.update(dict(reg_targets_raw=res["lidar"]["targets_raw"]["reg_targets"]))
-                data_bundle.update(dict(reg_weights_raw=res["lidar"]["targets_raw"]["reg_weights"]))
-                data_bundle.update(dict(positive_gt_id_raw={"positive_gt_id": res["lidar"]["targets_raw"]["positive_gt_id"]}))
-                data_bundle.update(dict(transformation=res["lidar"]["transformation"]))
+            # raw targets only exist when the "raw" target branch is enabled in AssignTarget.
+            if "labels" in res["lidar"].get("targets_raw", {}):
+                targets_raw = res["lidar"]["targets_raw"]
+                for key in ["labels", "reg_targets", "reg_weights", "pos_inds", "pos_reg_targets"]:
+                    data_bundle.update({key + "_raw": targets_raw[key]}) if key in targets_raw else None
+                data_bundle.update(dict(positive_gt_id_raw={"positive_gt_id": targets_raw["positive_gt_id"]}))
+            data_bundle.update(dict(transformation=res["lidar"]["transformation"]))
 
         if res["mode"] == "train" and not res['labeled']:
             data_bundle.update(dict(transformation=res["lidar"]["transformation"]))
@@ -75,18 +75,29 @@ class LoadPointCloudFromFile(object):
         res["type"] = self.type
 
         if self.type == "KittiDataset":
-            # get reduced points .bin file path
-            pc_info = info["point_cloud"]
-            velo_path = Path(pc_info["velodyne_path"])
-            if not velo_path.is_absolute():
-                velo_path = (Path(res["metadata"]["image_prefix"]) / pc_info["velodyne_path"])
-
-            velo_reduced_path = (velo_path.parent.parent/ (velo_path.parent.stem + "_reduced") / velo_path.name)
-            if velo_reduced_path.exists():
-                velo_path = velo_reduced_path
+            num_point_features = res["metadata"]["num_point_features"]
+            count = -1
+            if "static" in info:
+                # reduced / raw path resolved and rows counted once, see kitti_common.load_frame_static_cache.
+                pc_info = info["static"]["point_cloud"]
+                velo_path = Path(pc_info["velodyne_path"])
+                if not velo_path.is_absolute():
+                    velo_path = (Path(res["metadata"]["image_prefix"]) / pc_info["velodyne_path"])
+                if pc_info["num_points"] >= 0:
+                    count = pc_info["num_points"] * num_point_features
+            else:
+                # get reduced points .bin file path
+                pc_info = info["point_cloud"]
+                velo_path = Path(pc_info["velodyne_path"])
+                if not velo_path.is_absolute():
+                    velo_path = (Path(res["metadata"]["image_prefix"]) / pc_info["velodyne_path"])
+
+                velo_reduced_path = kitti.get_reduced_velodyne_path(velo_path)
+                if velo_reduced_path.exists():
+                    velo_path = velo_reduced_path
 
             # load points: loaded points are in the image range
-            points = np.fromfile(str(velo_path), dtype=np.float32, count=-1).reshape([-1, res["metadata"]["num_point_features"]])
+            points = np.fromfile(str(velo_path), dtype=np.float32, count=count).reshape([-1, num_point_features])
             res["lidar"]["points"] = points
 
         else:
@@ -116,12 +127,18 @@ class LoadPointCloudAnnotations(object):
         # True
         elif res["type"] == "KittiDataset":
             # only select useful calib matrix
+            # frustum & lidar gt boxes: from the frame-static cache when the dataset has one (read-only, copied).
+            static_info = info.get("static", None)
             calib = info["calib"]
+            if static_info is not None:
+                frustum = np.array(static_info["calib"]["frustum"])
+            else:
+                frustum = box_np_ops.get_valid_frustum(calib["R0_rect"], calib["Tr_velo_to_cam"], calib["P2"], info["image"]["image_shape"])
             calib_dict = {
                 "rect": calib["R0_rect"],
                 "Trv2c": calib["Tr_velo_to_cam"],
                 "P2": calib["P2"],
-                "frustum": box_np_ops.get_valid_frustum(calib["R0_rect"], calib["Tr_velo_to_cam"], calib["P2"], info["image"]["image_shape"]),
+                "frustum": frustum,
             }
             res["calib"] = calib_dict
 
@@ -130,18 +147,13 @@ class LoadPointCloudAnnotations(object):
                 annos = info["annos"]
                 # annos = kitti.remove_dontcare_v2(annos)  # todo: try my remove_dontcare_v2 later
                 annos = kitti.remove_dontcare(annos)
-                locs = annos["location"]   # x, y, z (cam)
-                dims = annos["dimensions"] # l, h, w
-                rots = annos["rotation_y"] # ry in label file, count from neg y-axis (0 degree), clockwise is postive,
-                                           # anti-clockwise is negative.
                 gt_names = annos["name"]
-                gt_boxes = np.concatenate([locs, dims, rots[..., np.newaxis]], axis=1).astype(np.float32)
-                calib = info["calib"]
 
-                # x,y,z(cam), l, h, w, ry -> x,y,z(velo), w, l, h, ry
-                gt_boxes = box_np_ops.box_camera_to_lidar(gt_boxes, calib["R0_rect"], calib["Tr_velo_to_cam"])
-                # real center of gt_boxes_velo: z_value + h/2
-                box_np_ops.change_box3d_center_(gt_boxes, [0.5, 0.5, 0], [0.5, 0.5, 0.5])
+                # x,y,z(cam), l, h, w, ry -> x,y,z(velo), w, l, h, ry, real center of gt_boxes_velo: z_value + h/2
+                if static_info is not None:
+                    gt_boxes = np.array(static_info["annos"]["gt_boxes_lidar"])
+                else:
+                    gt_boxes = kitti.get_gt_boxes_lidar(annos, calib)
 
                 res["lidar"]["annotations"] = {"boxes": gt_boxes, "names": gt_names,}    # without difficulty here
                 if self.enable_difficulty_level:
@@ -1,3 +1,6 @@
+import logging
+from collections import defaultdict
+
 import numpy as np
 import torch
 
@@ -5,6 +8,7 @@ from det3d import torchie
 from det3d.datasets.kitti import kitti_common as kitti
 from det3d.core.evaluation.bbox_overlaps import bbox_overlaps
 from det3d.core.bbox import box_np_ops
+from det3d.core.bbox.point_box_index import PointBoxIndex
 from det3d.core.sampler import preprocess as prep
 from det3d.builder import (
     build_dbsampler,
@@ -14,6 +18,7 @@ from det3d.builder import (
 )
 from det3d.core.input.voxel_generator import VoxelGenerator
 from det3d.core.anchor.target_assigner import TargetAssigner
+from det3d.core.anchor.anchor_cache import get_anchors_dict_by_task
 
 from ..registry import PIPELINES
 import time
@@ -80,6 +85,9 @@ class Preprocess(object):
             _dict_select(gt_dict, selected)
             gt_boxes_mask = np.array([n in self.class_names for n in gt_dict["gt_names"]], dtype=np.bool_)
 
+            # point -> box membership of the sample, built once and updated by the following stages.
+            point_box_index = None
+
             # perform gt-augmentation
             if self.db_sampler:
                 sampled_dict = self.db_sampler.sample_all(
@@ -99,15 +107,24 @@ class Preprocess(object):
                     sampled_points = sampled_dict["points"]
                     sampled_gt_masks = sampled_dict["gt_masks"]  # all 1.
 
+                    num_original_boxes = gt_dict["gt_boxes"].shape[0]
                     gt_dict["gt_names"] = np.concatenate([gt_dict["gt_names"], sampled_gt_names], axis=0)
                     gt_dict["gt_boxes"] = np.concatenate([gt_dict["gt_boxes"], sampled_gt_boxes])
                     gt_boxes_mask = np.concatenate([gt_boxes_mask, sampled_gt_masks], axis=0)
 
+                    point_box_index = PointBoxIndex(points, gt_dict["gt_boxes"])
+
                     # True, remove points in original scene with location occupied by auged gt boxes.
                     if self.remove_points_after_sample:
-                        masks = box_np_ops.points_in_rbbox(points, sampled_gt_boxes)
-                        points = points[np.logical_not(masks.any(-1))]
+                        sampled_box_mask = np.arange(gt_dict["gt_boxes"].shape[0]) >= num_original_boxes
+                        keep = np.logical_not(point_box_index.points_in_boxes(sampled_box_mask))
+                        points = points[keep]
+                        point_box_index.take_points(keep)
                     points = np.concatenate([sampled_points, points], axis=0)  # concat existed points and points in gt-aug boxes
+                    point_box_index.add_points(sampled_points, gt_dict["gt_boxes"], front=True)
+
+            if point_box_index is None:
+                point_box_index = PointBoxIndex(points, gt_dict["gt_boxes"])
 
             # per-object augmentation
             prep.noise_per_object_v4_(
@@ -121,9 +138,11 @@ class Preprocess(object):
                 num_try=100,
                 data_aug_with_context=self.data_aug_with_context,
                 data_aug_random_drop=self.data_aug_random_drop,
+                point_box_index=point_box_index,
             )
 
             _dict_select(gt_dict, gt_boxes_mask)  # get gt_boxes of specific class
+            point_box_index.select_boxes(gt_boxes_mask)
             gt_classes = np.array([self.class_names.index(n) + 1 for n in gt_dict["gt_names"]], dtype=np.int32, )
             gt_dict["gt_classes"] = gt_classes
 
@@ -134,10 +153,12 @@ class Preprocess(object):
                 res["lidar"]["annotations_raw"].update({key: gt_dict[key].copy()})
 
             # with global augmentation
-            gt_dict["gt_boxes"], points, flipped = prep.random_flip_v2(gt_dict["gt_boxes"], points)
-            gt_dict["gt_boxes"], points, noise_rotation = prep.global_rotation_v3(gt_dict["gt_boxes"], points, self.global_rotation_noise)
-            gt_dict["gt_boxes"], points, noise_scale = prep.global_scaling_v3(gt_dict["gt_boxes"], points, *self.global_scaling_noise)
-            res["lidar"]["transformation"] = {"flipped": flipped, "noise_rotation": noise_rotation, "noise_scale": noise_scale}
+            # flip, rotation and scaling composed into one transform (same random draws as random_flip_v2,
+            # global_rotation_v3 and global_scaling_v3).
+            transform = prep.GlobalTransform.sample(self.global_rotation_noise, *self.global_scaling_noise)
+            gt_dict["gt_boxes"], points = transform.apply_(gt_dict["gt_boxes"], points)
+            point_box_index.invalidate_grid()
+            res["lidar"]["transformation"] = transform.to_dict()
             # gt_dict["gt_boxes"], points, noise_trans = prep.global_translate_v2(gt_dict["gt_boxes"], points, [1.0, 1.0, 0.5])
             # res["lidar"]["transformation"].update({"noise_trans": noise_trans})
 
@@ -148,7 +169,9 @@ class Preprocess(object):
                                                  enable_sa_dropout=0.25,
                                                  enable_sa_sparsity=[0.05, 50],
                                                  enable_sa_swap=[0.1, 50],
+                                                 point_box_index=point_box_index,
                                                  )
+            res["lidar"]["point_box_index"] = point_box_index
             # for cyclist & ped
             # points = pa_aug_v2.pyramid_augment_v0(gt_boxes, points,
             #                                       enable_sa_dropout=0.2,  # 0.2
@@ -159,12 +182,13 @@ class Preprocess(object):
         if self.shuffle_points:
             choice = np.random.choice(np.arange(points.shape[0]), points.shape[0], replace=False)
             points = points[choice]
+            if "point_box_index" in res["lidar"]:
+                res["lidar"]["point_box_index"].take_points(choice)
 
         if self.mode == "train" and not res['labeled']:
-            _, points, flipped = prep.random_flip_v2(None, points)
-            _, points, noise_rotation = prep.global_rotation_v3(None, points, self.global_rotation_noise)
-            _, points, noise_scale = prep.global_scaling_v3(None, points, *self.global_scaling_noise)
-            res["lidar"]["transformation"] = {"flipped": flipped, "noise_rotation": noise_rotation, "noise_scale": noise_scale}
+            transform = prep.GlobalTransform.sample(self.global_rotation_noise, *self.global_scaling_noise)
+            _, points = transform.apply_(None, points)
+            res["lidar"]["transformation"] = transform.to_dict()
             # _, points, noise_trans = prep.global_translate_v2(None, points, [1.0, 1.0, 0.5])
             # res["lidar"]["transformation"].update({"noise_trans": noise_trans})
 
@@ -191,6 +215,7 @@ class Voxelization(object):
             voxel_size=self.voxel_size,
             max_num_points=self.max_points_in_voxel,
             max_voxels=self.max_voxel_num,
+            mode=cfg.get("mode", "numba"),  # "numba" or "numpy"
         )
 
     def __call__(self, res, info):
@@ -202,30 +227,20 @@ class Voxelization(object):
             bv_range = pc_range[[0, 1, 3, 4]]  # [  0. , -40. ,  70.4,  40. ],
             mask = prep.filter_gt_box_outside_range(gt_dict["gt_boxes"], bv_range)
             _dict_select(gt_dict, mask)
+            if "point_box_index" in res["lidar"]:
+                res["lidar"]["point_box_index"].select_boxes(mask)
             res["lidar"]["annotations"] = gt_dict
             self.shuffle = True
 
-        points = res["lidar"]["points"]
-        voxels, coordinates, num_points_per_voxel = self.voxel_generator.generate(points)
-        num_voxels = np.array([voxels.shape[0]], dtype=np.int64)
-        res["lidar"]["voxels"] = dict(
-            voxels=voxels,
-            coordinates=coordinates,
-            num_points=num_points_per_voxel,
-            num_voxels=num_voxels,
-            shape=grid_size,
-        )
-
-        # voxelization of raw points without transformation
-        if "points_raw" in res["lidar"].keys():
-            points_raw = res["lidar"]["points_raw"]
-            voxels_raw, coordinates_raw, num_points_per_voxel_raw = self.voxel_generator.generate(points_raw)
-            num_voxels_raw = np.array([voxels_raw.shape[0]], dtype=np.int64)
-            res["lidar"]["voxels_raw"] = dict(
-                voxels=voxels_raw,
-                coordinates=coordinates_raw,
-                num_points=num_points_per_voxel_raw,
-                num_voxels=num_voxels_raw,
+        # points and raw points without transformation (teacher input) are voxelized in one pass.
+        keys = ["points", "points_raw"] if "points_raw" in res["lidar"].keys() else ["points"]
+        voxel_sets = self.voxel_generator.generate_batch([res["lidar"][key] for key in keys])
+        for key, (voxels, coordinates, num_points_per_voxel) in zip(keys, voxel_sets):
+            res["lidar"][key.replace("points", "voxels")] = dict(
+                voxels=voxels,
+                coordinates=coordinates,
+                num_points=num_points_per_voxel,
+                num_voxels=np.array([voxels.shape[0]], dtype=np.int64),
                 shape=grid_size,
             )
 
@@ -280,78 +295,105 @@ class AssignTarget(object):
         # results
         self.target_assigners = target_assigners
         self.out_size_factor = assigner_cfg.out_size_factor  # 8
-        feature_map_size = [1, 200, 176]
-        self.anchor_dicts_by_task = [assigner.generate_anchors_dict(feature_map_size) for assigner in self.target_assigners]
+        feature_map_size = target_assigner_config.get("feature_map_size", [1, 200, 176])
+        # anchors are shared with MultiGroupHead through the anchor cache, not shipped with each sample.
+        self.anchor_dicts_by_task = get_anchors_dict_by_task(target_assigner_config, feature_map_size)
+
+        # target branches to compute: "student" (augmented annotations) and "raw" (annotations_raw, for the teacher).
+        # Reformat and the loss always read the student targets: only the raw branch can be skipped.
+        self.target_branches = assigner_cfg.get("target_branches", ["student", "raw"])
+        assert set(self.target_branches) <= {"student", "raw"}, f"unknown target branches: {self.target_branches}"
+        assert "student" in self.target_branches, f"the student targets are required: {self.target_branches}"
+        self.skipped_branches = [b for b in ["student", "raw"] if b not in self.target_branches]
+
+        # sparse targets: int8 labels and targets of positive anchors only, instead of dense [70400, 7] arrays.
+        self.sparse_targets = assigner_cfg.get("sparse_targets", False)
+
+        # profiling counter of assignment time per sample.
+        self.profile = assigner_cfg.get("profile", False)
+        self.profile_interval = assigner_cfg.get("profile_interval", 500)
+        self._profile_num_samples = 0
+        self._profile_times = defaultdict(float)
+        self.logger = logging.getLogger("AssignTarget")
+
+    def _assign_branch(self, gt_dict):
+        '''
+            Select gt boxes of targeted classes (ry limited in [-pi, pi]) and assign them to anchors.
+        '''
+        gt_mask = np.zeros(gt_dict["gt_classes"].shape, dtype=np.bool_)
+        for target_class_id in self.target_class_ids:
+            gt_mask = np.logical_or(gt_mask, gt_dict["gt_classes"] == target_class_id)
+
+        gt_boxes = gt_dict["gt_boxes"][gt_mask]
+        gt_boxes[:, -1] = box_np_ops.limit_period(gt_boxes[:, -1], offset=0.5, period=np.pi * 2)  # limit ry to [-pi, pi]
+        gt_dict["gt_boxes"] = [gt_boxes]
+        gt_dict["gt_classes"] = [gt_dict["gt_classes"][gt_mask]]
+        gt_dict["gt_names"] = [gt_dict["gt_names"][gt_mask]]
+
+        targets_dict = {}
+        for idx, target_assigner in enumerate(self.target_assigners):
+            targets_dict = target_assigner.assign_v2(
+                self.anchor_dicts_by_task[idx],
+                gt_dict["gt_boxes"][idx],  # (x, y, z, w, l, h, r)
+                anchors_mask=None,
+                gt_classes=gt_dict["gt_classes"][idx],
+                gt_names=gt_dict["gt_names"][idx],
+                enable_similar_type=self.enable_similar_type,
+                sparse=self.sparse_targets,
+            )
+
+        if self.sparse_targets:
+            # scattered to dense [batch_size, 70400, 7] targets on device by MultiGroupHead.
+            targets = {
+                "labels": [targets_dict["labels"]],                # [70400,], int8
+                "pos_inds": [targets_dict["pos_inds"]],            # [num_pos_anchors,]
+                "pos_reg_targets": [targets_dict["bbox_targets"]], # [num_pos_anchors, 7]
+                "positive_gt_id": [targets_dict["positive_gt_id"]],
+            }
+            return gt_dict, targets
+
+        targets = {
+            "labels": [targets_dict["labels"]],
+            "reg_targets": [targets_dict["bbox_targets"]],
+            "reg_weights": [targets_dict["bbox_outside_weights"]],
+            "positive_gt_id": [targets_dict["positive_gt_id"]],
+        }
+        return gt_dict, targets
+
+    def _update_profile(self, branch_times):
+        '''
+            Accumulate assignment time per branch; a skipped branch costs about the same as the student one, so its
+            time is counted as saved.
+        '''
+        self._profile_num_samples += 1
+        for branch, t in branch_times.items():
+            self._profile_times[branch] += t
+        if self._profile_num_samples % self.profile_interval == 0:
+            n = self._profile_num_samples
+            msg = ", ".join(f"{branch}: {t / n * 1000:.2f} ms" for branch, t in self._profile_times.items())
+            saved = self._profile_times["student"] / n * 1000 * len(self.skipped_branches)
+            self.logger.info(f"AssignTarget over {n} samples, per sample {msg}; skipped {self.skipped_branches}, "
+                             f"saved ~{saved:.2f} ms/sample.")
 
     def __call__(self, res, info):
         targets, targets_raw = {}, {}
-        targets["anchors"] = [anchor_dict[self.target_class_names[i]]["anchors"].reshape([-1, 7]) for i, anchor_dict in enumerate(self.anchor_dicts_by_task)]
-        targets_raw["anchors"] = targets["anchors"].copy()
 
         # get gt labels of targeted classes; limit ry range in [-pi, pi].
         if res["mode"] == "train" and res['labeled']:
-            gt_dict = res["lidar"]["annotations"]
-            gt_mask = np.zeros(gt_dict["gt_classes"].shape, dtype=np.bool)
-            for target_class_id in self.target_class_ids:
-                gt_mask = np.logical_or(gt_mask, gt_dict["gt_classes"] == target_class_id)
-
-            gt_boxes = gt_dict["gt_boxes"][gt_mask]
-            gt_boxes[:, -1] = box_np_ops.limit_period(gt_boxes[:, -1], offset=0.5, period=np.pi * 2)  # limit ry to [-pi, pi]
-            gt_dict["gt_boxes"] = [gt_boxes]
-            gt_dict["gt_classes"] = [gt_dict["gt_classes"][gt_mask]]
-            gt_dict["gt_names"] = [gt_dict["gt_names"][gt_mask]]
-            res["lidar"]["annotations"] = gt_dict
-
-            targets_dict = {}
-            for idx, target_assigner in enumerate(self.target_assigners):
-                targets_dict = target_assigner.assign_v2(
-                    self.anchor_dicts_by_task[idx],
-                    gt_dict["gt_boxes"][idx],  # (x, y, z, w, l, h, r)
-                    anchors_mask=None,
-                    gt_classes=gt_dict["gt_classes"][idx],
-                    gt_names=gt_dict["gt_names"][idx],
-                    enable_similar_type=self.enable_similar_type,
-                )
-
-            targets.update({
-                "labels": [targets_dict["labels"]],
-                "reg_targets": [targets_dict["bbox_targets"]],
-                "reg_weights": [targets_dict["bbox_outside_weights"]],
-                "positive_gt_id": [targets_dict["positive_gt_id"]],
-            })
-
-
-            ################# for raw points labels [unused] #######################
-            gt_dict_raw = res["lidar"]["annotations_raw"]
-            gt_mask = np.zeros(gt_dict_raw["gt_classes"].shape, dtype=np.bool)
-            for target_class_id in self.target_class_ids:
-                gt_mask = np.logical_or(gt_mask, gt_dict_raw["gt_classes"] == target_class_id)
-
-            gt_boxes = gt_dict_raw["gt_boxes"][gt_mask]
-            gt_boxes[:, -1] = box_np_ops.limit_period(gt_boxes[:, -1], offset=0.5, period=np.pi * 2)
-            gt_dict_raw["gt_boxes"] = [gt_boxes]
-            gt_dict_raw["gt_classes"] = [gt_dict_raw["gt_classes"][gt_mask]]
-            gt_dict_raw["gt_names"] = [gt_dict_raw["gt_names"][gt_mask]]
-            res["lidar"]["annotations_raw"] = gt_dict_raw
-
-            targets_dict = {}
-            for idx, target_assigner in enumerate(self.target_assigners):
-                targets_dict = target_assigner.assign_v2(
-                    self.anchor_dicts_by_task[idx],
-                    gt_dict_raw["gt_boxes"][idx],
-                    anchors_mask=None,
-                    gt_classes=gt_dict_raw["gt_classes"][idx],
-                    gt_names=gt_dict_raw["gt_names"][idx],
-                    enable_similar_type=self.enable_similar_type,
-                )
-
-            targets_raw.update({
-                "labels": [targets_dict["labels"]],
-                "reg_targets": [targets_dict["bbox_targets"]],
-                "reg_weights": [targets_dict["bbox_outside_weights"]],
-                "positive_gt_id": [targets_dict["positive_gt_id"]],
-            })
-            ######################## end #########################
+            branch_times = {}
+            if "student" in self.target_branches:
+                t = time.time()
+                res["lidar"]["annotations"], targets = self._assign_branch(res["lidar"]["annotations"])
+                branch_times["student"] = time.time() - t
+
+            # targets of raw points (without global augmentation), only used by MultiGroupHead.get_model_ema_loss.
+            if "raw" in self.target_branches:
+                t = time.time()
+                res["lidar"]["annotations_raw"], targets_raw = self._assign_branch(res["lidar"]["annotations_raw"])
+                branch_times["raw"] = time.time() - t
+
+            if self.profile:
+                self._update_profile(branch_times)
 
         res["lidar"]["targets"] = targets
         res["lidar"]["targets_raw"] = targets_raw
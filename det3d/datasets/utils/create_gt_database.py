@@ -7,8 +7,7 @@ from det3d.core import box_np_ops
 from det3d.datasets.dataset_factory import get_dataset
 from det3d.torchie import Config
 
-from joblib import Parallel, delayed
-from tqdm import tqdm
+from det3d.datasets.utils.parallel_prep import PrepManifest, content_hash, run_frames
 
 dataset_name_map = {
     "KITTI": "KittiDataset",
@@ -17,6 +16,152 @@ dataset_name_map = {
 }
 
 
+def _gt_database_frame(dataset, db_path, relative_path, used_classes, gt_aug_with_context, index, prev_hash):
+    '''
+        Points of the gt objects of frame index, written to db_path/{image_idx}_{name}_{i}.bin (relative distance to
+        the box center). return: frame_hash, frame = (image_idx, objects, gt_points) or None when the frame is
+        unchanged since the run of the manifest (same hash, object files still there).
+    '''
+    image_idx = index
+    sensor_data = dataset.get_sensor_data(index)   # see in loading.py after pipelines.
+    if "image_idx" in sensor_data["metadata"]:     # True, image_idx = file_name (000001)
+        image_idx = sensor_data["metadata"]["image_idx"]
+
+    points = sensor_data["lidar"]["points"]
+    annos = sensor_data["lidar"]["annotations"]
+    gt_boxes = annos["boxes"]   # gt_boxes of all classes, dc has been removed in pipeline LoadPointCloudAnnotations.
+    names = annos["names"]      # gt_names.
+
+    if "group_ids" in annos:    # False
+        group_ids = annos["group_ids"]
+    else:
+        group_ids = np.arange(gt_boxes.shape[0], dtype=np.int64)
+
+    difficulty = np.zeros(gt_boxes.shape[0], dtype=np.int32)
+    if "difficulty" in annos:  # False
+        difficulty = annos["difficulty"]
+
+    num_obj = gt_boxes.shape[0]
+    filenames = [f"{image_idx}_{names[i]}_{i}.bin" for i in range(num_obj)]
+    frame_hash = content_hash(image_idx, points, gt_boxes, names, group_ids, difficulty, annos.get("score"),
+                              str(db_path), relative_path, used_classes, gt_aug_with_context)
+    if frame_hash == prev_hash and all((db_path / filename).exists() for filename in filenames):
+        return frame_hash, None
+
+    # todo: maybe we need add some contexual points here.
+    offset = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]   # [x, y, z, w, l, h, ry]
+    if gt_aug_with_context > 0.0:
+        offset = [0.0, 0.0, 0.0, gt_aug_with_context, gt_aug_with_context, 0.0, 0.0]
+
+    point_indices_for_num = box_np_ops.points_in_rbbox(points, gt_boxes)
+    point_indices = box_np_ops.points_in_rbbox(points, gt_boxes + offset)
+    objects, all_gt_points = [], []
+    for i in range(num_obj):   # in a single scene.
+        filepath = db_path / filenames[i]
+        gt_points = points[point_indices[:, i]]
+        gt_points[:, :3] -= gt_boxes[i, :3]  # only record relative distance
+        with open(filepath, "w") as f:       # db: gt points in each gt_box are saved
+            gt_points[:, :4].tofile(f)
+        all_gt_points.append(gt_points[:, :4].astype(np.float32))
+
+        obj = {
+            "name": names[i],
+            "filename": filenames[i],
+            "box3d_lidar": gt_boxes[i],
+            "num_points_in_gt": point_indices_for_num[:, i].sum(),
+            "difficulty": difficulty[i],  # todo: not accurate, all are set as 0.
+            "group_id": group_ids[i],     # local group id, made global in the merge.
+        }
+        if "score" in annos:  # False
+            obj["score"] = annos["score"][i]
+        objects.append(obj)
+
+    return frame_hash, (image_idx, objects, all_gt_points)
+
+
+class _GtDatabaseWriter(object):
+    '''
+        Merges the frames of _gt_database_frame in frame order as they arrive (run_frames callback): their gt points are
+        appended to the packed file (gt_database.bin next to gt_database/) and their objects to the db infos, with the
+        row offset & num of points of each object in the packed file (see DataBaseSamplerV2) and global group ids.
+        Nothing but the db infos and the manifest entries is kept.
+    '''
+
+    def __init__(self, db_path, packed_path, manifest, used_classes, relative_path):
+        self.db_path = db_path
+        self.manifest = manifest
+        self.used_classes = used_classes
+        self.relative_path = relative_path
+        self.packed_file = open(packed_path, "wb")
+        self.packed_offset = 0
+        self.all_db_infos = {}
+        self.group_counter = 0
+        self.entries = {}
+        self.filenames = set()   # object files of the current frames
+        self.num_unchanged = 0
+
+    def __call__(self, result):
+        index = len(self.entries)
+        frame_hash, frame = result
+        if frame is None:   # unchanged: objects from the manifest, points from their .bin files.
+            image_idx, objects = self.manifest.result(index)
+            all_gt_points = [np.fromfile(str(self.db_path / obj["filename"]), dtype=np.float32).reshape(-1, 4) for obj in objects]
+            self.num_unchanged += 1
+        else:
+            image_idx, objects, all_gt_points = frame
+        self.entries[index] = (frame_hash, (image_idx, objects))
+        self.filenames.update(obj["filename"] for obj in objects)
+
+        group_dict = {}
+        for i, (obj, gt_points) in enumerate(zip(objects, all_gt_points)):
+            gt_points.tofile(self.packed_file)
+            gt_packed_offset = self.packed_offset
+            self.packed_offset += gt_points.shape[0]
+
+            name = obj["name"]
+            if (self.used_classes is None) or name in self.used_classes:
+                if self.relative_path:
+                    db_dump_path = str(self.db_path.stem + "/" + obj["filename"])
+                else:
+                    db_dump_path = str(self.db_path / obj["filename"])
+
+                db_info = {
+                    "name": name,
+                    "path": db_dump_path,
+                    "image_idx": image_idx,
+                    "gt_idx": i,
+                    "box3d_lidar": obj["box3d_lidar"],
+                    "num_points_in_gt": obj["num_points_in_gt"],
+                    "difficulty": obj["difficulty"],
+                    "packed_offset": gt_packed_offset,        # row offset in gt_database.bin
+                    "packed_num_points": gt_points.shape[0],  # rows in gt_database.bin
+                }
+                local_group_id = obj["group_id"]
+                if local_group_id not in group_dict:
+                    group_dict[local_group_id] = self.group_counter
+                    self.group_counter += 1
+                db_info["group_id"] = group_dict[local_group_id]  # count from 0 to total_num_of_specific_class[like 13442 for car]
+                if "score" in obj:  # False
+                    db_info["score"] = obj["score"]
+                if name in self.all_db_infos:                 # all_db_infos are grouped by class_names (like car, pedestrian, cyclist, cycle)
+                    self.all_db_infos[name].append(db_info)   # all db infos include info of all db
+                else:
+                    self.all_db_infos[name] = [db_info]
+
+    def close(self):
+        '''
+            Close the packed file, remove the object files of the previous run that no current frame has any more
+            (frames which lost objects, or frames no longer in the infos), and save the manifest.
+        '''
+        self.packed_file.close()
+        for _, (_, objects) in self.manifest.entries.values():
+            for obj in objects:
+                filepath = self.db_path / obj["filename"]
+                if obj["filename"] not in self.filenames and filepath.exists():
+                    filepath.unlink()
+        self.manifest.save(self.entries)
+
+
 def create_groundtruth_database(
     dataset_class_name,
     data_path,
@@ -30,8 +175,14 @@ def create_groundtruth_database(
     bev_only=False,
     coors_range=None,
     gt_aug_with_context=-1.0,
+    num_workers=8,
     **kwargs,
 ):
+    '''
+        The frames are processed in a pool of num_workers processes and merged in frame order as they arrive (same
+        packed offsets & group ids whatever num_workers, see _GtDatabaseWriter), gt_database_manifest.pkl (next to gt_database/) records the content hash
+        of each frame, so that a rerun only redoes the frames which changed.
+    '''
     gt_aug_with_context = gt_aug_with_context
     pipeline = [
         {"type": "LoadPointCloudFromFile", "dataset": dataset_name_map[dataset_class_name],},
@@ -46,84 +197,27 @@ def create_groundtruth_database(
         db_path = root_path / "gt_database"
     if dbinfo_path is None:
         dbinfo_path = root_path / "dbinfos_train.pkl"
+    if gt_aug_with_context > 0.0:
+        db_path = root_path / "gt_enlarged_database"
+        dbinfo_path = root_path / "dbinfos_enlarged_train.pkl"
+    db_path = Path(db_path)
     db_path.mkdir(parents=True, exist_ok=True)
 
-    all_db_infos = {}
-    group_counter = 0
-
-    for index in tqdm(range(len(dataset))):
-        image_idx = index
-        sensor_data = dataset.get_sensor_data(index)   # see in loading.py after pipelines.
-        if "image_idx" in sensor_data["metadata"]:     # True, image_idx = file_name (000001)
-            image_idx = sensor_data["metadata"]["image_idx"]
-
-        points = sensor_data["lidar"]["points"]
-        annos = sensor_data["lidar"]["annotations"]
-        gt_boxes = annos["boxes"]   # gt_boxes of all classes, dc has been removed in pipeline LoadPointCloudAnnotations.
-        names = annos["names"]      # gt_names.
-        group_dict = {}
-        group_ids = np.full([gt_boxes.shape[0]], -1, dtype=np.int64)
-
-        if "group_ids" in annos:    # False
-            group_ids = annos["group_ids"]
-        else:
-            group_ids = np.arange(gt_boxes.shape[0], dtype=np.int64)
-
-        difficulty = np.zeros(gt_boxes.shape[0], dtype=np.int32)
-        if "difficulty" in annos:  # False
-            difficulty = annos["difficulty"]
-
-        num_obj = gt_boxes.shape[0]
-
-        # todo: maybe we need add some contexual points here.
-        offset = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]   # [x, y, z, w, l, h, ry]
-        if gt_aug_with_context > 0.0:
-            offset = [0.0, 0.0, 0.0, gt_aug_with_context, gt_aug_with_context, 0.0, 0.0]
-            db_path = root_path / "gt_enlarged_database"
-            dbinfo_path = root_path / "dbinfos_enlarged_train.pkl"
-            db_path.mkdir(parents=True, exist_ok=True)
-
-        point_indices_for_num = box_np_ops.points_in_rbbox(points, gt_boxes)
-        point_indices = box_np_ops.points_in_rbbox(points, gt_boxes + offset)
-        for i in range(num_obj):   # in a single scene.
-            filename = f"{image_idx}_{names[i]}_{i}.bin"
-            filepath = db_path / filename
-            gt_points = points[point_indices[:, i]]
-            num_points_in_gt = point_indices_for_num[:, i].sum()
-            gt_points[:, :3] -= gt_boxes[i, :3]  # only record relative distance
-            with open(filepath, "w") as f:       # db: gt points in each gt_box are saved
-                gt_points[:, :4].tofile(f)
-
-            if (used_classes is None) or names[i] in used_classes:
-                if relative_path:
-                    db_dump_path = str(db_path.stem + "/" + filename)
-                else:
-                    db_dump_path = str(filepath)
-
-                db_info = {
-                    "name": names[i],
-                    "path": db_dump_path,
-                    "image_idx": image_idx,
-                    "gt_idx": i,
-                    "box3d_lidar": gt_boxes[i],
-                    "num_points_in_gt": num_points_in_gt,
-                    "difficulty": difficulty[i]  # todo: not accurate, all are set as 0.
-                }
-                local_group_id = group_ids[i]
-                if local_group_id not in group_dict:
-                    group_dict[local_group_id] = group_counter
-                    group_counter += 1
-                db_info["group_id"] = group_dict[local_group_id]  # count from 0 to total_num_of_specific_class[like 13442 for car]
-                if "score" in annos:  # False
-                    db_info["score"] = annos["score"][i]
-                if names[i] in all_db_infos:                 # all_db_infos are grouped by class_names (like car, pedestrian, cyclist, cycle)
-                    all_db_infos[names[i]].append(db_info)   # all db infos include info of all db
-                else:
-                    all_db_infos[names[i]] = [db_info]
-
+    manifest = PrepManifest(db_path.parent / (db_path.name + "_manifest.pkl"))
+    items = [(index, manifest.hash(index)) for index in range(len(dataset))]
 
+    # besides the per-object .bin files, all gt points are packed into a single file (gt_database.bin next to
+    # gt_database/), written frame by frame as the results arrive.
+    packed_path = db_path.parent / (db_path.name + ".bin")
+    writer = _GtDatabaseWriter(db_path, packed_path, manifest, used_classes, relative_path)
+    run_frames(_gt_database_frame, items, shared=(dataset, db_path, relative_path, used_classes, gt_aug_with_context),
+               num_workers=num_workers, desc="gt database", callback=writer)
+    writer.close()
+    all_db_infos = writer.all_db_infos
 
     print("dataset length: ", len(dataset))
+    print(f"{len(dataset) - writer.num_unchanged} frames processed, {writer.num_unchanged} unchanged since the last run")
+    print(f"packed {writer.packed_offset} gt points into {packed_path}")
     for k, v in all_db_infos.items():
         print(f"load {len(v)} {k} database infos")
 
@@ -0,0 +1,337 @@
+'''
+    Columnar, memory-mapped info store, replacing the info pickles (kitti_infos_*.pkl & dbinfos_*.pkl).
+
+    The pickles are lists / dicts of nested dicts of small numpy arrays: unpickled in full at startup, and every
+    dataloader worker touches their refcounts, so that copy-on-write duplicates the whole structure in each worker.
+    A store is a directory of .npy columns (one per leaf key, opened with mmap_mode="r") and a meta.json:
+
+        kitti_infos_train/                      # frame infos, InfoStore
+            meta.json                           # kind, num_frames, key paths, class_names
+            image.image_idx.npy                 # [F], one row per frame (scalars, paths, image_shape, calib)
+            calib.P2.npy                        # [F, 4, 4]
+            annos.offsets.npy                   # [F + 1], objects of frame i: rows offsets[i]: offsets[i + 1]
+            annos.location.npy                  # [M, 3], the annos of all the frames concatenated
+            annos.name.npy                      # [M] int32 ids of the names in meta.json class_names
+        dbinfos_train/                          # gt database infos, DbInfoStore
+            meta.json                           # kind, db_classes, key paths, class_names
+            class_offsets.npy                   # [C + 1], objects of db_classes[c]: rows class_offsets[c]: ...
+            box3d_lidar.npy                     # [M, 7], the db infos of all the classes concatenated
+            name.npy, path.npy, ...             # [M]
+
+    store[i] assembles the info of frame i (the nested dict of the pickle) from views of the columns, on demand, so
+    that nothing is kept per frame / per object: python scalars for the per-frame scalars, read-only array views
+    otherwise, the names decoded from their ids.
+
+    python -c "from det3d.datasets.utils.info_store import convert_infos_to_store; \
+               convert_infos_to_store('KITTI/object/kitti_infos_train.pkl', class_names=['Car'])"
+'''
+import json
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+STORE_META = "meta.json"
+STORE_VERSION = 1
+OBJECT_GROUP = "annos"      # per-object arrays of the frame infos, concatenated over the frames.
+NAME_KEYS = ["annos.name", "name"]
+
+
+def is_info_store(path):
+    return os.path.isdir(str(path)) and os.path.exists(os.path.join(str(path), STORE_META))
+
+
+def info_files(info_path):
+    # the files holding the infos of info_path: the .pkl, or all the columns & meta.json of a store.
+    info_path = Path(info_path)
+    return sorted(p for p in info_path.iterdir() if p.is_file()) if info_path.is_dir() else [info_path]
+
+
+def load_infos(info_path):
+    '''
+        Infos of info_path: an InfoStore / DbInfoStore for a store directory, the unpickled infos otherwise.
+    '''
+    if is_info_store(info_path):
+        with open(os.path.join(str(info_path), STORE_META), "r") as f:
+            kind = json.load(f)["kind"]
+        return {"frames": InfoStore, "db": DbInfoStore}[kind](info_path)
+    with open(info_path, "rb") as f:
+        return pickle.load(f)
+
+
+def _flatten(info, prefix=""):
+    # nested dict -> [(key path "calib.P2", value), ...]
+    ret = []
+    for key, value in info.items():
+        assert "." not in key, f"key {key} can not be stored"
+        if isinstance(value, dict):
+            ret += _flatten(value, prefix + key + ".")
+        else:
+            ret.append((prefix + key, value))
+    return ret
+
+
+def _unflatten(items):
+    ret = {}
+    for key_path, value in items:
+        keys = key_path.split(".")
+        node = ret
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return ret
+
+
+def _class_ids(names, class_names):
+    # class_names first (ids = index in the config class_names), then the other names sorted, e.g. DontCare.
+    class_names = list(class_names or [])
+    class_names += sorted(set(str(n) for n in names) - set(class_names))
+    lookup = {n: i for i, n in enumerate(class_names)}
+    ids = np.array([lookup[str(n)] for n in names], dtype=np.int32)
+    return ids, class_names
+
+
+def _concat_rows(arrays):
+    # the empty annos of label files without object are float64 ((0,) for name / occluded): their dtype and trailing
+    # shape are taken from the non-empty ones.
+    arrays = [np.asarray(a) for a in arrays]
+    non_empty = [a for a in arrays if a.shape[0] > 0]
+    if len(non_empty) == 0:
+        return arrays[0]
+    dtype = np.result_type(*non_empty)
+    shape = non_empty[0].shape[1:]
+    return np.concatenate([a if a.shape[0] > 0 else np.zeros((0,) + shape, dtype=dtype) for a in arrays], axis=0).astype(dtype, copy=False)
+
+
+def _save_columns(store_path, columns, meta):
+    os.makedirs(store_path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(store_path, name + ".npy"), np.ascontiguousarray(column), allow_pickle=False)
+    meta = dict(meta, version=STORE_VERSION, columns=sorted(columns.keys()))
+    with open(os.path.join(store_path, STORE_META), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class _ColumnStore(object):
+    '''
+        The columns of a store, memory-mapped on first access: after a fork the workers share the pages of the file
+        (no refcount writes), and a pickled store (spawned workers) reopens its files instead of copying them.
+    '''
+
+    def __init__(self, store_path, kind):
+        self.store_path = str(store_path)
+        with open(os.path.join(self.store_path, STORE_META), "r") as f:
+            self.meta = json.load(f)
+        assert self.meta["kind"] == kind, f"{self.store_path} is a {self.meta['kind']} store, not {kind}"
+        self.class_names = list(self.meta["class_names"])
+        self._names = np.array(self.class_names, dtype=str)
+        self._columns = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"] = None
+        return state
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = {name: np.load(os.path.join(self.store_path, name + ".npy"), mmap_mode="r", allow_pickle=False)
+                             for name in self.meta["columns"]}
+        return self._columns
+
+    def _row(self, key_path, column, idx):
+        value = column[idx]
+        if key_path in NAME_KEYS:
+            return str(self._names[value])
+        return value.item() if np.ndim(value) == 0 else np.asarray(value)
+
+    def _rows(self, key_path, column, start, stop):
+        value = np.asarray(column[start: stop])
+        if key_path in NAME_KEYS:
+            return self._names[value]
+        return value
+
+
+class InfoStore(_ColumnStore):
+    '''
+        Frame infos (kitti_infos_*.pkl) as a read-only sequence: len(store), store[i] -> info dict of frame i.
+    '''
+
+    def __init__(self, store_path):
+        super(InfoStore, self).__init__(store_path, "frames")
+        self.key_paths = self.meta["key_paths"]
+        self.num_frames = self.meta["num_frames"]
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"frame {idx} out of range [0, {len(self)})")
+
+        columns = self.columns
+        items = []
+        if OBJECT_GROUP + ".offsets" in columns:
+            offsets = columns[OBJECT_GROUP + ".offsets"]
+            start, stop = int(offsets[idx]), int(offsets[idx + 1])
+        for key_path in self.key_paths:
+            if key_path.startswith(OBJECT_GROUP + "."):
+                items.append((key_path, self._rows(key_path, columns[key_path], start, stop)))
+            else:
+                items.append((key_path, self._row(key_path, columns[key_path], idx)))
+        return _unflatten(items)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def image_idxes(self):
+        # [F] image_idx of the frames, without assembling the infos.
+        return np.asarray(self.columns["image.image_idx"])
+
+
+class DbInfoStore(_ColumnStore):
+    '''
+        Gt database infos (dbinfos_*.pkl) as a read-only mapping: store["Car"] -> DbInfoColumns, a sequence of the
+        db_info dicts of the class, store["Car"].columns the [N_car, ...] column views.
+    '''
+
+    def __init__(self, store_path):
+        super(DbInfoStore, self).__init__(store_path, "db")
+        self.key_paths = self.meta["key_paths"]
+        self.db_classes = self.meta["db_classes"]
+
+    def __getitem__(self, name):
+        if name not in self.db_classes:
+            raise KeyError(name)
+        c = self.db_classes.index(name)
+        class_offsets = self.columns["class_offsets"]
+        return DbInfoColumns(self, int(class_offsets[c]), int(class_offsets[c + 1]))
+
+    def __contains__(self, name):
+        return name in self.db_classes
+
+    def __len__(self):
+        return len(self.db_classes)
+
+    def __iter__(self):
+        return iter(self.db_classes)
+
+    def keys(self):
+        return list(self.db_classes)
+
+    def values(self):
+        return [self[name] for name in self.db_classes]
+
+    def items(self):
+        return [(name, self[name]) for name in self.db_classes]
+
+
+class DbInfoColumns(object):
+    def __init__(self, store, start, stop):
+        self.store = store
+        self.start = start
+        self.stop = stop
+
+    @property
+    def columns(self):
+        return {key_path: self.store._rows(key_path, self.store.columns[key_path], self.start, self.stop)
+                for key_path in self.store.key_paths}
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"db info {idx} out of range [0, {len(self)})")
+        columns = self.store.columns
+        return {key_path: self.store._row(key_path, columns[key_path], self.start + idx) for key_path in self.store.key_paths}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def save_info_store(infos, store_path, class_names=None, meta=None):
+    '''
+        infos: [info, ...] frame infos (kitti_infos_*.pkl), all with the same keys.
+        meta: extra entries of meta.json (e.g. the key of a cache).
+    '''
+    assert len(infos) > 0
+    flat_infos = [_flatten(info) for info in infos]
+    key_paths = [key_path for key_path, _ in flat_infos[0]]
+    for flat_info in flat_infos:
+        if [key_path for key_path, _ in flat_info] != key_paths:
+            raise ValueError(f"infos with different keys can not be stored: {key_paths} vs {[k for k, _ in flat_info]}")
+
+    columns = {}
+    for k, key_path in enumerate(key_paths):
+        values = [flat_info[k][1] for flat_info in flat_infos]
+        if key_path.startswith(OBJECT_GROUP + "."):
+            if OBJECT_GROUP + ".offsets" not in columns:
+                num_objects = [len(value) for value in values]
+                columns[OBJECT_GROUP + ".offsets"] = np.concatenate([[0], np.cumsum(num_objects)]).astype(np.int64)
+            if key_path in NAME_KEYS:
+                column, class_names = _class_ids(np.concatenate([np.asarray(v, dtype=str) for v in values]), class_names)
+            else:
+                column = _concat_rows(values)
+            assert column.shape[0] == columns[OBJECT_GROUP + ".offsets"][-1], f"{key_path}: not one row per object"
+        else:
+            column = np.stack([np.asarray(value) for value in values], axis=0)
+        assert column.dtype != object, f"{key_path}: object arrays can not be memory-mapped"
+        columns[key_path] = column
+
+    meta = dict(meta or {}, kind="frames", num_frames=len(infos), key_paths=key_paths, class_names=list(class_names or []))
+    _save_columns(str(store_path), columns, meta)
+
+
+def save_db_info_store(db_infos, store_path, class_names=None):
+    '''
+        db_infos: {"Car": [db_info, ...], ...} gt database infos (dbinfos_*.pkl).
+    '''
+    db_classes = [name for name in db_infos.keys() if len(db_infos[name]) > 0]
+    assert len(db_classes) > 0
+    all_db_infos = [db_info for name in db_classes for db_info in db_infos[name]]
+    key_paths = list(all_db_infos[0].keys())
+
+    columns = {}
+    for key_path in key_paths:
+        values = [db_info[key_path] for db_info in all_db_infos]
+        if key_path in NAME_KEYS:
+            column, class_names = _class_ids(values, class_names)
+        else:
+            column = np.stack([np.asarray(value) for value in values], axis=0)
+        assert column.dtype != object, f"{key_path}: object arrays can not be memory-mapped"
+        columns[key_path] = column
+    columns["class_offsets"] = np.concatenate([[0], np.cumsum([len(db_infos[name]) for name in db_classes])]).astype(np.int64)
+
+    meta = dict(kind="db", db_classes=db_classes, key_paths=key_paths, class_names=list(class_names or []))
+    _save_columns(str(store_path), columns, meta)
+
+
+def convert_infos_to_store(info_path, store_path=None, class_names=None):
+    '''
+        Convert an info pickle into a store: kitti_infos_train.pkl -> kitti_infos_train/ (next to the pickle by
+        default), the frame infos (list) to an InfoStore, the gt database infos (dict) to a DbInfoStore.
+    '''
+    info_path = str(info_path)
+    if store_path is None:
+        store_path = os.path.splitext(info_path)[0]
+    with open(info_path, "rb") as f:
+        infos = pickle.load(f)
+    if isinstance(infos, dict):
+        save_db_info_store(infos, store_path, class_names)
+    else:
+        save_info_store(infos, store_path, class_names)
+    print(f"{info_path} is converted to the info store {store_path}")
+    return store_path
@@ -0,0 +1,135 @@
+'''
+    Parallel, incremental dataset preparation (reduced point clouds, num_points_in_gt, gt database).
+
+    The frames are processed by chunks in a process pool and the per-frame results are merged in frame order, so that
+    the outputs do not depend on the number of workers. A manifest keeps the content hash of the inputs of every frame
+    (point cloud, annotations / calib, parameters) with what the merge needs from it: a rerun only redoes the frames
+    whose hash changed or whose output files are missing.
+'''
+import collections
+import concurrent.futures as futures
+import hashlib
+import os
+import pickle
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+MANIFEST_VERSION = 1
+
+
+def _hash_update(h, obj):
+    if isinstance(obj, dict):
+        h.update(b"{%d" % len(obj))
+        for key in sorted(obj.keys(), key=str):
+            h.update(str(key).encode())
+            _hash_update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[%d" % len(obj))
+        for item in obj:
+            _hash_update(h, item)
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        array = np.ascontiguousarray(obj)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    else:
+        h.update(repr(obj).encode())
+
+
+def content_hash(*objs, files=()):
+    '''
+        sha1 of objs (nested dicts / lists of arrays & scalars) and of the bytes of files.
+    '''
+    h = hashlib.sha1()
+    for obj in objs:
+        _hash_update(h, obj)
+    for path in files:
+        with open(str(path), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class PrepManifest(object):
+    '''
+        {key: (frame_hash, result)} of the frames processed by the previous runs, pickled at path. result is what the
+        merge needs again for an unchanged frame (e.g. the db infos of its objects).
+    '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                manifest = pickle.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest["entries"]
+
+    def hash(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def result(self, key):
+        return self.entries[key][1]
+
+    def save(self, entries, update=False):
+        # update: keep the entries of the other keys (several info files sharing one output directory).
+        if update:
+            entries = {**self.entries, **entries}
+        self.entries = entries
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": MANIFEST_VERSION, "entries": entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+_shared = ()   # shared arguments of run_frames, set once per worker process.
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _run_chunk(fn, chunk):
+    return [fn(*_shared, *item) for item in chunk]
+
+
+def _collect(results, chunk_results, callback):
+    results += chunk_results if callback is None else [callback(result) for result in chunk_results]
+
+
+def run_frames(fn, items, shared=(), num_workers=8, chunk_size=16, desc="frames", callback=None):
+    '''
+        [fn(*shared, *item) for item in items], by chunks of chunk_size items in a pool of num_workers processes (in
+        this process for num_workers <= 1); the results are in the order of items. fn must be a module-level function:
+        shared (e.g. the dataset) is given to each worker once when it starts, the items (e.g. frame index, previous
+        hash) are sent with their chunk.
+        callback: called on each result in order, as soon as its chunk is done, and its return value kept instead of
+        the result (e.g. to write large results out instead of holding them all).
+    '''
+    start = time.time()
+    chunks = [items[i: i + chunk_size] for i in range(0, len(items), chunk_size)]
+    results = []
+    with tqdm(total=len(items), desc=desc) as progress:
+        if num_workers <= 1:
+            _init_worker(shared)
+            for chunk in chunks:
+                _collect(results, _run_chunk(fn, chunk), callback)
+                progress.update(len(chunk))
+            _init_worker(())
+        else:
+            with futures.ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(shared,)) as executor:
+                # at most 2 * num_workers chunks in flight, a new chunk submitted only once one is consumed: the
+                # chunks done ahead of a slow one are held in memory until it is done.
+                jobs = collections.deque()
+                for i, chunk in enumerate(chunks):
+                    while len(jobs) < 2 * num_workers and len(jobs) + i < len(chunks):
+                        jobs.append(executor.submit(_run_chunk, fn, chunks[len(jobs) + i]))
+                    _collect(results, jobs.popleft().result(), callback)
+                    progress.update(len(chunk))
+    elapsed = time.time() - start
+    print(f"{desc}: {len(items)} frames in {elapsed:.1f} s ({len(items) / max(elapsed, 1e-6):.1f} frames / s, "
+          f"{max(num_workers, 1)} workers)")
+    return results
@@ -4,10 +4,8 @@ import numba
 import torch
 
 from det3d.core.bbox import box_np_ops
-from det3d.core.bbox.geometry import points_in_convex_polygon_3d_jit
+from det3d.core.bbox.point_box_index import PointBoxIndex
 
-from scipy.spatial import cKDTree
-from ifp import ifp_sample
 import traceback
 
 
@@ -63,25 +61,107 @@ def get_pyramids(gt_boxes):
     return pyramids
 
 
-def points_in_pyramids_mask(points, pyramids):
+def points_pyramid_ids(points, point_ids, box_ids, pyramids):
     '''
-    pyramids: [N', 15]
-    surfaces: [N', 5, 3, 3]
-               N': num of pyramids, '5: num of surfaces per pyramid, 3: num of corners per surface, 3: dim of each corner
+    pyramid (0~5) containing each point of the (point, box) pairs, the points being in the boxes: the face whose
+    direction from the box center has the largest normalized projection, i.e. the largest |x / w|, |y / l|, |z / h| in
+    box-local coordinates.
+    pyramids: [N, 6, 15], point_ids, box_ids: [num_pairs,].
     '''
-    indices = [1, 2, 0, 2, 3, 0, 3, 4, 0, 4, 1, 0, 4, 3, 2]
-    surfaces = np.concatenate([pyramids[:, 3*k : 3*k+3] for k in indices], axis=1).reshape(-1, 5, 3, 3)
-    point_masks = points_in_convex_polygon_3d_jit(points[:, :3], surfaces)
-    return point_masks
+    face_vectors = pyramids[:, :, 3:].reshape(-1, 6, 4, 3).mean(2) - pyramids[:, :, 0:3]  # [N, 6, 3], center -> face center
+    face_vectors = face_vectors / (face_vectors ** 2).sum(-1, keepdims=True)
+    offsets = points[point_ids, 0:3] - pyramids[box_ids, 0, 0:3]  # [num_pairs, 3]
+    return (offsets[:, None, :] * face_vectors[box_ids]).sum(-1).argmax(-1)
+
+
+def box_pyramid_pairs(points, pyramids, boxes, point_box_index):
+    '''
+    the points of the boxes (gathered once by the PointBoxIndex) with their pyramid.
+    boxes: [N,] index in point_box_index of each box of pyramids ([N, 6, 15]).
+    return point_ids (sorted), box_ids (in [0, N)), pyramid_ids: [num_pairs,].
+    '''
+    box_to_pyramids = np.full((point_box_index.num_boxes,), -1, dtype=np.int64)
+    box_to_pyramids[boxes] = np.arange(boxes.shape[0])
+    box_ids = box_to_pyramids[point_box_index.box_ids]
+    valid = box_ids >= 0
+    point_ids, box_ids = point_box_index.point_ids[valid], box_ids[valid]
+    return point_ids, box_ids, points_pyramid_ids(points, point_ids, box_ids, pyramids)
+
+
+def pyramid_point_ids(pairs, box_indices, pyramid_indices):
+    '''
+    point ids (sorted) in each of the pyramids (box_indices[k], pyramid_indices[k]).
+    pairs: from box_pyramid_pairs.
+    '''
+    point_ids, box_ids, pyramid_ids = pairs
+    keys = box_ids * 6 + pyramid_ids
+    order = np.argsort(keys, kind="stable")
+    selected_keys = np.asarray(box_indices) * 6 + np.asarray(pyramid_indices)
+    starts = np.searchsorted(keys[order], selected_keys)
+    ends = np.searchsorted(keys[order], selected_keys, side="right")
+    return [point_ids[order[i:j]] for i, j in zip(starts, ends)]
+
+
+def points_in_pyramids(num_points, pairs, pyramid_mask):
+    # [num_points,] bool, points in any of the selected pyramids (pyramid_mask: [N, 6] bool).
+    point_ids, box_ids, pyramid_ids = pairs
+    ret = np.zeros((num_points,), dtype=np.bool_)
+    ret[point_ids[pyramid_mask[box_ids, pyramid_ids]]] = True
+    return ret
+
+
+@numba.njit
+def farthest_point_sample_batch(points, starts, num_samples):
+    '''
+    farthest point sampling of several groups of points in one call, O(n * num_samples) time and O(n) memory.
+    each group starts from its first point, as ifp_sample on a full knn query (cKDTree(p).query(p, len(p))).
+    points: [M, 3+] points of all the groups concatenated, starts: [num_groups + 1,] start of each group in points.
+    return: [sum(min(n_i, num_samples)),] indices in points of the sampled points, group by group in sampling order.
+    '''
+    num_groups = starts.shape[0] - 1
+    ret_starts = np.zeros((num_groups + 1,), dtype=np.int64)
+    for g in range(num_groups):
+        ret_starts[g + 1] = ret_starts[g] + min(starts[g + 1] - starts[g], num_samples)
+    ret = np.zeros((ret_starts[num_groups],), dtype=np.int64)
+    min_dists = np.full((points.shape[0],), np.inf, dtype=np.float64)
+    for g in range(num_groups):
+        last = starts[g]
+        for k in range(ret_starts[g], ret_starts[g + 1]):
+            ret[k] = last
+            min_dists[last] = -1.0
+            next_point, max_dist = last, -1.0
+            for i in range(starts[g], starts[g + 1]):
+                if min_dists[i] < 0:
+                    continue
+                dist = 0.0
+                for j in range(3):
+                    dist += (np.float64(points[i, j]) - np.float64(points[last, j])) ** 2
+                if dist < min_dists[i]:
+                    min_dists[i] = dist
+                if min_dists[i] > max_dist:
+                    next_point, max_dist = i, min_dists[i]
+            last = next_point
+    return ret
+
 
 def pyramid_augment_v0(gt_boxes, points,
                        enable_sa_dropout=0.1,
                        enable_sa_sparsity=[0.05, 50],
                        enable_sa_swap=[0.05, 50],
+                       point_box_index=None,
                        ):
+    '''
+    the points of each box are gathered once from point_box_index (PointBoxIndex of points & gt_boxes, built here if
+    not given) and assigned to one of its 6 pyramids, the 3 operations then work on these (point, box, pyramid) pairs
+    instead of testing the whole point cloud against the pyramids; point_box_index is updated with the removed /
+    sparsified / swapped points.
+    '''
 
     try:
         pyramids = get_pyramids(gt_boxes)
+        if point_box_index is None:
+            point_box_index = PointBoxIndex(points, gt_boxes)
+        boxes = np.arange(gt_boxes.shape[0])  # boxes of pyramids, in gt_boxes / point_box_index.
         # dropout
         if enable_sa_dropout is not None and gt_boxes.shape[0] > 0:
             drop_prob = enable_sa_dropout
@@ -90,10 +170,12 @@ def pyramid_augment_v0(gt_boxes, points,
             drop_box_mask = np.random.uniform(0, 1, (pyramids.shape[0])) <= drop_prob
 
             drop_pyramid_mask = (np.tile(drop_box_mask, [6, 1]).transpose(1, 0) * drop_pyramid_one_hot) > 0
-            drop_pyramids = pyramids[drop_pyramid_mask]
-            point_masks = points_in_pyramids_mask(points, drop_pyramids)
-            points = points[np.logical_not(point_masks.any(-1))]
+            pairs = box_pyramid_pairs(points, pyramids, boxes, point_box_index)
+            keep = np.logical_not(points_in_pyramids(points.shape[0], pairs, drop_pyramid_mask))
+            points = points[keep]
+            point_box_index.take_points(keep)
             pyramids = pyramids[np.logical_not(drop_box_mask)]
+            boxes = boxes[np.logical_not(drop_box_mask)]
 
         # sparsify
         if enable_sa_sparsity is not None and pyramids.shape[0] > 0:
@@ -103,25 +185,25 @@ def pyramid_augment_v0(gt_boxes, points,
             sparsify_box_mask = np.random.uniform(0, 1, (pyramids.shape[0])) <= sparsity_prob
             sparsify_pyramid_mask = (np.tile(sparsify_box_mask, [6, 1]).transpose(1, 0) * sparsify_pyramid_one_hot) > 0
 
-            point_masks = points_in_pyramids_mask(points, pyramids.reshape(-1, 15))
-            pyramid_points_num = point_masks.sum(0)
+            pairs = box_pyramid_pairs(points, pyramids, boxes, point_box_index)
+            pyramid_points_num = np.bincount(pairs[1] * 6 + pairs[2], minlength=pyramids.shape[0] * 6)
             valid_pyramid_mask = pyramid_points_num > sparsity_num
             sparsify_pyramid_mask = sparsify_pyramid_mask & valid_pyramid_mask.reshape(-1, 6)
-            sparsify_pyramids = pyramids[sparsify_pyramid_mask]
-
-            if sparsify_pyramids.shape[0] > 0:
-                point_masks = points_in_pyramids_mask(points, sparsify_pyramids)
-                remain_points = points[np.logical_not(point_masks.any(-1))]
-                to_sparsify_points = [points[point_masks[:, i]] for i in range(point_masks.shape[1])]
-
-                sparsified_points = []
-                for sample in to_sparsify_points:
-                    dists, indices = cKDTree(sample[:, 0:3]).query(sample[:, 0:3], sample.shape[0])
-                    sampled_indices = ifp_sample(dists, indices, sparsity_num)
-                    sparsified_points.append(sample[sampled_indices])
-                sparsified_points = np.concatenate(sparsified_points, axis=0)
+
+            if sparsify_pyramid_mask.sum() > 0:
+                remain_indices = np.nonzero(np.logical_not(points_in_pyramids(points.shape[0], pairs, sparsify_pyramid_mask)))[0]
+                remain_points = points[remain_indices]
+                to_sparsify_indices = pyramid_point_ids(pairs, *np.nonzero(sparsify_pyramid_mask))
+
+                # farthest point sampling of all the selected pyramids at once.
+                sample_indices = np.concatenate(to_sparsify_indices)
+                starts = np.cumsum([0] + [indices.shape[0] for indices in to_sparsify_indices])
+                sparsified_indices = sample_indices[farthest_point_sample_batch(points[sample_indices], starts, sparsity_num)]
+                sparsified_points = points[sparsified_indices]
                 points = np.concatenate([remain_points, sparsified_points], axis=0)
+                point_box_index.take_points(np.concatenate([remain_indices, sparsified_indices]))
             pyramids = pyramids[np.logical_not(sparsify_box_mask)]
+            boxes = boxes[np.logical_not(sparsify_box_mask)]
 
         # swap partition
         if enable_sa_swap is not None:
@@ -129,8 +211,8 @@ def pyramid_augment_v0(gt_boxes, points,
             swap_pyramid_mask = np.random.uniform(0, 1, (pyramids.shape[0])) <= swap_prob
 
             if swap_pyramid_mask.sum() > 0:
-                point_masks = points_in_pyramids_mask(points, pyramids.reshape(-1, 15))
-                point_nums = point_masks.sum(0).reshape(pyramids.shape[0], -1)  # [N, 6]
+                pairs = box_pyramid_pairs(points, pyramids, boxes, point_box_index)
+                point_nums = np.bincount(pairs[1] * 6 + pairs[2], minlength=pyramids.shape[0] * 6).reshape(-1, 6)  # [N, 6]
                 non_zero_pyramids_mask = point_nums > num_thres  # ingore dropout pyramids or highly occluded pyramids
                 selected_pyramids = non_zero_pyramids_mask * swap_pyramid_mask[:, None]  # selected boxes and all their valid pyramids
 
@@ -152,10 +234,13 @@ def pyramid_augment_v0(gt_boxes, points,
                     swapped_indicies = np.concatenate([swapped_index_i[:, None], index_j[:, None]], axis=1)
                     swapped_pyramids = pyramids[swapped_indicies[:, 0].astype(np.int32), swapped_indicies[:, 1].astype(np.int32)]
 
-                    # concat to_swap&swapped pyramids
-                    swap_pyramids = np.concatenate([to_swap_pyramids, swapped_pyramids], axis=0)
-                    swap_point_masks = points_in_pyramids_mask(points, swap_pyramids)
-                    remain_points = points[np.logical_not(swap_point_masks.any(-1))]
+                    # points of the to_swap & swapped pyramids
+                    swapped_pyramids_mask = np.zeros_like(selected_pyramids_mask)
+                    swapped_pyramids_mask[swapped_indicies[:, 0], swapped_indicies[:, 1]] = True
+                    remain_mask = np.logical_not(points_in_pyramids(points.shape[0], pairs, selected_pyramids_mask | swapped_pyramids_mask))
+                    remain_points = points[remain_mask]
+                    to_swap_point_ids = pyramid_point_ids(pairs, index_i, index_j)
+                    swapped_point_ids = pyramid_point_ids(pairs, swapped_index_i, index_j)
 
                     # swap pyramids
                     points_res = []
@@ -164,8 +249,8 @@ def pyramid_augment_v0(gt_boxes, points,
                         to_swap_pyramid = to_swap_pyramids[i]
                         swapped_pyramid = swapped_pyramids[i]
 
-                        to_swap_points = points[swap_point_masks[:, i]]
-                        swapped_points = points[swap_point_masks[:, i + num_swapped_pyramids]]
+                        to_swap_points = points[to_swap_point_ids[i]]
+                        swapped_points = points[swapped_point_ids[i]]
                         # for intensity transform
                         to_swap_points_intensity_ratio = (to_swap_points[:, -1:] - to_swap_points[:, -1:].min()) / \
                                                          np.clip((to_swap_points[:, -1:].max() - to_swap_points[:, -1:].min()), 1e-6, 1)
@@ -195,6 +280,8 @@ def pyramid_augment_v0(gt_boxes, points,
 
                     points_res = np.concatenate(points_res, axis=0)
                     points = np.concatenate([remain_points, points_res], axis=0)
+                    point_box_index.take_points(remain_mask)
+                    point_box_index.add_points(points_res.astype(np.float32), gt_boxes)
 
         return points.astype(np.float32)
 
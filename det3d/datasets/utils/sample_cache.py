@@ -0,0 +1,244 @@
+'''
+    Sample cache of a deterministic pipeline (val / test): the final Reformat output of every frame (voxels, coordinates,
+    num_points, metadata, calib, annos, ...) is computed once and packed into one file, the later evaluations read the
+    frames back from it instead of loading, voxelizing and assigning them again.
+
+    <cache_dir>/samples.bin: the arrays of all the frames, back to back (aligned on ALIGN bytes). With compact, the
+        voxels are stored without their zero padding ([num_points.sum(), C] instead of [V, max_points, C], ~half the
+        size of the cache) and padded again when read, which costs about as much as the voxelization: off by default.
+    <cache_dir>/index.pkl: {"version", "key", "entries"}, entries[i]: the nested dict of frame i with its arrays replaced
+        by their (dtype, shape, offset) in samples.bin.
+
+    The cache directory is named by the hash of what the samples depend on (pipeline config, dataset arguments, info
+    file content): changing any of them makes a new cache. The point clouds are not hashed: delete the caches after
+    recreating them.
+'''
+import os
+import pickle
+import shutil
+import warnings
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from det3d.datasets.utils.info_store import info_files
+from det3d.datasets.utils.parallel_prep import content_hash, run_frames
+from det3d.torchie.trainer.utils import get_dist_info, synchronize
+
+CACHE_VERSION = 1
+ALIGN = 64
+SAMPLES_FILE = "samples.bin"
+INDEX_FILE = "index.pkl"
+VOXEL_KEYS = [("voxels", "num_points"), ("voxels_raw", "num_points_raw")]
+
+_Array = namedtuple("_Array", ["dtype", "shape", "offset"])
+_PaddedVoxels = namedtuple("_PaddedVoxels", ["points", "max_points"])   # voxels [V, max_points, C] without the padding
+
+
+def pipeline_is_deterministic(pipeline):
+    '''
+        False if a step of the pipeline config is random: Preprocess in train mode (augmentations) or shuffling the
+        points, or a step given as an object instead of a config dict.
+    '''
+    for step in pipeline:
+        if not isinstance(step, dict):
+            return False
+        cfg = step.get("cfg", None)
+        if isinstance(cfg, dict) and (cfg.get("mode", None) == "train" or cfg.get("shuffle_points", False)):
+            return False
+    return True
+
+
+def sample_cache_key(dataset, pipeline):
+    # the info file: kitti_infos_*.pkl or its info store directory (all its columns).
+    params = dict(dataset=type(dataset).__name__, root_path=str(dataset._root_path), test_mode=dataset.test_mode,
+                  labeled=getattr(dataset, "labeled", True), num_point_features=dataset.NumPointFeatures,
+                  version=CACHE_VERSION)
+    return content_hash(params, pipeline, files=info_files(dataset._info_path))
+
+
+def sample_cache_path(info_path, key):
+    # kitti_infos_val.pkl -> sample_cache/kitti_infos_val_<key>/
+    return str(Path(info_path).parent / "sample_cache" / f"{Path(info_path).stem}_{key[:16]}")
+
+
+def _compact_voxels(sample):
+    # voxels [V, T, C] -> points [num_points.sum(), C] if the padding is zeros (else stored as they are).
+    sample = dict(sample)
+    for voxel_key, num_points_key in VOXEL_KEYS:
+        voxels, num_points = sample.get(voxel_key, None), sample.get(num_points_key, None)
+        if not isinstance(voxels, np.ndarray) or voxels.ndim != 3 or not isinstance(num_points, np.ndarray):
+            continue
+        mask = np.arange(voxels.shape[1]) < num_points[:, None]
+        if not np.any(voxels[~mask]):
+            sample[voxel_key] = _PaddedVoxels(voxels[mask], voxels.shape[1])
+    return sample
+
+
+def _pad_voxels(sample):
+    for voxel_key, num_points_key in VOXEL_KEYS:
+        packed = sample.get(voxel_key, None)
+        if isinstance(packed, _PaddedVoxels):
+            num_points, points = sample[num_points_key], packed.points
+            # the points as [C * itemsize] byte rows: one masked copy of whole points.
+            row = np.dtype((np.void, points.shape[-1] * points.dtype.itemsize))
+            voxels = np.zeros((num_points.shape[0], packed.max_points), dtype=row)
+            voxels[np.arange(packed.max_points) < num_points[:, None]] = np.ascontiguousarray(points).view(row).ravel()
+            sample[voxel_key] = voxels.view(points.dtype).reshape(voxels.shape + points.shape[-1:])
+    return sample
+
+
+class SampleCacheWriter(object):
+    '''
+        Appends the samples to <cache_dir>/samples.bin in order, returns the entry of each one; close writes the index.
+    '''
+
+    def __init__(self, cache_dir, key, compact=False):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.compact = compact
+        self.entries = []
+        os.makedirs(cache_dir, exist_ok=True)
+        self._file = open(os.path.join(cache_dir, SAMPLES_FILE), "wb")
+        self._offset = 0
+
+    def _pack(self, obj):
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            obj = np.ascontiguousarray(obj)
+            self._file.write(b"\0" * (-self._offset % ALIGN))
+            self._offset += -self._offset % ALIGN
+            array = _Array(obj.dtype.str, obj.shape, self._offset)
+            self._file.write(obj.tobytes())
+            self._offset += obj.nbytes
+            return array
+        if isinstance(obj, _PaddedVoxels):
+            return _PaddedVoxels(self._pack(obj.points), obj.max_points)
+        if isinstance(obj, dict):
+            return {k: self._pack(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+            return type(obj)(self._pack(v) for v in obj)
+        return obj
+
+    def append(self, sample):
+        entry = self._pack(_compact_voxels(sample) if self.compact else sample)
+        self.entries.append(entry)
+        return len(self.entries) - 1
+
+    def close(self):
+        self._file.close()
+        with open(os.path.join(self.cache_dir, INDEX_FILE), "wb") as f:
+            pickle.dump({"version": CACHE_VERSION, "key": self.key, "entries": self.entries}, f)
+
+
+class SampleCache(object):
+    '''
+        Reads the samples of <cache_dir>: cache[i] is the Reformat output of frame i, with its arrays copied out of the
+        memory-mapped samples.bin (the batch collation & the model may modify them).
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = str(cache_dir)
+        with open(os.path.join(self.cache_dir, INDEX_FILE), "rb") as f:
+            index = pickle.load(f)
+        self.key = index["key"]
+        self.entries = index["entries"]
+        self._data = None
+
+    @staticmethod
+    def is_valid(cache_dir, key):
+        try:
+            with open(os.path.join(str(cache_dir), INDEX_FILE), "rb") as f:
+                index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        return index.get("version") == CACHE_VERSION and index.get("key") == key
+
+    @property
+    def data(self):
+        # opened on first use, in each dataloader worker.
+        if self._data is None:
+            path = os.path.join(self.cache_dir, SAMPLES_FILE)
+            self._data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unpack(self, obj):
+        if isinstance(obj, _Array):
+            dtype = np.dtype(obj.dtype)
+            nbytes = int(np.prod(obj.shape, dtype=np.int64)) * dtype.itemsize
+            return np.array(self.data[obj.offset: obj.offset + nbytes].view(dtype).reshape(obj.shape))
+        if isinstance(obj, _PaddedVoxels):
+            return _PaddedVoxels(self._unpack(obj.points), obj.max_points)
+        if isinstance(obj, dict):
+            return {k: self._unpack(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+            return type(obj)(self._unpack(v) for v in obj)
+        return obj
+
+    def __getitem__(self, idx):
+        return _pad_voxels(self._unpack(self.entries[idx]))
+
+
+def _cache_frame(dataset, idx):
+    return dataset.get_sensor_data(idx)
+
+
+def create_sample_cache(dataset, cache_dir, key, num_workers=8, compact=False):
+    '''
+        Run the pipeline of dataset on all its frames (dataset.get_sensor_data, in num_workers processes) and pack the
+        samples into cache_dir; return the SampleCache.
+    '''
+    # written aside then renamed: several processes (e.g. separate runs) may build the same cache.
+    tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+    writer = SampleCacheWriter(tmp_dir, key, compact)
+    try:
+        run_frames(_cache_frame, [(i,) for i in range(len(dataset))], shared=(dataset,), num_workers=num_workers,
+                   desc="sample cache", callback=writer.append)
+        writer.close()
+    except BaseException:
+        writer.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not SampleCache.is_valid(cache_dir, key):
+            raise
+    return SampleCache(cache_dir)
+
+
+def load_sample_cache(dataset, pipeline, cache_dir=None, num_workers=8, compact=False):
+    '''
+        The sample cache of dataset with the pipeline config, created on first use; None (no cache) if the pipeline is
+        not deterministic. Under distributed training, rank 0 creates the cache and the other ranks wait for it.
+    '''
+    if pipeline is None or not pipeline_is_deterministic(pipeline):
+        warnings.warn("sample_cache: the pipeline is not deterministic (train mode or shuffled points), not cached")
+        return None
+    key = sample_cache_key(dataset, pipeline)
+    cache_dir = sample_cache_path(dataset._info_path, key) if cache_dir is None else os.path.join(str(cache_dir), key[:16])
+    rank, _ = get_dist_info()
+    cache = _open_sample_cache(dataset, cache_dir, key, num_workers, compact) if rank == 0 else None
+    synchronize()
+    if cache is None:
+        cache = _open_sample_cache(dataset, cache_dir, key, num_workers, compact)
+    return cache
+
+
+def _open_sample_cache(dataset, cache_dir, key, num_workers, compact):
+    if SampleCache.is_valid(cache_dir, key):
+        cache = SampleCache(cache_dir)
+        if len(cache) == len(dataset):
+            return cache
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    return create_sample_cache(dataset, cache_dir, key, num_workers, compact)
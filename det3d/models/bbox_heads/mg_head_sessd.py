@@ -14,7 +14,11 @@ from det3d.torchie.trainer import load_checkpoint
 from torch import nn
 from torch.nn import functional as F
 from torch.nn.modules.batchnorm import _BatchNorm
-from det3d.core.iou3d import iou3d_utils
+try:
+    from det3d.core.iou3d import iou3d_utils
+except ImportError:
+    # iou3d_cuda is only needed by the iou targets of the supervised loss: consistency_loss & predict run on cpu.
+    iou3d_utils = None
 from det3d.core.bbox import box_np_ops, box_torch_ops
 
 from .. import builder
@@ -399,6 +403,7 @@ class MultiGroupHead(nn.Module):
                  loss_aux=dict(type="WeightedSoftmaxClassificationLoss", name="direction_classifier",
                                loss_weight=0.2, ),
                  direction_offset=0.0,
+                 target_assigner=None,  # anchor_generators & tasks, shared with AssignTarget to build anchors.
                  name="rpn",
                  logger=None,
                  ):
@@ -480,11 +485,18 @@ class MultiGroupHead(nn.Module):
                                    num_dir=num_dirs[task_id] if self.use_direction_classifier else None,
                                    header=False, ))
 
+        # anchors are built once and kept on device instead of being collated in each batch: [70400, 7] per task.
+        assert target_assigner is not None, "MultiGroupHead needs target_assigner config to build anchors."
+        from det3d.core.anchor.anchor_cache import get_anchors_by_task
+        feature_map_size = target_assigner.get("feature_map_size", [1, 200, 176])
+        for task_id, anchors in enumerate(get_anchors_by_task(target_assigner, feature_map_size)):
+            self.register_buffer(f"anchors_{task_id}", torch.from_numpy(anchors.copy()), persistent=False)
+
         logger.info("Finish MultiGroupHead Initialization")
         post_center_range = [0, -40.0, -5.0, 70.4, 40.0, 5.0]
-        self.post_center_range = torch.tensor(post_center_range, dtype=torch.float).cuda()
-        self.thresh = torch.tensor([0.3], dtype=torch.float).cuda()
-        self.top_labels = torch.zeros([70400], dtype=torch.long, ).cuda()  # [70400]
+        # buffers, on the device of the model (consistency_loss & predict run on cpu too).
+        self.register_buffer("post_center_range", torch.tensor(post_center_range, dtype=torch.float), persistent=False)
+        self.register_buffer("thresh", torch.tensor([0.3], dtype=torch.float), persistent=False)
         self.loss_size_consistency = nn.MSELoss(reduction='mean')
         self.loss_iou_consistency = build_loss(dict(type="WeightedSmoothL1Loss", sigma=3.0, code_weights=None, codewise=True, loss_weight=1.0, ))
         self.loss_score_consistency = build_loss(dict(type="WeightedSmoothL1Loss", sigma=3.0, code_weights=None, codewise=True, loss_weight=1.0, ))
@@ -569,6 +581,29 @@ class MultiGroupHead(nn.Module):
 
         return cls_weights, reg_weights, cared
 
+    def get_targets(self, example, task_id, key_tag=""):
+        '''
+            return: labels [batch_size, 70400] and reg_targets [batch_size, 70400, 7]; sparse targets from AssignTarget
+                    (int8 labels, pos_inds & pos_reg_targets) are scattered to dense ones on device here.
+        '''
+        labels = example["labels" + key_tag][task_id]
+        if "pos_inds" + key_tag not in example:
+            return labels, example["reg_targets" + key_tag][task_id]
+
+        pos_inds = example["pos_inds" + key_tag][task_id].long()  # [num_pos_anchors_in_batch, 2], (batch_id, anchor_id)
+        pos_reg_targets = example["pos_reg_targets" + key_tag][task_id]
+        reg_targets = pos_reg_targets.new_zeros(*labels.shape, pos_reg_targets.shape[-1])
+        reg_targets[pos_inds[:, 0], pos_inds[:, 1]] = pos_reg_targets
+        return labels.int(), reg_targets
+
+    def get_anchors(self, task_id, batch_size=None):
+        '''
+            return: anchors of task, [70400, 7], or expanded to [batch_size, 70400, 7] without copy.
+        '''
+        anchors = getattr(self, f"anchors_{task_id}")
+        if batch_size is None:
+            return anchors
+        return anchors.unsqueeze(0).expand(batch_size, -1, -1)
 
     def nn_distance(self, box1, box2, iou_thres=0.7, return_loss='10'):
         """
@@ -615,89 +650,97 @@ class MultiGroupHead(nn.Module):
         return boxes
 
 
+    def gather_kept(self, keep, tensors):
+        '''
+            pad the kept anchors of each sample to a common length, in anchor order.
+            keep: [batch_size, 70400] bool; tensors: list of [batch_size, 70400, C].
+            return: indices [batch_size, num_kept] of the kept anchors, valid [batch_size, num_kept] (False for the
+                padding) & the gathered tensors, [batch_size, num_kept, C].
+        '''
+        num_kept = int(keep.sum(1).max())
+        # unique keys, the kept anchors first in anchor order, no stable sort needed (torch < 1.9).
+        order = (~keep).long() * keep.shape[1] + torch.arange(keep.shape[1], device=keep.device)
+        indices = torch.argsort(order, dim=1)[:, :num_kept]
+        valid = torch.gather(keep, 1, indices)
+        gathered = [torch.gather(t, 1, indices.unsqueeze(-1).expand(-1, -1, t.shape[-1])) for t in tensors]
+        return indices, valid, gathered
+
+    def nn_distance_batched(self, box1, box2, valid1, valid2, iou_thres=0.7):
+        '''
+            nn_distance on padded batches, box1: [batch_size, N, 7], box2: [batch_size, M, 7], valid1 / valid2: masks of
+            the padding. the bev iou is computed with tensor ops (box_torch_ops.rotate_iou_bev_batched), on cpu too.
+            return: idx1 [batch_size, N] (idx2 [batch_size, M]), the box of box2 (box1) matched with each box of box1
+                (box2), and mask1, mask2, the boxes with a match of iou > iou_thres.
+        '''
+        with torch.no_grad():
+            ans_iou = box_torch_ops.rotate_iou_bev_batched(box1, box2, valid1, valid2)  # [batch_size, N, M]
+        mask1, mask2 = ans_iou.max(2)[0] > iou_thres, ans_iou.max(1)[0] > iou_thres
+        # matched among the boxes of the other set with a match, the first one for ties, as nn_distance.
+        idx1 = torch.where(mask2[:, None, :], ans_iou, torch.full_like(ans_iou, -1)).max(2)[1]
+        idx2 = torch.where(mask1[:, :, None], ans_iou, torch.full_like(ans_iou, -1)).max(1)[1]
+        return idx1, idx2, mask1, mask2
+
     def consistency_loss(self, preds_stu, preds_tea, example):
         '''
-            each prediction of student matched with one prediction of teacher
+            each prediction of student matched with one prediction of teacher, the whole batch at once: the predictions
+            kept by the score threshold are decoded and padded to a common length, valid_stu / valid_tea mask the
+            padding, and the samples without matched predictions add no loss.
         '''
         batch_size = preds_stu[0]['box_preds'].shape[0]
-        # trans, trans_res = example['transformation'][unsupervision_mask], {}
-        # for key in trans[0].keys():
-        #     val_list = [trans[i][key] for i in range(batch_size)]
-        #     trans_res.update({key: np.stack(val_list)})
         batch_trans = example['transformation']
-        batch_gt_dict_raw = example['annos_raw']
         batch_box_preds_stu = preds_stu[0]["box_preds"].view(batch_size, -1, 7)
         batch_cls_preds_stu = preds_stu[0]["cls_preds"].view(batch_size, -1, 1)
-        batch_dir_preds_stu = preds_stu[0]["dir_cls_preds"].view(batch_size, -1, 2)
         batch_iou_preds_stu = preds_stu[0]["iou_preds"].view(batch_size, -1, 1)
         batch_box_preds_tea = preds_tea[0]["box_preds"].view(batch_size, -1, 7)
         batch_cls_preds_tea = preds_tea[0]["cls_preds"].view(batch_size, -1, 1)
-        batch_dir_preds_tea = preds_tea[0]["dir_cls_preds"].view(batch_size, -1, 2)
         batch_iou_preds_tea = preds_tea[0]["iou_preds"].view(batch_size, -1, 1)
-
-        batch_box_loss = torch.tensor([0.], dtype=torch.float32).cuda()
-        batch_cls_loss = torch.tensor([0.], dtype=torch.float32).cuda()
-        batch_iou_loss = torch.tensor([0.], dtype=torch.float32).cuda()
-        batch_dir_loss = torch.tensor([0.], dtype=torch.float32).cuda()
-
-        batch_id = 0
-        for box_preds_stu_offset, cls_preds_stu, dir_preds_stu, iou_preds_stu, \
-            box_preds_tea_offset, cls_preds_tea, dir_preds_tea, iou_preds_tea, trans in \
-                zip(batch_box_preds_stu, batch_cls_preds_stu, batch_dir_preds_stu, batch_iou_preds_stu,
-                    batch_box_preds_tea, batch_cls_preds_tea, batch_dir_preds_tea, batch_iou_preds_tea, batch_trans):
-            batch_id += 1
-            box_preds_stu = self.box_coder.decode_torch(box_preds_stu_offset, example["anchors"][0][0])
-            box_preds_tea = self.box_coder.decode_torch(box_preds_tea_offset, example["anchors"][0][0])
-
-            # filter predicted boxes
-            top_scores_keep_stu = torch.sigmoid(cls_preds_stu).squeeze(-1) >= 0.3  # [70400]
-            top_scores_keep_tea = torch.sigmoid(cls_preds_tea).squeeze(-1) >= 0.3  # [70400]
-            pos_anchors = example['anchors'][0][0][top_scores_keep_tea]
-            mask_stu = (box_preds_stu[:, :3] >= self.post_center_range[:3]).all(1)
-            mask_stu &= (box_preds_stu[:, :3] <= self.post_center_range[3:]).all(1)
-            mask_stu &= top_scores_keep_stu
-            mask_tea = (box_preds_tea[:, :3] >= self.post_center_range[:3]).all(1)
-            mask_tea &= (box_preds_tea[:, :3] <= self.post_center_range[3:]).all(1)
-            mask_tea &= top_scores_keep_tea
-            top_box_preds_stu, top_cls_preds_stu, top_dir_preds_stu, top_iou_preds_stu, \
-            top_box_preds_tea, top_cls_preds_tea, top_dir_preds_tea, top_iou_preds_tea \
-            = box_preds_stu[mask_stu], cls_preds_stu[mask_stu], dir_preds_stu[mask_stu], iou_preds_stu[mask_stu], \
-              box_preds_tea[mask_tea], cls_preds_tea[mask_tea], dir_preds_tea[mask_tea], iou_preds_tea[mask_tea]
-
-            if mask_stu.sum() > 0 and mask_tea.sum() > 0:
-                # transform boxes predicted by teacher with local & global augmentation
-                # top_box_preds_tea = self.per_box_loc_trans(top_box_preds_tea, gt_dict_raw['gt_boxes'][0], trans)
-                top_box_preds_tea[:, 1] = - top_box_preds_tea[:, 1] if trans["flipped"] else top_box_preds_tea[:, 1]
-                top_box_preds_tea[:, -1] = - top_box_preds_tea[:, -1] + np.pi if trans["flipped"] else top_box_preds_tea[:, -1]
-                top_box_preds_tea[:, :3] = box_torch_ops.rotation_points_single_angle(top_box_preds_tea[:, :3], trans["noise_rotation"], axis=2)
-                top_box_preds_tea[:, -1] += trans["noise_rotation"]
-                top_box_preds_tea[:, :-1] *= trans["noise_scale"]
-                # top_box_preds_tea[:, :3] += torch.from_numpy(trans['noise_trans']).float().cuda()
-
-                # center consistency loss
-                box_consistency_loss, idx1, idx2, mask1, mask2 = self.nn_distance(top_box_preds_stu, top_box_preds_tea)
-                if box_consistency_loss is None:
-                    continue
-                batch_box_loss += box_consistency_loss
-
-                # cls_score consistency loss
-                aligned_cls_preds_stu, aligned_cls_preds_tea = top_cls_preds_stu[mask1][idx2], top_cls_preds_tea[mask2][idx1]
-                scores_stu, scores_tea = torch.sigmoid(top_cls_preds_stu[mask1]), torch.sigmoid(aligned_cls_preds_tea)
-                score_consistency_loss = self.loss_score_consistency(scores_stu, scores_tea).mean()
-                batch_cls_loss += score_consistency_loss
-
-                # iou consistency loss
-                aligned_iou_preds_tea = (top_iou_preds_tea[mask2][idx1] + 1) * 0.5
-                top_iou_preds_stu = (top_iou_preds_stu[mask1] + 1) * 0.5
-                iou_consistency_loss = self.loss_iou_consistency(top_iou_preds_stu, aligned_iou_preds_tea).mean()
-                batch_iou_loss += iou_consistency_loss
-
-                # dir consistency loss
-                aligned_dir_preds_tea = top_dir_preds_tea[mask2][idx1]
-                aligned_dir_preds_tea = F.softmax(aligned_dir_preds_tea, dim=-1)
-                top_dir_preds_stu = F.softmax(top_dir_preds_stu[mask1], dim=-1)
-                dir_consistency_loss = self.loss_dir_consistency(top_dir_preds_stu, aligned_dir_preds_tea)
-                batch_dir_loss += dir_consistency_loss
+        batch_anchors = self.get_anchors(0, batch_size)
+
+        # filter predicted boxes by score, then decode the kept ones only.
+        top_scores_keep_stu = torch.sigmoid(batch_cls_preds_stu).squeeze(-1) >= 0.3  # [batch_size, 70400]
+        top_scores_keep_tea = torch.sigmoid(batch_cls_preds_tea).squeeze(-1) >= 0.3  # [batch_size, 70400]
+        _, valid_stu, (box_preds_stu, cls_preds_stu, iou_preds_stu, anchors_stu) = self.gather_kept(
+            top_scores_keep_stu, [batch_box_preds_stu, batch_cls_preds_stu, batch_iou_preds_stu, batch_anchors])
+        _, valid_tea, (box_preds_tea, cls_preds_tea, iou_preds_tea, anchors_tea) = self.gather_kept(
+            top_scores_keep_tea, [batch_box_preds_tea, batch_cls_preds_tea, batch_iou_preds_tea, batch_anchors])
+        if box_preds_stu.shape[1] == 0 or box_preds_tea.shape[1] == 0:  # for unlabeled data (some scenes wo cars)
+            return torch.zeros([1], dtype=torch.float32, device=box_preds_stu.device)
+        box_preds_stu = self.box_coder.decode_torch(box_preds_stu, anchors_stu)
+        box_preds_tea = self.box_coder.decode_torch(box_preds_tea, anchors_tea)
+        valid_stu &= (box_preds_stu[..., :3] >= self.post_center_range[:3]).all(-1)
+        valid_stu &= (box_preds_stu[..., :3] <= self.post_center_range[3:]).all(-1)
+        valid_tea &= (box_preds_tea[..., :3] >= self.post_center_range[:3]).all(-1)
+        valid_tea &= (box_preds_tea[..., :3] <= self.post_center_range[3:]).all(-1)
+
+        # transform boxes predicted by teacher with global augmentation
+        batch_trans = {key: torch.tensor(np.stack([trans[key] for trans in batch_trans]), dtype=torch.float32,
+                                         device=box_preds_tea.device)
+                       for key in ["matrix", "noise_scale", "yaw_sign", "yaw_offset"]}
+        box_preds_tea = box_torch_ops.global_transform_boxes(box_preds_tea, **batch_trans)
+
+        # center consistency loss, each student box w.r.t. its nearest teacher box ('10' of nn_distance).
+        idx1, idx2, mask1, mask2 = self.nn_distance_batched(box_preds_stu, box_preds_tea, valid_stu, valid_tea)
+        num_matched = mask1.sum(1).clamp(min=1).float()  # [batch_size]
+
+        def gather_tea(t):
+            return torch.gather(t, 1, idx1.unsqueeze(-1).expand(-1, -1, t.shape[-1]))
+
+        def masked_mean(loss):
+            return (torch.where(mask1, loss.sum(-1), torch.zeros_like(mask1, dtype=loss.dtype)).sum(1) / num_matched).sum().view(1)
+
+        encoded_box_preds, encoded_reg_targets = add_sin_difference(box_preds_stu, gather_tea(box_preds_tea))
+        batch_box_loss = masked_mean(self.loss_reg(encoded_box_preds, encoded_reg_targets) / 7.)
+
+        # cls_score consistency loss
+        scores_stu, scores_tea = torch.sigmoid(cls_preds_stu), torch.sigmoid(gather_tea(cls_preds_tea))
+        batch_cls_loss = masked_mean(self.loss_score_consistency(scores_stu, scores_tea))
+
+        # iou consistency loss
+        aligned_iou_preds_tea = (gather_tea(iou_preds_tea) + 1) * 0.5
+        top_iou_preds_stu = (iou_preds_stu + 1) * 0.5
+        batch_iou_loss = masked_mean(self.loss_iou_consistency(top_iou_preds_stu, aligned_iou_preds_tea))
+
+        # dir consistency loss, not used.
 
         consistency_loss = (1.0 * batch_box_loss + 1.0 * batch_cls_loss + 1.0 * batch_iou_loss) / batch_size
         return consistency_loss
@@ -706,10 +749,11 @@ class MultiGroupHead(nn.Module):
     def loss(self, example, preds_dicts, preds_ema, **kwargs):
         supervision_mask = example["ssl_labeled"] == 1 if "ssl_labeled" in example.keys() else torch.ones(len(example['metadata'])) == 1
         consistency_loss = self.consistency_loss(preds_dicts, preds_ema, example)
-        loss_ema = self.get_model_ema_loss(example, preds_ema)
+        # teacher losses are only logged, and need targets of the "raw" branch in AssignTarget.
+        loss_ema = self.get_model_ema_loss(example, preds_ema) if "labels_raw" in example else {}
 
-        batch_anchors = example["anchors"][0][supervision_mask]
-        batch_size_device = batch_anchors.shape[0]
+        batch_size_device = int(supervision_mask.sum())
+        batch_anchors = self.get_anchors(0, batch_size_device)
 
         rets = []
         for task_id, preds_dict in enumerate(preds_dicts):
@@ -718,8 +762,7 @@ class MultiGroupHead(nn.Module):
             cls_preds = preds_dict["cls_preds"][supervision_mask]
 
             # get targets and weights.
-            labels = example["labels"][task_id]  # cls_labels: [batch_size, 70400], elem in [-1, 0, 1].
-            reg_targets = example["reg_targets"][task_id]  # reg_labels: [batch_size, 70400, 7].
+            labels, reg_targets = self.get_targets(example, task_id)  # cls_labels: [batch_size, 70400], elem in [-1, 0, 1]; reg_labels: [batch_size, 70400, 7].
             cls_weights, reg_weights, cared = self.prepare_loss_weights(labels, loss_norm=self.loss_norm, dtype=torch.float32, )  # all: [batch_size, 70400]
             cls_targets = labels * cared.type_as(labels)  # filter -1 in labels.
             cls_targets = cls_targets.unsqueeze(-1)  # [batch_size, 70400, 1].
@@ -744,7 +787,7 @@ class MultiGroupHead(nn.Module):
             cls_neg_loss /= self.loss_norm["neg_cls_weight"]
 
             if self.use_direction_classifier:  # True
-                dir_targets = get_direction_target(example["anchors"][task_id][supervision_mask], reg_targets, dir_offset=self.direction_offset, )  # [8, 70400, 2]
+                dir_targets = get_direction_target(self.get_anchors(task_id, batch_size_device), reg_targets, dir_offset=self.direction_offset, )  # [8, 70400, 2]
                 dir_logits = preds_dict["dir_cls_preds"][supervision_mask].view(batch_size_device, -1, 2)  # [8, 70400, 2], WeightedSoftmaxClassificationLoss.
                 weights = (labels > 0).type_as(dir_logits)  # [8, 70400], only for positive anchors.
                 weights /= torch.clamp(weights.sum(-1, keepdim=True), min=1.0)  # [8, 70400], averaged in sample.
@@ -759,8 +802,8 @@ class MultiGroupHead(nn.Module):
             iou_preds = preds_dict["iou_preds"][supervision_mask]
             pos_pred_mask = reg_weights > 0
             iou_pos_preds = iou_preds.view(batch_size, -1, 1)[pos_pred_mask]
-            qboxes = self.box_coder.decode_torch(box_preds[pos_pred_mask], example["anchors"][0][supervision_mask][pos_pred_mask])
-            gboxes = self.box_coder.decode_torch(reg_targets[pos_pred_mask], example["anchors"][0][supervision_mask][pos_pred_mask])
+            qboxes = self.box_coder.decode_torch(box_preds[pos_pred_mask], batch_anchors[pos_pred_mask])
+            gboxes = self.box_coder.decode_torch(reg_targets[pos_pred_mask], batch_anchors[pos_pred_mask])
             iou_weights = reg_weights[pos_pred_mask]
             iou_pos_targets = iou3d_utils.boxes_aligned_iou3d_gpu(qboxes, gboxes).detach()
             iou_pos_targets = 2 * iou_pos_targets - 1
@@ -771,8 +814,8 @@ class MultiGroupHead(nn.Module):
             pos_pred_mask = reg_weights > 0
             if pos_pred_mask.sum() > 0:
                 qboxes = self.box_coder.decode_torch(preds_dict["box_preds"][supervision_mask].view(batch_size, -1, 7)[pos_pred_mask], \
-                                                     example["anchors"][0][supervision_mask][pos_pred_mask])
-                gboxes = self.box_coder.decode_torch(example["reg_targets"][0][pos_pred_mask], example["anchors"][0][supervision_mask][pos_pred_mask])
+                                                     batch_anchors[pos_pred_mask])
+                gboxes = self.box_coder.decode_torch(reg_targets[pos_pred_mask], batch_anchors[pos_pred_mask])
                 weights = reg_weights[pos_pred_mask]
                 ious_loss = self.odiou_3d_loss(gboxes, qboxes, weights, batch_size)
 
@@ -809,8 +852,8 @@ class MultiGroupHead(nn.Module):
 
     def get_model_ema_loss(self, example, preds_dicts):
         supervision_mask = example["ssl_labeled"] == 1 if "ssl_labeled" in example.keys() else torch.ones(len(example['metadata'])) == 1
-        batch_anchors = example["anchors"][0][supervision_mask]
-        batch_size_device = batch_anchors.shape[0]
+        batch_size_device = int(supervision_mask.sum())
+        batch_anchors = self.get_anchors(0, batch_size_device)
 
         rets = []
         for task_id, preds_dict in enumerate(preds_dicts):
@@ -818,8 +861,7 @@ class MultiGroupHead(nn.Module):
             cls_preds = preds_dict["cls_preds"][supervision_mask]
 
             # get targets and weights.
-            labels = example["labels_raw"][task_id]
-            reg_targets = example["reg_targets_raw"][task_id]
+            labels, reg_targets = self.get_targets(example, task_id, key_tag="_raw")
             cls_weights, reg_weights, cared = self.prepare_loss_weights(labels, loss_norm=self.loss_norm, dtype=torch.float32, )
             cls_targets = labels * cared.type_as(labels)
             cls_targets = cls_targets.unsqueeze(-1)
@@ -842,7 +884,7 @@ class MultiGroupHead(nn.Module):
             cls_neg_loss /= self.loss_norm["neg_cls_weight"]
 
             if self.use_direction_classifier:  # True
-                dir_targets = get_direction_target(example["anchors_raw"][task_id][supervision_mask], reg_targets, dir_offset=self.direction_offset, )
+                dir_targets = get_direction_target(self.get_anchors(task_id, batch_size_device), reg_targets, dir_offset=self.direction_offset, )
                 dir_logits = preds_dict["dir_cls_preds"][supervision_mask].view(batch_size_device, -1, 2)
                 weights = (labels > 0).type_as(dir_logits)
                 weights /= torch.clamp(weights.sum(-1, keepdim=True), min=1.0)
@@ -856,8 +898,8 @@ class MultiGroupHead(nn.Module):
             iou_preds = preds_dict["iou_preds"][supervision_mask]
             pos_pred_mask = reg_weights > 0
             iou_pos_preds = iou_preds.view(batch_size, -1, 1)[pos_pred_mask]
-            qboxes = self.box_coder.decode_torch(box_preds[pos_pred_mask], example["anchors_raw"][0][supervision_mask][pos_pred_mask])
-            gboxes = self.box_coder.decode_torch(reg_targets[pos_pred_mask], example["anchors_raw"][0][supervision_mask][pos_pred_mask])
+            qboxes = self.box_coder.decode_torch(box_preds[pos_pred_mask], batch_anchors[pos_pred_mask])
+            gboxes = self.box_coder.decode_torch(reg_targets[pos_pred_mask], batch_anchors[pos_pred_mask])
             iou_weights = reg_weights[pos_pred_mask]
             iou_pos_targets = iou3d_utils.boxes_aligned_iou3d_gpu(qboxes, gboxes).detach()
             iou_pos_targets = 2 * iou_pos_targets - 1
@@ -892,28 +934,25 @@ class MultiGroupHead(nn.Module):
 
     def predict(self, example, preds_dicts, test_cfg, **kwargs):
         batch_valid_frustum = example['calib']['frustum']  # [batch_size, 1, 6, 4, 3]
-        batch_anchors = example["anchors"]
+        batch_size = len(example["metadata"])
+        batch_anchors = [self.get_anchors(task_id, batch_size) for task_id in range(len(self.tasks))]
 
         rets = []
         for task_id, preds_dict in enumerate(preds_dicts):
             meta_list = example["metadata"]  # length: 8
             num_class_with_bg = self.num_classes[task_id]  # 1
-            batch_size = batch_anchors[task_id].shape[0]
-            batch_task_anchors = example["anchors"][task_id].view(batch_size, -1, self.box_n_dim)  # [8, 70400, 7]
             batch_anchors_mask = [None] * batch_size
             batch_cls_preds = preds_dict["cls_preds"].view(batch_size, -1, num_class_with_bg)  # [8, 70400, 1]
             batch_box_preds = preds_dict["box_preds"].view(batch_size, -1, self.box_n_dim)  # [batch_size, 70400, 7]
             batch_iou_preds = preds_dict["iou_preds"].view(batch_size, -1, 1)
-
-            # pred_box(abs_pos):[8, 70400, 7] <- pred_offset: [8, 70400, 7], anchors: [8, 70400, 7]
-            batch_reg_preds = self.box_coder.decode_torch(batch_box_preds[:, :, : self.box_coder.code_size], batch_task_anchors)
             batch_dir_preds = preds_dict["dir_cls_preds"].view(batch_size, -1, 2)  # [8, 200, 176, 4]) -> [8, 70400, 2]
 
+            # box offsets are decoded in get_task_detections, only for the anchors kept by the score threshold.
             rets.append(self.get_task_detections(task_id,
                                                  num_class_with_bg,
                                                  test_cfg,
                                                  batch_cls_preds,
-                                                 batch_reg_preds,
+                                                 batch_box_preds[:, :, : self.box_coder.code_size],
                                                  batch_dir_preds,
                                                  batch_iou_preds,
                                                  batch_anchors,
@@ -942,116 +981,95 @@ class MultiGroupHead(nn.Module):
             ret_list.append(ret)
         return ret_list
 
-    def get_task_detections(self, task_id, num_class_with_bg, test_cfg, batch_cls_preds, batch_reg_preds,
+    def get_task_detections(self, task_id, num_class_with_bg, test_cfg, batch_cls_preds, batch_box_preds,
                             batch_dir_preds=None,
                             batch_iou_preds=None, batch_anchors=None, batch_anchors_mask=None, meta_list=None,
                             batch_valid_frustum=None):
+        '''
+            post-processing of the whole batch on the device of the predictions: score threshold and top-k first,
+            then only the kept anchors are decoded, nms (box_torch_ops.rotate_nms_batched), frustum and range
+            filtering are tensor ops on the padded [batch_size, nms_pre_max_size] candidates.
+            batch_box_preds: [batch_size, 70400, 7], box offsets w.r.t. batch_anchors[task_id].
+        '''
         predictions_dicts = []
         post_center_range = self.post_center_range
-        anchors = batch_anchors[0][0]
 
-        for box_preds, cls_preds, dir_preds, iou_preds, a_mask, meta, valid_frustum in zip(batch_reg_preds,  batch_cls_preds, batch_dir_preds,
-                                                                                          batch_iou_preds, batch_anchors_mask, meta_list, batch_valid_frustum):
-            # get dir labels
+        # get scores from cls_preds
+        total_scores = torch.sigmoid(batch_cls_preds).squeeze(-1)  # [batch_size, 70400]
+
+        # SCORE_THRESHOLD: REMOVE those boxes lower than 0.3.
+        if test_cfg.score_threshold > 0.0:
+            top_scores_keep = total_scores >= self.thresh
+            # Still add IoU rectification in CIA-SSD to SE-SSD due to its minor positive effect.
+            iou_preds = (batch_iou_preds.squeeze(-1) + 1) * 0.5
+            total_scores = total_scores * torch.pow(iou_preds, 4)
+        else:
+            top_scores_keep = torch.ones_like(total_scores, dtype=torch.bool)
+
+        # candidates of NMS: the nms_pre_max_size best kept anchors of each sample, padded, by decreasing score.
+        num_candidates = min(int(top_scores_keep.sum(1).max()), test_cfg.nms.nms_pre_max_size)
+        top_scores, top_indices = torch.topk(torch.where(top_scores_keep, total_scores, torch.full_like(total_scores, -1.0)),
+                                             k=num_candidates, dim=1)  # [batch_size, num_candidates]
+        valid = torch.gather(top_scores_keep, 1, top_indices)
+        anchors = torch.gather(batch_anchors[task_id], 1, top_indices.unsqueeze(-1).expand(-1, -1, self.box_n_dim))
+        box_preds = self.box_coder.decode_torch(
+            torch.gather(batch_box_preds, 1, top_indices.unsqueeze(-1).expand(-1, -1, batch_box_preds.shape[-1])), anchors)
+        top_labels = torch.zeros_like(top_indices)  # one class per task.
+        if self.use_direction_classifier:
+            dir_labels = torch.gather(torch.max(batch_dir_preds, dim=-1)[1], 1, top_indices)
+
+        # REMOVE overlap boxes by bev rotate-nms.
+        nms_type = "rotate_nms"
+        if nms_type == "rotate_nms":      # DEFAULT NMS
+            valid &= box_torch_ops.rotate_nms_batched(box_preds[..., [0, 1, 3, 4, -1]],
+                                                      top_scores,
+                                                      valid,
+                                                      iou_threshold=test_cfg.nms.nms_iou_threshold,
+                                                      post_max_size=test_cfg.nms.nms_post_max_size, )
+
+        # Still add DI-NMS in CIA-SSD to SE-SSD due to its minor positive effect.
+        elif nms_type == 'rotate_weighted_nms':  # DI-NMS
+            # candidates re-ordered as picked, kept ones replaced by the weighted average of their cluster.
+            order, valid, box_preds, top_scores = box_torch_ops.rotate_weighted_nms_batched(
+                box_preds,
+                box_preds[..., [0, 1, 3, 4, -1]],
+                top_scores,
+                torch.gather((batch_iou_preds.squeeze(-1) + 1) * 0.5, 1, top_indices),
+                top_labels,
+                anchors,
+                valid,
+                enable_centerness=True,
+                centerness_pow=2,
+                nms_cnt_thresh=2.6,  # 2.6
+                nms_sigma_dist_interval=(0, 20, 40, 60),
+                nms_sigma_square=(0.0009, 0.009, 0.1, 1),
+                suppressed_thresh=0.3,
+            )
+            top_labels = torch.gather(top_labels, 1, order)
             if self.use_direction_classifier:
-                dir_labels = torch.max(dir_preds, dim=-1)[1]  # [70400]
-
-            # get scores from cls_preds
-            total_scores = torch.sigmoid(cls_preds)  # [70400, 1]
-            top_scores = total_scores.squeeze(-1)  # [70400]
-            top_labels = self.top_labels
-
-            # SCORE_THRESHOLD: REMOVE those boxes lower than 0.3.
-            if test_cfg.score_threshold > 0.0:
-                thresh = self.thresh
-                top_scores_keep = top_scores >= thresh
-                top_scores = top_scores.masked_select(top_scores_keep)
-
-                # Still add IoU rectification in CIA-SSD to SE-SSD due to its minor positive effect.
-                iou_preds = (iou_preds.squeeze() + 1) * 0.5
-                top_scores *= torch.pow(iou_preds.masked_select(top_scores_keep), 4)
-
-            # NMS: obtain remained box_preds & dir_labels & cls_labels after score threshold.
-            if top_scores.shape[0] != 0:
-                if test_cfg.score_threshold > 0.0:
-                    box_preds = box_preds[top_scores_keep]
-                    if self.use_direction_classifier:
-                        dir_labels = dir_labels[top_scores_keep]
-                    top_labels = top_labels[top_scores_keep]
-
-                boxes_for_nms = box_preds[:, [0, 1, 3, 4, -1]]
-
-                # REMOVE overlap boxes by bev rotate-nms.
-                nms_type = "rotate_nms"
-                if nms_type == "rotate_nms":      # DEFAULT NMS
-                    nms_func = box_torch_ops.rotate_nms
-                    selected = nms_func(boxes_for_nms,
-                                        top_scores,
-                                        pre_max_size=test_cfg.nms.nms_pre_max_size,
-                                        post_max_size=test_cfg.nms.nms_post_max_size,
-                                        iou_threshold=test_cfg.nms.nms_iou_threshold, )
-                    box_preds = box_preds[selected]
-                    if self.use_direction_classifier:
-                        dir_labels = dir_labels[selected]
-                    label_preds = top_labels[selected]
-                    scores = top_scores[selected]
-
-                # Still add DI-NMS in CIA-SSD to SE-SSD due to its minor positive effect.
-                elif nms_type == 'rotate_weighted_nms':  # DI-NMS
-                    nms_func = box_torch_ops.rotate_weighted_nms
-                    box_preds, dir_labels, label_preds, scores, selected = nms_func(box_preds,
-                                                                          boxes_for_nms,
-                                                                          dir_labels,
-                                                                          top_labels,
-                                                                          top_scores,
-                                                                          iou_preds[top_scores_keep],
-                                                                          anchors[top_scores_keep],
-                                                                          pre_max_size=test_cfg.nms.nms_pre_max_size,
-                                                                          post_max_size=test_cfg.nms.nms_post_max_size,
-                                                                          iou_threshold=test_cfg.nms.nms_iou_threshold,
-                                                                          enable_centerness=True,
-                                                                          centerness_pow=2,
-                                                                          nms_cnt_thresh=2.6,  # 2.6
-                                                                          nms_sigma_dist_interval=(0, 20, 40, 60),
-                                                                          nms_sigma_square=(0.0009, 0.009, 0.1, 1),
-                                                                          suppressed_thresh=0.3,
-                                                                          )
-                else:
-                    raise NotImplementedError
-            else:
-                box_preds = torch.zeros([0, 7], dtype=float)
-
-            if box_preds.shape[0] > 0:
-                from det3d.core.bbox.geometry import points_in_convex_polygon_3d_jit
-                indices = points_in_convex_polygon_3d_jit(box_preds[:, :3].cpu().numpy(), valid_frustum.cpu().numpy())
-                box_preds = box_preds[indices.reshape([-1])]
-                dir_labels = dir_labels[indices.reshape([-1])]
-                label_preds = label_preds[indices.reshape([-1])]
-                scores = scores[indices.reshape([-1])]
-
-            # POST-PROCESSING of predictions.
-            if box_preds.shape[0] != 0:
-                # move pred boxes direction by pi, eg. pred_ry < 0 while pred_dir_label > 0.
-                if self.use_direction_classifier:
-                    opp_labels = ((box_preds[..., -1] - self.direction_offset) > 0) ^ (dir_labels.byte() == 1)
-                    box_preds[..., -1] += torch.where(opp_labels, torch.tensor(np.pi).type_as(box_preds), torch.tensor(0.0).type_as(box_preds), )  # useful for dir accuracy, but has no impact on localization
-
-                # remove pred boxes out of POST_VALID_RANGE
-                mask = (box_preds[:, :3] >= post_center_range[:3]).all(1)
-                mask &= (box_preds[:, :3] <= post_center_range[3:]).all(1)
-                predictions_dict = {"box3d_lidar": box_preds[mask],
-                                    "scores": scores[mask],
-                                    "label_preds": label_preds[mask],
-                                    "metadata": meta, }
-            else:
-                dtype = batch_reg_preds.dtype
-                device = batch_reg_preds.device
-                predictions_dict = {
-                    "box3d_lidar": torch.zeros([0, self.box_n_dim], dtype=dtype, device=device),
-                    "scores": torch.zeros([0], dtype=dtype, device=device),
-                    "label_preds": torch.zeros([0], dtype=top_labels.dtype, device=device),
-                    "metadata": meta,
-                }
+                dir_labels = torch.gather(dir_labels, 1, order)
+        else:
+            raise NotImplementedError
+
+        # remove pred boxes out of the camera frustum.
+        valid &= box_torch_ops.points_in_convex_polygon_3d(box_preds[..., :3], batch_valid_frustum).squeeze(-1)
+
+        # POST-PROCESSING of predictions.
+        # move pred boxes direction by pi, eg. pred_ry < 0 while pred_dir_label > 0.
+        if self.use_direction_classifier:
+            opp_labels = ((box_preds[..., -1] - self.direction_offset) > 0) ^ (dir_labels.byte() == 1)
+            box_preds[..., -1] += torch.where(opp_labels, torch.tensor(np.pi).type_as(box_preds), torch.tensor(0.0).type_as(box_preds), )  # useful for dir accuracy, but has no impact on localization
+
+        # remove pred boxes out of POST_VALID_RANGE
+        valid &= (box_preds[..., :3] >= post_center_range[:3]).all(-1)
+        valid &= (box_preds[..., :3] <= post_center_range[3:]).all(-1)
+
+        for sample_box_preds, sample_scores, sample_labels, sample_valid, meta in zip(box_preds, top_scores, top_labels,
+                                                                                    valid, meta_list):
+            predictions_dict = {"box3d_lidar": sample_box_preds[sample_valid],
+                                "scores": sample_scores[sample_valid],
+                                "label_preds": sample_labels[sample_valid],
+                                "metadata": meta, }
             predictions_dicts.append(predictions_dict)
 
         return predictions_dicts
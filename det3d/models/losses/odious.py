@@ -834,13 +834,121 @@ class align_inter_aligned(nn.Module):
         return inter_area_xoz, mbr_area_xoz, inter_area_xoy, mbr_area_xoy, inter_area_yoz, mbr_area_yoz
 
 
+def rinter_area_batched(corners_gboxes, corners_qboxes):
+    '''
+        Batched version of rinter_area_compute: the intersection area of N pairs of rotated rectangles, without python
+        loops and on the device of the inputs, differentiable by autograd (same gradients as the Functions above).
+        corners_gboxes / corners_qboxes: [N, 8], corners from rbbox_to_corners.
+        Return: [N,], the intersection areas.
+    '''
+    N = corners_gboxes.shape[0]
+    pts_g = corners_gboxes.view(N, 4, 2)
+    pts_q = corners_qboxes.view(N, 4, 2)
+
+    def inside(pts, rect):
+        # pts: [N, 4, 2] inside rect [N, 4, 2] (edges ab & ad), boundary included.
+        ab = (rect[:, 1] - rect[:, 0]).unsqueeze(1)
+        ad = (rect[:, 3] - rect[:, 0]).unsqueeze(1)
+        ap = pts - rect[:, 0:1]
+        abab = (ab * ab).sum(-1)
+        abap = (ab * ap).sum(-1)
+        adad = (ad * ad).sum(-1)
+        adap = (ad * ap).sum(-1)
+        return (abab >= abap) & (abap >= 0) & (adad >= adap) & (adap >= 0)  # [N, 4]
+
+    # step 1 & 2: corners of one box inside the other one.
+    flags_gboxes = inside(pts_g, pts_q)
+    flags_qboxes = inside(pts_q, pts_g)
+
+    # step 3: intersections of all the 4x4 edges, edge i (A -> B) of gboxes and edge j (C -> D) of qboxes.
+    A = pts_g.unsqueeze(2)                          # [N, 4, 1, 2]
+    B = pts_g[:, [1, 2, 3, 0]].unsqueeze(2)
+    C = pts_q.unsqueeze(1)                          # [N, 1, 4, 2]
+    D = pts_q[:, [1, 2, 3, 0]].unsqueeze(1)
+    BA0, BA1 = B[..., 0] - A[..., 0], B[..., 1] - A[..., 1]  # [N, 4, 1]
+    CA0, CA1 = C[..., 0] - A[..., 0], C[..., 1] - A[..., 1]  # [N, 4, 4]
+    DA0, DA1 = D[..., 0] - A[..., 0], D[..., 1] - A[..., 1]
+    acd = DA1 * CA0 > CA1 * DA0
+    bcd = (D[..., 1] - B[..., 1]) * (C[..., 0] - B[..., 0]) > (C[..., 1] - B[..., 1]) * (D[..., 0] - B[..., 0])
+    abc = CA1 * BA0 > BA1 * CA0
+    abd = DA1 * BA0 > BA1 * DA0
+    flags_inters = (acd != bcd) & (abc != abd)      # [N, 4, 4]
+
+    DC0, DC1 = D[..., 0] - C[..., 0], D[..., 1] - C[..., 1]  # [N, 1, 4]
+    ABBA = A[..., 0] * B[..., 1] - B[..., 0] * A[..., 1]     # [N, 4, 1]
+    CDDC = C[..., 0] * D[..., 1] - D[..., 0] * C[..., 1]     # [N, 1, 4]
+    DH = BA1 * DC0 - BA0 * DC1
+    DH = torch.where(flags_inters, DH, torch.ones_like(DH))  # no division by zero for the parallel edges.
+    inters = torch.stack(((ABBA * DC0 - BA0 * CDDC) / DH, (ABBA * DC1 - BA1 * CDDC) / DH), -1)
+
+    # same order as compute_vertex, which keeps at most 8 points.
+    int_pts = torch.cat((pts_g, pts_q, inters.view(N, 16, 2)), 1)  # [N, 24, 2]
+    valid = torch.cat((flags_gboxes, flags_qboxes, flags_inters.view(N, 16)), 1)
+    valid = valid & (torch.cumsum(valid.int(), 1) <= 8)
+    num_of_inter = valid.sum(1)  # [N,]
+
+    # sort_vertex: angles around the center with descending order, the unused points at the end.
+    valid_f = valid.type_as(int_pts).unsqueeze(-1)
+    center = (int_pts * valid_f).sum(1, keepdim=True) / torch.clamp(num_of_inter, min=1).view(N, 1, 1).type_as(int_pts)
+    v = (int_pts - center).detach()
+    angle = torch.atan2(v[..., 1], v[..., 0])
+    angle = torch.where(angle < 0, angle + 2 * 3.1415926, angle)
+    angle = torch.where(valid, angle, torch.full_like(angle, -1.0))
+    sorted_index = torch.argsort(angle, dim=1, descending=True)
+    sorted_pts = torch.gather(int_pts, 1, sorted_index.unsqueeze(-1).expand(-1, -1, 2))[:, :8]  # [N, 8, 2]
+
+    # area_polygon: fan of triangles (p0, p_i, p_i+1), i in [1, num_of_inter - 2].
+    p1 = sorted_pts[:, 0:1]
+    p2 = sorted_pts[:, 1:7]
+    p3 = sorted_pts[:, 2:8]
+    tri = torch.abs((p1[..., 0] - p3[..., 0]) * (p2[..., 1] - p3[..., 1]) - (p1[..., 1] - p3[..., 1]) * (p2[..., 0] - p3[..., 0])) / 2.0
+    tri_mask = torch.arange(2, 8, device=int_pts.device).unsqueeze(0) < num_of_inter.unsqueeze(1)  # [N, 6]
+    return (tri * tri_mask.type_as(tri)).sum(1)
+
+
+def mbr_diag_batched(corners):
+    '''
+        Batched version of mbr_diag_compute: the diagonal of the minimum bounding rectangle of N sets of 8 points,
+        found among the orientations of the convex hull edges, without scipy and on the device of the inputs.
+        The hull edges are the (counterclockwise) directed edges i -> j with all the other points on their left;
+        the edge angles go through the same transform as mbr_diag_convex_hull.
+        corners: [N, 8, 2].
+        Return: [N,], the diagonals.
+    '''
+    N, P = corners.shape[:2]
+    pts = corners.detach()
+    edges = pts.unsqueeze(1) - pts.unsqueeze(2)          # [N, P(i), P(j), 2], p_j - p_i
+    rel = pts.unsqueeze(1) - pts.unsqueeze(2)            # [N, P(i), P(k), 2], p_k - p_i
+    cross = edges[..., 0].unsqueeze(-1) * rel[..., 1].unsqueeze(2) - edges[..., 1].unsqueeze(-1) * rel[..., 0].unsqueeze(2)  # [N, i, j, k]
+    length = edges.norm(dim=-1)
+    eps = 1e-6 * torch.clamp(length.flatten(1).max(1)[0].view(-1, 1, 1), min=1.0)
+    is_hull_edge = (cross >= -eps.unsqueeze(-1) * length.unsqueeze(-1)).all(-1) & (length > eps)  # [N, i, j]
+
+    # angles with gradients, the same as the edges of hull_points_2d.
+    edges = corners.unsqueeze(1) - corners.unsqueeze(2)
+    edge_angles = torch.atan2(edges[..., 1], edges[..., 0]).view(N, P * P)
+    edge_angles = torch.abs(torch.fmod(edge_angles, 3.1415926 / 2.0))
+    cos_a, sin_a = torch.cos(edge_angles), torch.sin(edge_angles)  # R = [[cos, sin], [-sin, cos]]
+    rot_x = cos_a.unsqueeze(-1) * corners[..., 0].unsqueeze(1) + sin_a.unsqueeze(-1) * corners[..., 1].unsqueeze(1)  # [N, P*P, P]
+    rot_y = -sin_a.unsqueeze(-1) * corners[..., 0].unsqueeze(1) + cos_a.unsqueeze(-1) * corners[..., 1].unsqueeze(1)
+    size_x = rot_x.max(-1)[0] - rot_x.min(-1)[0]
+    size_y = rot_y.max(-1)[0] - rot_y.min(-1)[0]
+    areas = (size_x * size_y).detach()
+    areas = torch.where(is_hull_edge.view(N, P * P), areas, torch.full_like(areas, float("inf")))
+    min_index = torch.argmin(areas, dim=1, keepdim=True)
+    size_x = torch.gather(size_x, 1, min_index).squeeze(1)
+    size_y = torch.gather(size_y, 1, min_index).squeeze(1)
+    return torch.sqrt(size_x ** 2 + size_y ** 2)
+
+
 class odiou_3D(nn.Module):
-    def _init_(self, gboxes, qboxes, aligned=False):
-        super(odiou_3D, self)._init_()
-        self.gboxes = gboxes
-        self.qboxes = qboxes
-        self.aligned = aligned
-        return
+    def __init__(self, batched=True):
+        '''
+            batched: compute the bev intersection & the mbr diagonal with rinter_area_batched & mbr_diag_batched,
+                     else with the per box numpy & scipy Functions above (slow, only kept for reference).
+        '''
+        super(odiou_3D, self).__init__()
+        self.batched = batched
 
     def forward(ctx, gboxes, qboxes, weights, batch_size):
         '''
@@ -867,16 +975,19 @@ class odiou_3D(nn.Module):
         corners_qboxes_1 = torch.stack((corners_qboxes[:, [0, 2, 4, 6]], corners_qboxes[:, [1, 3, 5, 7]]), 2)
         corners_pts = torch.cat((corners_gboxes_1, corners_qboxes_1), 1)
 
-        # compute the inter area
-        rinter_area_compute_object = rinter_area_compute()
-        inter_area = rinter_area_compute_object(corners_gboxes, corners_qboxes)
+        # compute the inter area & the mbr bev diag
+        if ctx.batched:
+            inter_area = rinter_area_batched(corners_gboxes, corners_qboxes)
+            mbr_diag_bev = mbr_diag_batched(corners_pts)
+        else:
+            rinter_area_compute_object = rinter_area_compute()
+            inter_area = rinter_area_compute_object(corners_gboxes, corners_qboxes)
+            mbr_diag_compute_object = mbr_diag_compute()
+            mbr_diag_bev = mbr_diag_compute_object(corners_pts)
 
         # compute center distance
         center_dist_square = torch.pow(gboxes[:, 0:3] - qboxes[:, 0:3], 2).sum(-1)
 
-        # compute the mbr bev diag
-        mbr_diag_compute_object = mbr_diag_compute()
-        mbr_diag_bev = mbr_diag_compute_object(corners_pts)
         inter_h = (torch.min(gboxes[:, 2] + 0.5 * gboxes[:, 5], qboxes[:, 2] + 0.5 * qboxes[:, 5]) -
                    torch.max(gboxes[:, 2] - 0.5 * gboxes[:, 5], qboxes[:, 2] - 0.5 * qboxes[:, 5]))
         oniou_h = (torch.max(gboxes[:, 2] + 0.5 * gboxes[:, 5], qboxes[:, 2] + 0.5 * qboxes[:, 5]) -
@@ -1,3 +1,9 @@
 from det3d.ops.nms.nms_cpu import nms_jit, soft_nms_jit
-from det3d.ops.nms.nms_gpu import nms_gpu, rotate_iou_gpu, rotate_nms_gpu
-from det3d.ops.nms.nms_gpu import rotate_iou_gpu_eval
+
+try:
+    from det3d.ops.nms.nms_gpu import nms_gpu, rotate_iou_gpu, rotate_nms_gpu
+    from det3d.ops.nms.nms_gpu import rotate_iou_gpu_eval
+except Exception:
+    # numba.cuda compiles the device functions of nms_gpu when it is imported, which needs a cuda driver: nms_cpu
+    # (and the torch nms of box_torch_ops) stay usable on cpu only machines.
+    pass
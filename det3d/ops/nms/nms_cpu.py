@@ -1,10 +1,8 @@
 import math
-from pathlib import Path
 import numba
 import numpy as np
 
 from det3d.core.bbox import box_np_ops
-from det3d.ops.nms.nms_gpu import rotate_iou_gpu
 
 try:
     from det3d.ops.nms.nms import (
@@ -12,20 +10,16 @@ try:
         rotate_non_max_suppression_cpu,
         IOU_weighted_rotate_non_max_suppression_cpu,
     )
-except:
-    current_dir = Path(__file__).resolve().parents[0]
-    load_pb11(
-        ["./nms_kernel.cu.cc", "./nms.cc"],
-        current_dir / "nms.so",
-        current_dir,
-        cuda=True,
-    )
-    from det3d.ops.nms.nms import (
-        non_max_suppression_cpu,
-        rotate_non_max_suppression_cpu,
-        IOU_weighted_rotate_non_max_suppression_cpu,
-    )
+except ImportError:
+    # the nms extension is optional (nms_gpu tries to build it): box_torch_ops.rotate_nms & rotate_weighted_nms
+    # fall back to the torch implementations when it is missing, see nms_extension_available.
+    non_max_suppression_cpu = None
+    rotate_non_max_suppression_cpu = None
+    IOU_weighted_rotate_non_max_suppression_cpu = None
+
 
+def nms_extension_available():
+    return rotate_non_max_suppression_cpu is not None
 
 
 def nms_cc(dets, thresh):
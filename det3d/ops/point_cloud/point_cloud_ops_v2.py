@@ -1,10 +1,9 @@
+import threading
 import time
 
 import numba
 import numpy as np
 
-COOR_TO_VOXELIDX2 = 65535 * np.ones(shape=(40, 1600, 1408), dtype=np.uint16)
-
 
 @numba.jit(nopython=True)
 def _points_to_voxel_reverse_kernel(
@@ -117,13 +116,275 @@ def _points_to_voxel_kernel(
 
 
 
+@numba.jit(nopython=True, nogil=True)
+def _points_to_voxel_hash_kernel(
+    points,
+    cloud_offsets,
+    voxel_size,
+    coors_range,
+    voxelmap_shape,
+    reverse_index,
+    table,
+    stamp,
+    point_voxel,
+    coors,
+    max_voxels=20000,
+):
+    '''
+        Same voxel assignment as _points_to_voxel_reverse_kernel for each point cloud points[cloud_offsets[c]:
+        cloud_offsets[c + 1]], with an open addressing hash table of linear voxel indices instead of the dense
+        coor_to_voxelidx map. table: [2 * size], slot s holds the tag (stamp << 40 | linear index) at 2s and the
+        voxel index at 2s + 1. Cloud c uses stamp + c: slots with another stamp are empty, so the table is shared
+        by the clouds and never needs to be cleared.
+        point_voxel: [N], voxel index of each point (counted over all clouds), -1 for dropped points.
+        return: voxel_nums, [num_clouds].
+    '''
+    ndim = 3
+    ndim_minus_1 = ndim - 1
+    grid_size = (coors_range[3:] - coors_range[:3]) / voxel_size
+    grid_size = np.round(grid_size, 0, grid_size).astype(np.int32)
+    table_mask = table.shape[0] // 2 - 1
+    coor = np.zeros(shape=(3,), dtype=np.int32)
+    num_clouds = cloud_offsets.shape[0] - 1
+    voxel_nums = np.zeros(shape=(num_clouds,), dtype=np.int64)
+    voxel_offset = 0
+    for cloud in range(num_clouds):
+        cloud_stamp = stamp + cloud
+        stamp_tag = np.int64(cloud_stamp) << 40
+        voxel_num = 0
+        for i in range(cloud_offsets[cloud], cloud_offsets[cloud + 1]):
+            point_voxel[i] = -1
+            if voxel_num < 0:  # max_voxels reached, drop the rest of this cloud.
+                continue
+            failed = False
+            for j in range(ndim):
+                c = np.floor((points[i, j] - coors_range[j]) / voxel_size[j])
+                if c < 0 or c >= grid_size[j]:
+                    failed = True
+                    break
+                if reverse_index:
+                    coor[ndim_minus_1 - j] = c
+                else:
+                    coor[j] = c
+            if failed:
+                continue
+            key = (np.int64(coor[0]) * voxelmap_shape[1] + coor[1]) * voxelmap_shape[2] + coor[2]
+            tag = stamp_tag | key
+            slot = ((key * 2654435761) ^ (key >> 13)) & table_mask
+            while table[2 * slot] != tag and (table[2 * slot] >> 40) == cloud_stamp:
+                slot = (slot + 1) & table_mask
+            if table[2 * slot] != tag:
+                if voxel_num >= max_voxels:
+                    voxel_nums[cloud] = voxel_num
+                    voxel_num = -1
+                    continue
+                table[2 * slot] = tag
+                table[2 * slot + 1] = voxel_offset + voxel_num
+                coors[voxel_offset + voxel_num] = coor
+                voxel_num += 1
+            point_voxel[i] = table[2 * slot + 1]
+        if voxel_num >= 0:
+            voxel_nums[cloud] = voxel_num
+        voxel_offset += voxel_nums[cloud]
+    return voxel_nums
+
+
+@numba.jit(nopython=True, nogil=True)
+def _fill_voxels_kernel(points, point_voxel, voxels, num_points_per_voxel, max_points=35):
+    for i in range(points.shape[0]):
+        voxelidx = point_voxel[i]
+        if voxelidx >= 0:
+            num = num_points_per_voxel[voxelidx]
+            if num < max_points:
+                voxels[voxelidx, num] = points[i]
+                num_points_per_voxel[voxelidx] += 1
+
+
+def points_to_voxel_numpy(points, voxel_size, coors_range, max_points=35, reverse_index=True, max_voxels=20000):
+    '''
+        Sort based, fully vectorized voxelization without numba (no jit warm-up), same output as Voxelizer: voxels
+        in the order their first point appears, first max_points points of each voxel, and the points from the one
+        which would create voxel max_voxels + 1 on are dropped.
+    '''
+    voxel_size = np.asarray(voxel_size, dtype=np.float32)
+    coors_range = np.asarray(coors_range, dtype=np.float32)
+    grid_size = np.round((coors_range[3:] - coors_range[:3]) / voxel_size).astype(np.int32)
+
+    coors = np.floor((points[:, :3] - coors_range[:3]) / voxel_size)                  # [N, 3], xyz
+    valid_inds = np.where(((coors >= 0) & (coors < grid_size)).all(axis=1))[0]
+    coors = coors[valid_inds].astype(np.int32)
+    keys = (coors[:, 0].astype(np.int64) * grid_size[1] + coors[:, 1]) * grid_size[2] + coors[:, 2]
+
+    # group points by voxel with a stable sort: first_inds is the first point of each voxel, in key order.
+    _, first_inds, point_voxel = np.unique(keys, return_index=True, return_inverse=True)
+    point_voxel = point_voxel.reshape(-1)
+    voxel_order = np.argsort(first_inds, kind="stable")                                # first-seen order
+    voxel_rank = np.empty_like(voxel_order)
+    voxel_rank[voxel_order] = np.arange(voxel_order.shape[0])
+    point_voxel = voxel_rank[point_voxel]
+
+    # stop at the point which would create voxel max_voxels + 1.
+    if voxel_order.shape[0] > max_voxels:
+        num_valid = first_inds[voxel_order[max_voxels]]
+        valid_inds, point_voxel = valid_inds[:num_valid], point_voxel[:num_valid]
+        voxel_order = voxel_order[:max_voxels]
+    voxel_num = voxel_order.shape[0]
+
+    # slot of each point in its voxel, keep the first max_points ones.
+    point_order = np.argsort(point_voxel, kind="stable")
+    sorted_voxel = point_voxel[point_order]
+    num_points_per_voxel = np.bincount(sorted_voxel, minlength=voxel_num).astype(np.int32)
+    voxel_start = np.cumsum(num_points_per_voxel) - num_points_per_voxel
+    slots = np.arange(sorted_voxel.shape[0]) - voxel_start[sorted_voxel]
+    keep = slots < max_points
+
+    voxels = np.zeros(shape=(voxel_num, max_points, points.shape[-1]), dtype=points.dtype)
+    voxels[sorted_voxel[keep], slots[keep]] = points[valid_inds[point_order[keep]]]
+    coors = coors[first_inds[voxel_order]]
+    if reverse_index:
+        coors = coors[:, ::-1]
+    return voxels, np.ascontiguousarray(coors), np.minimum(num_points_per_voxel, max_points)
+
+
+class _VoxelizerScratch(object):
+    '''
+        Per-thread scratch buffers of Voxelizer, grown on demand and reused across calls. The stamps of the hash table
+        tags (stamp << 40 | linear index) wrap at MAX_STAMP, with the table cleared, so that the tags stay positive.
+    '''
+    MAX_STAMP = (1 << 23) - 1
+
+    def __init__(self, max_voxels):
+        self.table = np.zeros((0,), dtype=np.int64)
+        self.stamp = 0
+        self.point_voxel = np.zeros((0,), dtype=np.int32)
+        self.coors = np.zeros((0, 3), dtype=np.int32)
+
+    def reserve(self, cloud_sizes, max_voxels):
+        # keep the load factor of the hash table <= 0.5, each cloud uses the table on its own.
+        num_points = max(cloud_sizes) if len(cloud_sizes) > 0 else 0
+        table_size = max(1024, 1 << int(np.ceil(np.log2(2 * max(min(num_points, max_voxels), 1)))))
+        if 2 * table_size > self.table.shape[0]:
+            self.table = -np.ones((2 * table_size,), dtype=np.int64)  # stamp -1: empty
+        if sum(cloud_sizes) > self.point_voxel.shape[0]:
+            self.point_voxel = np.zeros((int(sum(cloud_sizes) * 1.5),), dtype=np.int32)
+        if max_voxels * len(cloud_sizes) > self.coors.shape[0]:
+            self.coors = np.zeros((max_voxels * len(cloud_sizes), 3), dtype=np.int32)
+        if self.stamp + len(cloud_sizes) > self.MAX_STAMP:
+            self.table.fill(-1)
+            self.stamp = 0
+        stamp = self.stamp
+        self.stamp += len(cloud_sizes)
+        return stamp
+
+
+class Voxelizer(object):
+    """Reentrant voxelizer, equivalent to the former points_to_voxel: voxels are created in the order their first
+    point appears, each voxel keeps its first max_points points, and all points after the one which would create
+    voxel max_voxels + 1 are dropped.
+
+    Instead of a global dense coor -> voxel map, the voxel map is a hash table sized to the point count; it and the
+    other scratch buffers are owned by the calling thread and reused across calls, so that generate can run in a
+    thread pool (the kernels release the gil). Only the outputs, sized to the actual number of voxels, are allocated.
+
+    Args:
+        voxel_size: [3] list/tuple or array, float. xyz, indicate voxel size
+        coors_range: [6] list/tuple or array, float. indicate voxel range, format: xyzxyz, minmax
+        max_points: int. indicate maximum points contained in a voxel.
+        reverse_index: boolean. if True, output coordinates will be zyx format.
+        max_voxels: int. indicate maximum voxels this function create.
+        mode: "numba" (hash table kernels) or "numpy" (points_to_voxel_numpy, no jit warm-up), same outputs.
+    """
+    def __init__(self, voxel_size, coors_range, max_points=35, reverse_index=True, max_voxels=20000, mode="numba"):
+        assert mode in ["numba", "numpy"], f"unknown voxelization mode: {mode}"
+        self.mode = mode
+        self.voxel_size = np.array(voxel_size, dtype=np.float32)
+        self.coors_range = np.array(coors_range, dtype=np.float32)
+        self.max_points = max_points
+        self.reverse_index = reverse_index
+        self.max_voxels = max_voxels
+        voxelmap_shape = np.round((self.coors_range[3:] - self.coors_range[:3]) / self.voxel_size).astype(np.int64)
+        self.voxelmap_shape = voxelmap_shape[::-1].copy() if reverse_index else voxelmap_shape
+        assert np.prod(self.voxelmap_shape) < 2 ** 40, "linear voxel index should fit in 40 bits"
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_scratch(self):
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = self._local.scratch = _VoxelizerScratch(self.max_voxels)
+        return scratch
+
+    def generate(self, points):
+        """
+        Args:
+            points: [N, ndim] float tensor. points[:, :3] contain xyz points and points[:, 3:] contain other information.
+
+        Returns:
+            voxels: [M, max_points, ndim] float tensor. only contain points.
+            coordinates: [M, 3] int32 tensor.
+            num_points_per_voxel: [M] int32 tensor.
+        """
+        return self.generate_batch([points])[0]
+
+    def generate_batch(self, points_list):
+        """
+        Voxelize several point clouds (like points and points_raw of a sample) in one kernel invocation with
+        shared scratch buffers; each cloud is voxelized on its own, same as generate.
+
+        Args:
+            points_list: list of [N_i, ndim] float tensor with the same ndim & dtype.
+
+        Returns:
+            list of (voxels, coordinates, num_points_per_voxel), one per point cloud.
+        """
+        if self.mode == "numpy":
+            return [points_to_voxel_numpy(points, self.voxel_size, self.coors_range, self.max_points,
+                                          self.reverse_index, self.max_voxels) for points in points_list]
+
+        cloud_sizes = [points.shape[0] for points in points_list]
+        cloud_offsets = np.cumsum([0] + cloud_sizes).astype(np.int64)
+        all_points = points_list[0] if len(points_list) == 1 else np.concatenate(points_list, axis=0)
+        scratch = self._get_scratch()
+        stamp = scratch.reserve(cloud_sizes, self.max_voxels)
+        voxel_nums = _points_to_voxel_hash_kernel(
+            all_points,
+            cloud_offsets,
+            self.voxel_size,
+            self.coors_range,
+            self.voxelmap_shape,
+            self.reverse_index,
+            scratch.table,
+            stamp,
+            scratch.point_voxel,
+            scratch.coors,
+            self.max_voxels,
+        )
+        total_voxel_num = int(voxel_nums.sum())
+        voxels = np.zeros(shape=(total_voxel_num, self.max_points, all_points.shape[-1]), dtype=all_points.dtype)
+        num_points_per_voxel = np.zeros(shape=(total_voxel_num,), dtype=np.int32)
+        _fill_voxels_kernel(all_points, scratch.point_voxel[:all_points.shape[0]], voxels, num_points_per_voxel, self.max_points)
+        coors = scratch.coors[:total_voxel_num].copy()
+
+        voxel_offsets = np.cumsum(voxel_nums)[:-1]
+        return list(zip(np.split(voxels, voxel_offsets), np.split(coors, voxel_offsets), np.split(num_points_per_voxel, voxel_offsets)))
+
+
+_VOXELIZERS = {}
+
+
 def points_to_voxel(
     points, voxel_size, coors_range, max_points=35, reverse_index=True, max_voxels=20000
 ):
-    """convert kitti points(N, >=3) to voxels. This version calculate
-    everything in one loop. now it takes only 4.2ms(complete point cloud)
-    with jit and 3.2ghz cpu.(don't calculate other features)
-    Note: this function in ubuntu seems faster than windows 10.
+    """convert kitti points(N, >=3) to voxels, see Voxelizer; the voxelizer (and its scratch buffers)
+    of each setting is kept for the next calls.
 
     Args:
         points: [N, ndim] float tensor. points[:, :3] contain xyz points and
@@ -145,53 +406,10 @@ def points_to_voxel(
         coordinates: [M, 3] int32 tensor.
         num_points_per_voxel: [M] int32 tensor.
     """
-    if not isinstance(voxel_size, np.ndarray):
-        voxel_size = np.array(voxel_size, dtype=points.dtype)
-    if not isinstance(coors_range, np.ndarray):
-        coors_range = np.array(coors_range, dtype=points.dtype)
-    voxelmap_shape = (coors_range[3:] - coors_range[:3]) / voxel_size
-    voxelmap_shape = tuple(np.round(voxelmap_shape).astype(np.int32).tolist())
-    if reverse_index:
-        voxelmap_shape = voxelmap_shape[::-1]
-    # don't create large array in jit(nopython=True) code.
-
-    num_points_per_voxel = np.zeros(shape=(max_voxels,), dtype=np.int32)
-
-    voxels = np.zeros(
-        shape=(max_voxels, max_points, points.shape[-1]), dtype=points.dtype
-    )
-
-    global COOR_TO_VOXELIDX2
-    coors = np.zeros(shape=(max_voxels, 3), dtype=np.int32)
-    if reverse_index:
-        voxel_num = _points_to_voxel_reverse_kernel(
-            points,
-            voxel_size,
-            coors_range,
-            num_points_per_voxel,
-            COOR_TO_VOXELIDX2,
-            voxels,
-            coors,
-            max_points,
-            max_voxels,
-        )
-
-    else:
-        voxel_num = _points_to_voxel_kernel(
-            points,
-            voxel_size,
-            coors_range,
-            num_points_per_voxel,
-            COOR_TO_VOXELIDX2,
-            voxels,
-            coors,
-            max_points,
-            max_voxels,
-        )
-    coors = coors[:voxel_num]
-    voxels = voxels[:voxel_num]
-    num_points_per_voxel = num_points_per_voxel[:voxel_num]
-    return voxels, coors, num_points_per_voxel
+    key = (tuple(np.asarray(voxel_size).tolist()), tuple(np.asarray(coors_range).tolist()), max_points, reverse_index, max_voxels)
+    if key not in _VOXELIZERS:
+        _VOXELIZERS[key] = Voxelizer(voxel_size, coors_range, max_points, reverse_index, max_voxels)
+    return _VOXELIZERS[key].generate(points)
 
 
 @numba.jit(nopython=True)
@@ -1,6 +1,8 @@
+import numba
 import numpy as np
 import roipool3d_cuda
 import torch
+from det3d.core.bbox.geometry import bev_grid_params, bucket_points_bev
 from lib.datasets.kitti import kitti_utils
 
 
@@ -42,29 +44,65 @@ def roipool3d_gpu(pts, pts_feature, boxes3d, pool_extra_width, sampled_pt_num=51
     return pooled_features, pooled_empty_flag
 
 
-def pts_in_boxes3d_cpu(pts, boxes3d):
+def pts_in_boxes3d_cpu(pts, boxes3d, cell_size=1.0):
     """
     :param pts: (N, 3) in rect-camera coords
     :param boxes3d: (M, 7)
     :return: boxes_pts_mask_list: (M), list with [(N), (N), ..]
+    same test as roipool3d_cuda.pts_in_boxes3d_cpu, but each box only checks the points of the
+    bev (x, z) cells under it.
     """
     if not pts.is_cuda:
-        pts = pts.float().contiguous()
-        boxes3d = boxes3d.float().contiguous()
-        pts_flag = torch.LongTensor(
-            torch.Size((boxes3d.size(0), pts.size(0)))
-        )  # (M, N)
-        roipool3d_cuda.pts_in_boxes3d_cpu(pts_flag, pts, boxes3d)
+        np_pts = pts.float().contiguous().numpy()
+        np_boxes3d = boxes3d.float().contiguous().numpy()
+        pts_flag = np.zeros((np_boxes3d.shape[0], np_pts.shape[0]), dtype=np.bool_)  # (M, N)
+        if np_pts.shape[0] > 0 and np_boxes3d.shape[0] > 0:
+            # bev radius of each box, at most the max_dis of the test.
+            radius = np.minimum(np.sqrt(np_boxes3d[:, 4] ** 2 + np_boxes3d[:, 5] ** 2) / 2.0, 10.0) + 1e-2
+            box_min = np_boxes3d[:, [0, 2]] - radius[:, np.newaxis]
+            box_max = np_boxes3d[:, [0, 2]] + radius[:, np.newaxis]
+            grid_min, cell_size, grid_shape = bev_grid_params(box_min.min(axis=0), box_max.max(axis=0), cell_size)
+            order, cell_start = bucket_points_bev(np.ascontiguousarray(np_pts[:, [0, 2]]), grid_min, cell_size, grid_shape)
+            _pts_in_boxes3d_grid(np_pts, np_boxes3d, box_min, box_max, order, cell_start, grid_min, cell_size,
+                                 grid_shape, pts_flag)
 
         boxes_pts_mask_list = []
-        for k in range(0, boxes3d.shape[0]):
-            cur_mask = pts_flag[k] > 0
+        for k in range(0, np_boxes3d.shape[0]):
+            cur_mask = torch.from_numpy(pts_flag[k])
             boxes_pts_mask_list.append(cur_mask)
         return boxes_pts_mask_list
     else:
         raise NotImplementedError
 
 
+@numba.njit
+def _pts_in_boxes3d_grid(pts, boxes3d, box_min, box_max, order, cell_start, grid_min, cell_size, grid_shape, pts_flag):
+    # pt_in_box3d_cpu of roipool3d.cpp, boxes3d: (M, 7) [x, y, z, h, w, l, ry], y is the bottom.
+    max_dis = 10.0
+    nx, ny = grid_shape[0], grid_shape[1]
+    for k in range(boxes3d.shape[0]):
+        cx, bottom_y, cz = boxes3d[k, 0], boxes3d[k, 1], boxes3d[k, 2]
+        h, w, l, angle = boxes3d[k, 3], boxes3d[k, 4], boxes3d[k, 5], boxes3d[k, 6]
+        cy = bottom_y - h / 2.0
+        cosa = np.cos(angle)
+        sina = np.sin(angle)
+        gx0 = max(int(np.floor((box_min[k, 0] - grid_min[0]) / cell_size)), 0)
+        gz0 = max(int(np.floor((box_min[k, 1] - grid_min[1]) / cell_size)), 0)
+        gx1 = min(int(np.floor((box_max[k, 0] - grid_min[0]) / cell_size)), nx - 1)
+        gz1 = min(int(np.floor((box_max[k, 1] - grid_min[1]) / cell_size)), ny - 1)
+        for gz in range(gz0, gz1 + 1):
+            for gx in range(gx0, gx1 + 1):
+                c = gz * nx + gx
+                for n in range(cell_start[c], cell_start[c + 1]):
+                    j = order[n]
+                    x, y, z = pts[j, 0], pts[j, 1], pts[j, 2]
+                    if abs(x - cx) > max_dis or abs(y - cy) > h / 2.0 or abs(z - cz) > max_dis:
+                        continue
+                    x_rot = (x - cx) * cosa + (z - cz) * (-sina)
+                    z_rot = (x - cx) * sina + (z - cz) * cosa
+                    pts_flag[k, j] = (x_rot >= -l / 2.0) and (x_rot <= l / 2.0) and (z_rot >= -w / 2.0) and (z_rot <= w / 2.0)
+
+
 def roipool_pc_cpu(pts, pts_feature, boxes3d, sampled_pt_num):
     """
     :param pts: (N, 3)
@@ -152,7 +152,7 @@ def batch_processor(model, data, train_mode=False, **kwargs):
     if train_mode:
         losses = model(example, return_loss=True)
         loss, log_vars = parse_second_losses(losses)
-        outputs = dict(loss=loss, log_vars=log_vars, num_samples=len(example["anchors"][0]))
+        outputs = dict(loss=loss, log_vars=log_vars, num_samples=len(example["metadata"]))
         return outputs
     else:
         return model(example, is_ema=[False, None], return_loss=False)
@@ -301,7 +301,8 @@ def train_detector(model, dataset, cfg, distributed=False, validate=False, logge
         param.detach_()
 
     # build trainer
-    trainer = Trainer(model, model_ema, batch_processor, optimizer, lr_scheduler, cfg.work_dir, cfg.log_level)
+    trainer = Trainer(model, model_ema, batch_processor, optimizer, lr_scheduler, cfg.work_dir, cfg.log_level,
+                      ema_config=cfg.get("ema_config", None))
 
     if distributed:
         optimizer_config = DistOptimizerHook(**cfg.optimizer_config)
@@ -208,6 +208,16 @@ def collate_kitti(batch_list, samples_per_gpu=1):
             for kk, vv in ret[key].items():
                 res.append(torch.stack(vv))
             ret[key] = res
+        elif key in ["pos_inds", "pos_inds_raw"]:
+            # sparse targets: [num_pos_anchors_in_batch, 2], (batch_id, anchor_id) per task.
+            res = []
+            for idx in range(len(elems[0])):
+                inds = [np.stack([np.full_like(elem[idx], i), elem[idx]], axis=-1) for i, elem in enumerate(elems)]
+                res.append(torch.from_numpy(np.concatenate(inds, axis=0)))
+            ret[key] = res
+        elif key in ["pos_reg_targets", "pos_reg_targets_raw"]:
+            # sparse targets: [num_pos_anchors_in_batch, 7] per task, same order as pos_inds.
+            ret[key] = [torch.from_numpy(np.concatenate([elem[idx] for elem in elems], axis=0)) for idx in range(len(elems[0]))]
         else:
             try:
                 ret[key] = np.stack(elems, axis=0)
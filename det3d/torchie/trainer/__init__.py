@@ -17,6 +17,7 @@ from .hooks import (
     TensorboardLoggerHook,
     TextLoggerHook,
 )
+from .ema import ModelEMA
 from .log_buffer import LogBuffer
 from .parallel_test import parallel_test
 from .priority import Priority, get_priority
@@ -38,6 +39,7 @@ from .utils import (
 __all__ = [
     "Trainer",
     "LogBuffer",
+    "ModelEMA",
     "Hook",
     "CheckpointHook",
     "ClosureHook",
@@ -0,0 +1,68 @@
+import torch
+
+
+class ModelEMA(object):
+    '''
+        Mean teacher update of model_ema from model:
+            ema = alpha * ema + (1 - alpha) * param, alpha = min(1 - 1 / (global_step + 1), decay),
+        with one torch._foreach op over all the parameters instead of two small kernels per tensor.
+
+        buffers: how the buffers of the teacher (BatchNorm running stats) follow the student, None: not at all (as the
+            original update), "copy": copied, "ema": same average as the parameters (integer buffers, e.g.
+            num_batches_tracked, are copied).
+        interval: update every interval steps only, with the product of the alphas of the skipped steps, so that the
+            teacher keeps the same time constant.
+    '''
+
+    def __init__(self, model, model_ema, decay=0.999, interval=1, buffers=None):
+        assert buffers in [None, "copy", "ema"], f"unknown buffers mode {buffers}"
+        assert interval >= 1
+        self.decay = decay
+        self.interval = interval
+        self.buffers = buffers
+        self._alpha = 1.0
+        self._num_steps = 0
+
+        # .data shares the storage of the parameters: load_checkpoint & the optimizer update them in place.
+        self.ema_params = [p.data for p in model_ema.parameters()]
+        self.params = [p.data for p in model.parameters()]
+        assert len(self.ema_params) == len(self.params)
+        ema_buffers, buffers = list(model_ema.buffers()), list(model.buffers())
+        assert len(ema_buffers) == len(buffers)
+        float_buffers = [b.is_floating_point() for b in buffers]
+        self.ema_float_buffers = [b for b, f in zip(ema_buffers, float_buffers) if f]
+        self.float_buffers = [b for b, f in zip(buffers, float_buffers) if f]
+        self.ema_other_buffers = [b for b, f in zip(ema_buffers, float_buffers) if not f]
+        self.other_buffers = [b for b, f in zip(buffers, float_buffers) if not f]
+
+    @torch.no_grad()
+    def update(self, global_step):
+        self._alpha *= min(1 - 1 / (global_step + 1), self.decay)
+        self._num_steps += 1
+        if self._num_steps < self.interval:
+            return
+        alpha, self._alpha, self._num_steps = self._alpha, 1.0, 0
+
+        self._ema_(self.ema_params, self.params, alpha)
+        if self.buffers == "ema":
+            self._ema_(self.ema_float_buffers, self.float_buffers, alpha)
+        elif self.buffers == "copy":
+            self._copy_(self.ema_float_buffers, self.float_buffers)
+        if self.buffers is not None:
+            self._copy_(self.ema_other_buffers, self.other_buffers)
+
+    @staticmethod
+    def _ema_(ema_tensors, tensors, alpha):
+        if len(ema_tensors) == 0:
+            return
+        if not hasattr(torch, "_foreach_mul_"):  # torch < 1.7
+            for ema_tensor, tensor in zip(ema_tensors, tensors):
+                ema_tensor.mul_(alpha).add_(tensor, alpha=1 - alpha)
+            return
+        torch._foreach_mul_(ema_tensors, alpha)
+        torch._foreach_add_(ema_tensors, tensors, alpha=1 - alpha)
+
+    @staticmethod
+    def _copy_(dst_tensors, src_tensors):
+        for dst, src in zip(dst_tensors, src_tensors):
+            dst.copy_(src)
@@ -11,6 +11,7 @@ from det3d import torchie
 
 from . import hooks
 from .checkpoint import load_checkpoint, save_checkpoint
+from .ema import ModelEMA
 from .hooks import (CheckpointHook, Hook, IterTimerHook, LrUpdaterHook, OptimizerHook, lr_updater,)
 from .log_buffer import LogBuffer
 from .priority import get_priority
@@ -21,8 +22,8 @@ def example_to_device(example, device, non_blocking=False) -> dict:
     example_torch = {}
     float_names = ["voxels", "bev_map"]
     for k, v in example.items():
-        if k in ["anchors", "anchors_mask", "reg_targets", "reg_weights", "labels", "anchors_raw",
-                 "anchors_mask_raw", "reg_targets_raw", "reg_weights_raw", "labels_raw"]:
+        if k in ["anchors_mask", "reg_targets", "reg_weights", "labels", "pos_inds", "pos_reg_targets",
+                 "anchors_mask_raw", "reg_targets_raw", "reg_weights_raw", "labels_raw", "pos_inds_raw", "pos_reg_targets_raw"]:
             example_torch[k] = [res.to(device, non_blocking=non_blocking) for res in v]
         elif k in ["voxels", "bev_map", "coordinates", "num_points", "points", "num_voxels",
                    "voxels_raw", "coordinates_raw", "num_points_raw", "points_raw", "num_voxels_raw",]:
@@ -53,10 +54,12 @@ def parse_second_losses(losses):
 
 class Trainer(object):
 
-    def __init__(self, model, model_ema, batch_processor, optimizer=None, lr_scheduler=None, work_dir=None, log_level=logging.INFO, logger=None, **kwargs,):
+    def __init__(self, model, model_ema, batch_processor, optimizer=None, lr_scheduler=None, work_dir=None, log_level=logging.INFO, logger=None, ema_config=None, **kwargs,):
         assert callable(batch_processor)
         self.model = model
         self.model_ema = model_ema
+        # ema_config: decay, interval & buffers of ModelEMA, the teacher update.
+        self.ema = ModelEMA(model, model_ema, **(ema_config or {}))
         self.optimizer = optimizer
         self.lr_scheduler = lr_scheduler
 
@@ -268,7 +271,7 @@ class Trainer(object):
             self.call_hook("after_forward")
             loss, log_vars = parse_second_losses(losses)
             del losses
-            outputs = dict(loss=loss, log_vars=log_vars, num_samples=len(example["anchors"][0]))
+            outputs = dict(loss=loss, log_vars=log_vars, num_samples=len(example["metadata"]))
             self.call_hook("after_parse_loss")
             return outputs
         else:
@@ -291,8 +294,8 @@ class Trainer(object):
                 elif key == "calib":
                     for k1 in data_batch[key].keys():
                         data_batch[key][k1] = torch.cat([data_batch[key][k1], data_batch_unlabel[key][k1]], dim=0)
-                elif key in ["anchors", "anchors_mask", "reg_targets", "reg_weights", "labels",
-                             "anchors_raw", "anchors_mask_raw", "reg_targets_raw", "reg_weights_raw", "labels_raw"]:
+                elif key in ["anchors_mask", "reg_targets", "reg_weights", "labels",
+                             "anchors_mask_raw", "reg_targets_raw", "reg_weights_raw", "labels_raw"]:
                     if key in data_batch_unlabel.keys():
                         data_batch[key][0] = torch.cat([data_batch[key][0], data_batch_unlabel[key][0]], dim=0)
                 elif key in data_batch_unlabel.keys():
@@ -313,9 +316,8 @@ class Trainer(object):
 
 
     def update_ema_variables(self, model, ema_model, global_step):
-        alpha = min(1 - 1 / (global_step + 1), 0.999)
-        for ema_param, param in zip(ema_model.parameters(), model.parameters()):
-            ema_param.data.mul_(alpha).add_(1 - alpha, param.data)
+        # all the parameters (and buffers) of ema_model at once, see ModelEMA.
+        self.ema.update(global_step)
 
     def train(self, data_loader, data_loader_unlabel, epoch, **kwargs):
         self.model_ema.train()
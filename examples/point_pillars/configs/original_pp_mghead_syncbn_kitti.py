@@ -89,6 +89,7 @@ model = dict(
             loss_weight=0.2,
         ),
         direction_offset=0.0,
+        target_assigner=target_assigner,
     ),
 )
 
@@ -42,6 +42,27 @@ my_paras = dict(
     loss_iou=None,
 )
 
+target_assigner = dict(
+    type="iou",
+    anchor_generators=[
+        dict(
+            type="anchor_generator_range",
+            sizes=[1.6, 3.9, 1.56],  # w, l, h
+            anchor_ranges=[0, -40.0, -1.0, 70.4, 40.0, -1.0],
+            rotations=[0, 1.57],
+            matched_threshold=0.6,
+            unmatched_threshold=0.45,
+            class_name="Car",
+        ),
+    ],
+    sample_positive_fraction=-1,
+    sample_size=512,
+    region_similarity_calculator=dict(type="grid_nearest_iou_similarity",),  # nearest iou, evaluated in gt windows of the anchor grid only
+    pos_area_threshold=-1,
+    tasks=tasks,
+    feature_map_size=[1, 200, 176],  # anchors are built once for this size, shared by AssignTarget & MultiGroupHead.
+)
+
 # model settings
 model = dict(
     type="VoxelNet",
@@ -75,36 +96,20 @@ model = dict(
         encode_rad_error_by_sin=True,
         loss_aux=dict(type="WeightedSoftmaxClassificationLoss", name="direction_classifier", loss_weight=0.2,),
         direction_offset=0.0,
+        target_assigner=target_assigner,
         #loss_iou=my_paras['loss_iou'],
     ),
 )
 
-target_assigner = dict(
-    type="iou",
-    anchor_generators=[
-        dict(
-            type="anchor_generator_range",
-            sizes=[1.6, 3.9, 1.56],  # w, l, h
-            anchor_ranges=[0, -40.0, -1.0, 70.4, 40.0, -1.0],
-            rotations=[0, 1.57],
-            matched_threshold=0.6,
-            unmatched_threshold=0.45,
-            class_name="Car",
-        ),
-    ],
-    sample_positive_fraction=-1,
-    sample_size=512,
-    region_similarity_calculator=dict(type="nearest_iou_similarity",),
-    pos_area_threshold=-1,
-    tasks=tasks,
-)
-
 assigner = dict(
     box_coder=box_coder,
     target_assigner=target_assigner,
     out_size_factor=8,
     debug=False,
     enable_similar_type=True,
+    sparse_targets=True,          # int8 labels & targets of positive anchors only, scattered to dense on device.
+    target_branches=["student"],  # add "raw" to log teacher losses on targets of points without global augmentation.
+    profile=False,                # log assignment time per sample and time saved by skipped branches.
 )
 
 
@@ -140,6 +145,9 @@ db_sampler = dict(
     gt_random_drop=my_paras['gt_random_drop'],
     gt_aug_with_context=my_paras['gt_aug_with_context'],
     gt_aug_similar_type=my_paras['gt_aug_similar_type'],
+    placement="incremental",       # place sampled boxes one by one until the quota is met (see sample_class_incremental)
+    placement_time_budget=None,    # seconds per class; None: bounded by placement_max_candidates only (reproducible)
+    placement_max_candidates=100,
 )
 train_preprocessor = dict(
     mode="train",
@@ -204,6 +212,8 @@ train_anno = data_root_prefix + "/KITTI/object/kitti_infos_" + my_paras['data_mo
 val_anno = data_root_prefix + "/KITTI/object/kitti_infos_val.pkl"
 test_anno = data_root_prefix + "/KITTI/object/kitti_infos_test.pkl"
 trainval_anno = data_root_prefix + "/KITTI/object/kitti_infos_trainval.pkl"
+frame_static_cache = True   # precompute the frame-static values once, next to the infos (kitti_infos_*_static/)
+sample_cache = True   # val: pack the pipeline outputs once (deterministic pipeline), next to the infos (sample_cache/)
 
 data = dict(
     samples_per_gpu=my_paras['batch_size'],  # batch_size: 4
@@ -213,6 +223,7 @@ data = dict(
         root_path=data_root,
         info_path=train_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
         pipeline=training_pipeline,
     ),
     val=dict(
@@ -220,6 +231,8 @@ data = dict(
         root_path=data_root,
         info_path=val_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
+        sample_cache=sample_cache,
         pipeline=test_pipeline,
     ),
     test=dict(
@@ -227,6 +240,7 @@ data = dict(
         root_path=data_root,
         info_path=test_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
         pipeline=test_pipeline,
     ),
     trainval=dict(
@@ -234,6 +248,7 @@ data = dict(
         root_path=data_root,
         info_path=trainval_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
         pipeline=test_pipeline,
     ),
     train_unlabel_val=dict(
@@ -241,6 +256,7 @@ data = dict(
         root_path=data_root,
         info_path=val_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
         pipeline=train_pipeline,
         labeled=False,
     ),
@@ -249,6 +265,7 @@ data = dict(
         root_path=data_root,
         info_path=test_anno,
         class_names=class_names,
+        frame_static_cache=frame_static_cache,
         pipeline=train_pipeline,
         labeled=False,
     ),
@@ -258,6 +275,8 @@ data = dict(
 optimizer = dict(type="adam", amsgrad=0.0, wd=0.01, fixed_wd=True, moving_average=False,)
 optimizer_config = dict(grad_clip=dict(max_norm=35, norm_type=2))
 lr_config = dict(type="one_cycle", lr_max=0.003, moms=[0.95, 0.85], div_factor=10.0, pct_start=0.4,)  # learning policy in training hooks
+# teacher update: ema of the student with decay, every interval steps; buffers (bn stats): None / "copy" / "ema".
+ema_config = dict(decay=0.999, interval=1, buffers=None)
 
 
 
@@ -0,0 +1,69 @@
+'''
+    Compare the teacher update of the SE-SSD trainer: the previous loop over the parameters (two kernels per tensor) with
+    ModelEMA (torch._foreach ops over all the tensors at once), with the buffers not updated (as the loop), copied or
+    averaged, and updated every k steps: checks that the loop and ModelEMA(buffers=None) give the same teacher, and
+    reports the time per step on the model built from the config (on cpu by default).
+
+    python tools/benchmark_ema.py --config examples/second/configs/config.py --num_steps 100 --intervals 1 4
+'''
+import copy
+
+import torch
+from det3d.models import build_detector
+from det3d.torchie import Config
+from det3d.torchie.trainer import ModelEMA
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark the teacher ema update", device="cpu")
+    parser.add_argument("--config", default="examples/second/configs/config.py")
+    parser.add_argument("--num_steps", type=int, default=100)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 4])
+    return parser.parse_args()
+
+
+def loop_update(model, ema_model, global_step):
+    # the previous Trainer.update_ema_variables.
+    alpha = min(1 - 1 / (global_step + 1), 0.999)
+    for ema_param, param in zip(ema_model.parameters(), model.parameters()):
+        ema_param.data.mul_(alpha).add_(param.data, alpha=1 - alpha)
+
+
+def time_per_step(update, num_steps):
+    t, _ = timeit(lambda: [update(step) for step in range(num_steps)])
+    return t / num_steps
+
+
+def same_params(model_a, model_b):
+    return all(torch.equal(a, b) for a, b in zip(model_a.parameters(), model_b.parameters()))
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    torch.manual_seed(args.seed)
+    model = build_detector(cfg.model, train_cfg=cfg.train_cfg, test_cfg=cfg.test_cfg).to(args.device)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param) * 0.01)
+    num_params = sum(p.numel() for p in model.parameters())
+    print(f"{len(list(model.parameters()))} parameters ({num_params / 1e6:.2f}M values), {len(list(model.buffers()))} buffers")
+
+    model_ema_loop, model_ema = copy.deepcopy(model), copy.deepcopy(model)
+    ema = ModelEMA(model, model_ema)
+    t_loop = time_per_step(lambda step: loop_update(model, model_ema_loop, step), args.num_steps)
+    t_ema = time_per_step(ema.update, args.num_steps)
+    print(f"loop {t_loop:8.3f} ms / step | ModelEMA {t_ema:8.3f} ms / step ({t_loop / t_ema:5.1f}x) | "
+          f"same teacher {same_params(model_ema, model_ema_loop)}")
+
+    for buffers in ["copy", "ema"]:
+        for interval in args.intervals:
+            ema = ModelEMA(model, copy.deepcopy(model), interval=interval, buffers=buffers)
+            t_ema = time_per_step(ema.update, args.num_steps)
+            print(f"ModelEMA buffers={buffers:4s} interval={interval:2d} {t_ema:8.3f} ms / step")
+
+
+if __name__ == "__main__":
+    main()
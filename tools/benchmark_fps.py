@@ -0,0 +1,81 @@
+'''
+    Compare the farthest point sampling used by the SA-DA sparsification: the batched numba sampler
+    (sa_da_v2.farthest_point_sample_batch, all the pyramids in one call) with the previous per pyramid
+    cKDTree(p).query(p, len(p)) + ifp_sample, on random pyramids of 50 to 5000 points: checks that both select the same
+    points (or against a numpy reference when the ifp package is not installed) and reports the time per pyramid and
+    the size of the n x n knn matrices the cKDTree query materializes.
+
+    python tools/benchmark_fps.py --num_points 50 200 1000 5000 --num_pyramids 4 --num_samples 50
+'''
+import numpy as np
+from scipy.spatial import cKDTree
+from det3d.datasets.utils.sa_da_v2 import farthest_point_sample_batch
+
+try:
+    from ifp import ifp_sample
+except ImportError:
+    ifp_sample = None
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark batched numba fps vs cKDTree + ifp_sample", num_runs=5)
+    parser.add_argument("--num_points", type=int, nargs="+", default=[50, 100, 200, 500, 1000, 2000, 5000])
+    parser.add_argument("--num_pyramids", type=int, default=4, help="pyramids sparsified together")
+    parser.add_argument("--num_samples", type=int, default=50)
+    return parser.parse_args()
+
+
+def random_pyramid(num_points, rng):
+    # points of one pyramid of a car: apex at the center, base on the front face, denser near the surface.
+    base = rng.uniform(-0.5, 0.5, (num_points, 2)) * [1.6, 1.5]
+    depth = np.sqrt(rng.uniform(0, 1, (num_points, 1)))
+    xyz = np.concatenate([depth * 2.0, base * depth], axis=1) + rng.normal(0, 0.01, (num_points, 3))
+    return np.concatenate([xyz, rng.uniform(0, 1, (num_points, 1))], axis=1).astype(np.float32)
+
+
+def reference_fps(points, num_samples):
+    # numpy farthest point sampling from the first point.
+    min_dists = np.full((points.shape[0],), np.inf)
+    ret = [0]
+    for _ in range(min(num_samples, points.shape[0]) - 1):
+        dists = ((points[:, :3].astype(np.float64) - points[ret[-1], :3]) ** 2).sum(-1)
+        min_dists = np.minimum(min_dists, dists)
+        min_dists[ret] = -1
+        ret.append(int(np.argmax(min_dists)))
+    return np.array(ret)
+
+
+def knn_fps(points, num_samples):
+    dists, indices = cKDTree(points[:, 0:3]).query(points[:, 0:3], points.shape[0])
+    if ifp_sample is None:
+        return None
+    return ifp_sample(dists, indices, num_samples)
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    farthest_point_sample_batch(random_pyramid(100, rng), np.array([0, 100]), 10)  # warm up numba.
+    if ifp_sample is None:
+        print("ifp is not installed: timing the cKDTree query only, checking against a numpy reference")
+
+    for num_points in args.num_points:
+        pyramids = [random_pyramid(num_points, rng) for _ in range(args.num_pyramids)]
+        points = np.concatenate(pyramids, axis=0)
+        starts = np.arange(args.num_pyramids + 1) * num_points
+
+        t_batch, sampled = timeit(lambda: farthest_point_sample_batch(points, starts, args.num_samples), args.num_runs)
+        t_knn, knn_sampled = timeit(lambda: [knn_fps(p, args.num_samples) for p in pyramids], args.num_runs)
+        if ifp_sample is None:
+            knn_sampled = [reference_fps(p, args.num_samples) for p in pyramids]
+        expected = np.concatenate([indices + start for indices, start in zip(knn_sampled, starts)])
+        knn_mb = num_points * num_points * 16 / 2 ** 20  # float64 dists + int64 indices.
+        print(f"{num_points:5d} points x {args.num_pyramids} pyramids | batched fps {t_batch / args.num_pyramids:8.3f} ms | "
+              f"cKDTree{' + ifp' if ifp_sample is not None else ' query'} {t_knn / args.num_pyramids:9.3f} ms "
+              f"({t_knn / t_batch:6.1f}x) | knn matrix {knn_mb:8.1f} MB | same samples {np.array_equal(sampled, expected)}")
+
+
+if __name__ == "__main__":
+    main()
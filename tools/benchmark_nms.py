@@ -0,0 +1,100 @@
+'''
+    Compare the torch rotated nms of box_torch_ops (rotate_nms_batched & rotate_weighted_nms_batched, tensor ops on the
+    input device, rotated iou only for the standup-overlapping pairs) with the nms extension (rotate_nms_cc &
+    rotate_weighted_nms_cc) on random clusters of car predictions, from 100 to 5000 candidates: checks that both keep
+    the same boxes and reports the time per sample, one sample at a time and for a padded batch. Without the nms
+    extension only the torch versions are timed.
+
+    python tools/benchmark_nms.py --num_candidates 100 500 1000 2000 5000 --batch_size 4 [--device cuda]
+'''
+import numpy as np
+import torch
+from det3d.core.bbox import box_torch_ops
+from det3d.ops.nms.nms_cpu import nms_extension_available, rotate_nms_cc, rotate_weighted_nms_cc
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark torch vs nms extension rotated nms", num_runs=5, device="cpu")
+    parser.add_argument("--num_candidates", type=int, nargs="+", default=[100, 200, 500, 1000, 2000, 5000])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--iou_threshold", type=float, default=0.01)
+    parser.add_argument("--post_max_size", type=int, default=100)
+    return parser.parse_args()
+
+
+def random_candidates(batch_size, num_candidates, rng):
+    # predictions around ~num_candidates / 20 cars, [x, y, z, w, l, h, ry], with their scores, iou preds & anchors.
+    num_cars = max(num_candidates // 20, 1)
+    cars = np.concatenate([rng.uniform([0, -40, -1.5], [70.4, 40, -0.5], (batch_size, num_cars, 3)),
+                           rng.uniform([1.4, 3.2, 1.3], [2.0, 4.8, 1.8], (batch_size, num_cars, 3)),
+                           rng.uniform(-np.pi, np.pi, (batch_size, num_cars, 1))], axis=-1)
+    car_ids = rng.randint(0, num_cars, (batch_size, num_candidates))
+    boxes = np.take_along_axis(cars, car_ids[..., None], axis=1)
+    boxes += np.concatenate([rng.normal(0, 0.3, (batch_size, num_candidates, 3)),
+                             rng.normal(0, 0.1, (batch_size, num_candidates, 3)),
+                             rng.normal(0, 0.1, (batch_size, num_candidates, 1))], axis=-1)
+    anchors = boxes + rng.normal(0, 0.4, boxes.shape)
+    scores = rng.uniform(0.3, 1.0, (batch_size, num_candidates))
+    iou_preds = rng.uniform(0.5, 1.0, (batch_size, num_candidates))
+    return [torch.from_numpy(x).float() for x in (boxes, scores, iou_preds, anchors)]
+
+
+def torch_nms(boxes, scores, args):
+    keep = box_torch_ops.rotate_nms_batched(boxes[..., [0, 1, 3, 4, 6]], scores, iou_threshold=args.iou_threshold,
+                                            post_max_size=args.post_max_size)
+    return [set(k.nonzero()[:, 0].tolist()) for k in keep]
+
+
+def torch_weighted_nms(boxes, scores, iou_preds, anchors):
+    order, keep, _, _ = box_torch_ops.rotate_weighted_nms_batched(boxes, boxes[..., [0, 1, 3, 4, 6]], scores, iou_preds,
+                                                                  torch.zeros_like(scores, dtype=torch.long), anchors,
+                                                                  centerness_c=True)
+    return [set(o[k].tolist()) for o, k in zip(order, keep)]
+
+
+def cc_nms(boxes, scores, args):
+    ret = []
+    for sample_boxes, sample_scores in zip(boxes.numpy(), scores.numpy()):
+        dets = np.concatenate([sample_boxes[:, [0, 1, 3, 4, 6]], sample_scores[:, None]], axis=1)
+        ret.append(set(rotate_nms_cc(dets, args.iou_threshold)[:args.post_max_size]))
+    return ret
+
+
+def cc_weighted_nms(boxes, scores, iou_preds, anchors):
+    ret = []
+    for sample_boxes, sample_scores, sample_iou_preds, sample_anchors in zip(boxes.numpy(), scores.numpy(),
+                                                                             iou_preds.numpy(), anchors.numpy()):
+        dets = np.concatenate([sample_boxes[:, [0, 1, 3, 4, 6]], sample_scores[:, None]], axis=1)
+        labels = np.zeros((dets.shape[0],), dtype=np.int32)
+        ret.append(set(rotate_weighted_nms_cc(sample_boxes, dets, 0.3, sample_iou_preds, labels, labels, sample_anchors)[4]))
+    return ret
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    if not nms_extension_available():
+        print("the nms extension is not installed: timing the torch nms only")
+
+    for num_candidates in args.num_candidates:
+        boxes, scores, iou_preds, anchors = random_candidates(args.batch_size, num_candidates, rng)
+        inputs = [x.to(args.device) for x in (boxes, scores, iou_preds, anchors)]
+
+        t_single, _ = timeit(lambda: [torch_nms(b[None], s[None], args) for b, s in zip(*inputs[:2])], args.num_runs)
+        t_batch, kept = timeit(lambda: torch_nms(inputs[0], inputs[1], args), args.num_runs)
+        t_weighted, kept_weighted = timeit(lambda: torch_weighted_nms(*inputs), args.num_runs)
+        line = (f"{num_candidates:5d} candidates x {args.batch_size} | torch nms {t_single / args.batch_size:8.2f} ms "
+                f"(batched {t_batch / args.batch_size:8.2f} ms) | torch di-nms {t_weighted / args.batch_size:8.2f} ms")
+
+        if nms_extension_available():
+            t_cc, kept_cc = timeit(lambda: cc_nms(boxes, scores, args), args.num_runs)
+            t_cc_weighted, kept_cc_weighted = timeit(lambda: cc_weighted_nms(boxes, scores, iou_preds, anchors), args.num_runs)
+            line += (f" | rotate_nms_cc {t_cc / args.batch_size:8.2f} ms, same keep {kept == kept_cc}"
+                     f" | rotate_weighted_nms_cc {t_cc_weighted / args.batch_size:8.2f} ms, same keep {kept_weighted == kept_cc_weighted}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+'''
+    Compare the batched ODIoU loss (odiou_3D(batched=True), tensor ops on the input device) with the per box numpy /
+    scipy implementation (odiou_3D(batched=False)) on random pairs of boxes: checks the bev intersection areas, the mbr
+    diagonals, the loss & the gradients w.r.t. the predicted boxes, and reports the time of forward + backward.
+    The per box implementation drops the closing edge of the scipy convex hull when searching for the mbr, so some of
+    the diagonals (~14%, those whose mbr is aligned with that edge) are expected to differ.
+
+    python tools/benchmark_odiou.py --num_pairs 1000 5000 10000 50000 --max_legacy_pairs 5000 [--device cuda]
+'''
+import numpy as np
+import torch
+from det3d.models.losses import odious
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark batched vs per box odiou loss", num_runs=5, device="cpu")
+    parser.add_argument("--num_pairs", type=int, nargs="+", default=[1000, 5000, 10000, 20000, 50000])
+    parser.add_argument("--max_legacy_pairs", type=int, default=5000, help="the per box version is only run up to this size")
+    return parser.parse_args()
+
+
+def random_pairs(num_pairs, rng):
+    # gt cars and predictions around them, [x, y, z, w, l, h, ry] with (x, y, z) the real center.
+    gboxes = np.concatenate([rng.uniform([0, -40, -2], [70.4, 40, 0], (num_pairs, 3)),
+                             rng.uniform([1.4, 3.2, 1.3], [2.0, 4.8, 1.8], (num_pairs, 3)),
+                             rng.uniform(-np.pi, np.pi, (num_pairs, 1))], axis=1)
+    noise = np.concatenate([rng.normal(0, 0.5, (num_pairs, 3)), rng.normal(0, 0.2, (num_pairs, 3)),
+                            rng.normal(0, 0.3, (num_pairs, 1))], axis=1)
+    return torch.from_numpy(gboxes).float(), torch.from_numpy(gboxes + noise).float()
+
+
+def bev_terms(gboxes, qboxes, batched):
+    to_corners = odious.rbbox_to_corners()
+    corners_gboxes = to_corners(gboxes[:, [0, 1, 3, 4, 6]])
+    corners_qboxes = to_corners(qboxes[:, [0, 1, 3, 4, 6]])
+    corners_pts = torch.cat((torch.stack((corners_gboxes[:, [0, 2, 4, 6]], corners_gboxes[:, [1, 3, 5, 7]]), 2),
+                             torch.stack((corners_qboxes[:, [0, 2, 4, 6]], corners_qboxes[:, [1, 3, 5, 7]]), 2)), 1)
+    if batched:
+        return odious.rinter_area_batched(corners_gboxes, corners_qboxes), odious.mbr_diag_batched(corners_pts)
+    inter_area = odious.rinter_area_compute()(corners_gboxes.cpu(), corners_qboxes.cpu())
+    return inter_area, odious.mbr_diag_compute()(corners_pts)
+
+
+def loss_and_grad(loss_fn, gboxes, qboxes):
+    qboxes = qboxes.clone().requires_grad_(True)
+    loss = loss_fn(gboxes, qboxes, torch.ones_like(gboxes[:, 0]), 2)
+    loss.backward()
+    return loss.detach(), qboxes.grad
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    batched, legacy = odious.odiou_3D(batched=True), odious.odiou_3D(batched=False)
+
+    for num_pairs in args.num_pairs:
+        gboxes, qboxes = random_pairs(num_pairs, rng)
+        gboxes, qboxes = gboxes.to(args.device), qboxes.to(args.device)
+        t_batched, (loss_b, grad_b) = timeit(lambda: loss_and_grad(batched, gboxes, qboxes), args.num_runs)
+        line = f"{num_pairs:6d} pairs | batched {t_batched:9.2f} ms"
+
+        if num_pairs <= args.max_legacy_pairs:
+            t_legacy, (loss_l, grad_l) = timeit(lambda: loss_and_grad(legacy, gboxes, qboxes), 1)
+            area_b, diag_b = bev_terms(gboxes, qboxes, True)
+            area_l, diag_l = bev_terms(gboxes, qboxes, False)
+            same_diag = (diag_b - diag_l).abs() < 1e-4
+            grad_err = (grad_b - grad_l).abs().max(1)[0][same_diag].max().item()
+            line += (f" | per box {t_legacy:9.2f} ms ({t_legacy / t_batched:6.1f}x) | area max err "
+                     f"{(area_b.cpu() - area_l).abs().max().item():.2e} | same mbr diag {same_diag.float().mean().item():6.1%} "
+                     f"| loss {loss_b.item():.4f} vs {loss_l.item():.4f} | grad max err (same diag) {grad_err:.2e}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+'''
+    Compare the dense (nearest_iou_similarity) and the windowed (grid_nearest_iou_similarity) anchor-to-gt matching
+    of TargetAssigner.assign_v2: checks that both give bit-identical overlaps & targets, and reports the time per sample.
+
+    python tools/benchmark_target_assign.py examples/second/configs/config.py --num_gt 5 15 30
+'''
+import copy
+
+import numpy as np
+from det3d.builder import build_box_coder, build_similarity_metric
+from det3d.core.anchor.anchor_cache import get_anchors_dict_by_task
+from det3d.core.anchor.target_assigner import TargetAssigner
+from det3d.torchie import Config
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark dense vs windowed anchor-to-gt matching")
+    parser.add_argument("config", help="train config file path")
+    parser.add_argument("--num_gt", type=int, nargs="+", default=[5, 15, 30], help="number of gt boxes per sample")
+    parser.add_argument("--num_samples", type=int, default=50)
+    return parser.parse_args()
+
+
+def random_gt_boxes(num_gt, pc_range, rng):
+    # cars inside the point cloud range, some of them partially outside the anchor grid.
+    centers = rng.uniform(pc_range[:3] - 1.0, pc_range[3:] + 1.0, (num_gt, 3))
+    sizes = rng.uniform([1.4, 3.2, 1.3], [2.0, 4.8, 1.8], (num_gt, 3))
+    rots = rng.uniform(-np.pi, np.pi, (num_gt, 1))
+    return np.concatenate([centers, sizes, rots], axis=1).astype(np.float32)
+
+
+def build_target_assigner(target_assigner_cfg, box_coder_cfg, similarity_type):
+    similarity_cfg = copy.deepcopy(target_assigner_cfg.region_similarity_calculator)
+    similarity_cfg.type = similarity_type
+    return TargetAssigner(
+        box_coder=build_box_coder(box_coder_cfg),
+        anchor_generators=[],  # anchors come from the shared anchor cache.
+        region_similarity_calculator=build_similarity_metric(similarity_cfg),
+        positive_fraction=None,
+        sample_size=target_assigner_cfg.sample_size,
+    )
+
+
+def time_per_sample(fn, samples):
+    t, outputs = timeit(lambda: [fn(b) for b in samples])
+    return t / len(samples), outputs
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    target_assigner_cfg = cfg.train_cfg.assigner.target_assigner
+    box_coder_cfg = cfg.train_cfg.assigner.box_coder
+    feature_map_size = target_assigner_cfg.get("feature_map_size", [1, 200, 176])
+    anchors_dict = get_anchors_dict_by_task(target_assigner_cfg, feature_map_size)[0]
+    pc_range = np.array(target_assigner_cfg.anchor_generators[0].anchor_ranges, dtype=np.float32)
+    class_name = target_assigner_cfg.anchor_generators[0].class_name
+
+    dense = build_target_assigner(target_assigner_cfg, box_coder_cfg, "nearest_iou_similarity")
+    grid = build_target_assigner(target_assigner_cfg, box_coder_cfg, "grid_nearest_iou_similarity")
+    anchors = anchors_dict[class_name]["anchors"]  # (1, 200, 176, 2, 7)
+    anchors_rbv = anchors.reshape(-1, 7)[:, [0, 1, 3, 4, -1]]
+
+    rng = np.random.RandomState(args.seed)
+    for num_gt in args.num_gt:
+        samples = [random_gt_boxes(num_gt, pc_range, rng) for _ in range(args.num_samples)]
+        gt_names = np.array([class_name] * num_gt)
+        gt_classes = np.ones([num_gt], dtype=np.int32)
+
+        # warm up numba (jit compilation & grid preparation of the anchors).
+        for assigner in [dense, grid]:
+            assigner.assign_v2(anchors_dict, samples[0], gt_classes=gt_classes, gt_names=gt_names)
+        dense._region_similarity_calculator.compare(anchors_rbv, samples[0][:, [0, 1, 3, 4, -1]])
+        grid._region_similarity_calculator.compare_grid(anchors, samples[0][:, [0, 1, 3, 4, -1]])
+
+        # similarity only
+        t_dense_iou, iou_dense = time_per_sample(lambda b: dense._region_similarity_calculator.compare(
+            anchors_rbv, b[:, [0, 1, 3, 4, -1]]), samples)
+        t_grid_iou, iou_grid = time_per_sample(lambda b: grid._region_similarity_calculator.compare_grid(
+            anchors, b[:, [0, 1, 3, 4, -1]]), samples)
+        iou_equal = all(np.array_equal(a, b) and a.dtype == b.dtype for a, b in zip(iou_dense, iou_grid))
+
+        # whole assign_v2
+        t_dense, targets_dense = time_per_sample(lambda b: dense.assign_v2(anchors_dict, b, gt_classes=gt_classes, gt_names=gt_names), samples)
+        t_grid, targets_grid = time_per_sample(lambda b: grid.assign_v2(anchors_dict, b, gt_classes=gt_classes, gt_names=gt_names), samples)
+        targets_equal = all(
+            all(np.array_equal(np.asarray(a[k]), np.asarray(b[k])) for k in ["labels", "bbox_targets", "bbox_outside_weights"])
+            and all(np.array_equal(x, y) for x, y in zip(a["positive_gt_id"], b["positive_gt_id"]))
+            for a, b in zip(targets_dense, targets_grid)
+        )
+
+        print(f"num_gt {num_gt:3d} | iou: dense {t_dense_iou:7.2f} ms, grid {t_grid_iou:7.2f} ms, identical {iou_equal} "
+              f"| assign_v2: dense {t_dense:7.2f} ms, grid {t_grid:7.2f} ms, identical {targets_equal}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+'''
+    Common scaffold of the tools/benchmark_*.py & tools/time_analyze.py scripts: the shared arguments and the timer,
+    each script keeps its own workload. The scripts are run as python tools/<script>.py, which puts tools/ on the path.
+'''
+import argparse
+import time
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+def benchmark_parser(description, num_runs=None, device=None):
+    '''
+        ArgumentParser with --seed, and --num_runs / --device when given their default.
+    '''
+    parser = argparse.ArgumentParser(description=description)
+    if num_runs is not None:
+        parser.add_argument("--num_runs", type=int, default=num_runs)
+    if device is not None:
+        parser.add_argument("--device", type=str, default=device)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def timeit(fn, n=1, warmup=False):
+    '''
+        Mean time of n calls of fn() in ms (cuda synchronized before stopping the clock), and the result of the last
+        call. warmup: one untimed call first (numba jit compilation).
+    '''
+    if warmup:
+        fn()
+    t1 = time.time()
+    for _ in range(n):
+        ret = fn()
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t2 = time.time()
+    return (t2 - t1) / n * 1000, ret
@@ -0,0 +1,60 @@
+'''
+    Compare the numba (hash table kernels) and numpy (sort based) modes of Voxelizer on random point clouds from
+    20k to 120k points: checks that both give identical voxels, and reports the time per call, plus the first call
+    of this process, which includes the numba jit compilation a freshly spawned dataloader worker pays.
+
+    python tools/benchmark_voxelization.py --num_points 20000 40000 80000 120000
+'''
+import numpy as np
+from det3d.ops.point_cloud.point_cloud_ops_v2 import Voxelizer
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark numba vs numpy voxelization", num_runs=20)
+    parser.add_argument("--num_points", type=int, nargs="+", default=[20000, 40000, 60000, 80000, 100000, 120000])
+    parser.add_argument("--voxel_size", type=float, nargs=3, default=[0.05, 0.05, 0.1])
+    parser.add_argument("--range", type=float, nargs=6, default=[0, -40.0, -3.0, 70.4, 40.0, 1.0])
+    parser.add_argument("--max_points_in_voxel", type=int, default=5)
+    parser.add_argument("--max_voxel_num", type=int, default=20000)
+    return parser.parse_args()
+
+
+def random_points(num_points, pc_range, rng):
+    # half of the points on a ground plane, half in small clusters (objects), with some points out of range.
+    pc_range = np.array(pc_range)
+    num_ground = num_points // 2
+    ground = rng.uniform(pc_range[:3] - 2, pc_range[3:] + 2, (num_ground, 3))
+    ground[:, 2] = rng.normal(-1.6, 0.05, num_ground)
+    centers = rng.uniform(pc_range[:3], pc_range[3:], ((num_points - num_ground) // 100 + 1, 3))
+    objects = np.repeat(centers, 100, axis=0)[:num_points - num_ground] + rng.normal(0, 0.5, (num_points - num_ground, 3))
+    xyz = np.concatenate([ground, objects], axis=0)
+    points = np.concatenate([xyz, rng.uniform(0, 1, (num_points, 1))], axis=1).astype(np.float32)
+    return points[rng.permutation(num_points)]
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    voxelizers = {
+        mode: Voxelizer(args.voxel_size, args.range, args.max_points_in_voxel, True, args.max_voxel_num, mode=mode)
+        for mode in ["numba", "numpy"]
+    }
+
+    points = random_points(args.num_points[0], args.range, rng)
+    for mode, voxelizer in voxelizers.items():
+        t_first, _ = timeit(lambda: voxelizer.generate(points), 1)
+        print(f"{mode}: first call (incl. jit warm-up) {t_first:8.2f} ms")
+
+    for num_points in args.num_points:
+        points = random_points(num_points, args.range, rng)
+        t_numba, ret_numba = timeit(lambda: voxelizers["numba"].generate(points), args.num_runs)
+        t_numpy, ret_numpy = timeit(lambda: voxelizers["numpy"].generate(points), args.num_runs)
+        same = all(np.array_equal(a, b) for a, b in zip(ret_numba, ret_numpy))
+        print(f"{num_points:6d} points ({ret_numba[0].shape[0]:5d} voxels) | numba {t_numba:7.2f} ms | "
+              f"numpy {t_numpy:7.2f} ms | identical {same}")
+
+
+if __name__ == "__main__":
+    main()
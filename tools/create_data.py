@@ -6,11 +6,12 @@ import fire
 
 from det3d.datasets.kitti import kitti_common as kitti_ds
 from det3d.datasets.utils.create_gt_database import create_groundtruth_database
+from det3d.datasets.utils.info_store import convert_infos_to_store
 from det3d.torchie import Config
 
 cfg = Config.fromfile("../examples/second/configs/config.py")
 
-def kitti_data_prep(root_path):
+def kitti_data_prep(root_path, num_workers=8):
     # compress info of image(path), velodyne(path), label (all info but dc removed),
     # calib (all) into pkl file; DontCare has been removed
     # root_path: "/mnt/proj50/zhengwu/KITTI/object"
@@ -50,10 +51,20 @@ def kitti_data_prep(root_path):
     #                   "num_points_in_gt": [n0, n1, n2, ..., -1, -1, -1],  # dc gt are counted as -1.
     #                  }
     #        }
-    #kitti_ds.create_kitti_info_file(root_path)
+    #kitti_ds.create_kitti_info_file(root_path, num_workers=num_workers)
 
     # all points outside of image_range are removed and kept as reduced point_cloud .bin file.
-    kitti_ds.create_reduced_point_cloud(root_path)
+    # frames in a pool of num_workers processes, only the frames changed since the last run are redone.
+    kitti_ds.create_reduced_point_cloud(root_path, num_workers=num_workers)
+
+    # frame-static cache of each info file (kitti_infos_*_static/: resolved reduced cloud path, frustum, lidar gt
+    # boxes), rebuilt if the infos or the point clouds changed (see frame_static_cache_key).
+    for info_name in ["kitti_infos_train", "kitti_infos_val", "kitti_infos_trainval", "kitti_infos_test"]:
+        info_path = Path(root_path) / (info_name + ".pkl")
+        if info_path.exists():
+            with open(info_path, "rb") as f:
+                infos = pickle.load(f)
+            kitti_ds.load_frame_static_cache(root_path, info_path, infos, num_workers=num_workers)
 
 
     # dbinfos_train.pkl
@@ -66,10 +77,21 @@ def kitti_data_prep(root_path):
     #             "box3d_lidar": gt_boxes[i],  # dc removed.
     #             "num_points_in_gt": gt_points.shape[0],
     #             "difficulty": difficulty[i]  # todo: not accurate, all are set as 0.
+    #             "packed_offset": offset,     # row offset of the gt points in gt_database.bin (all gt points packed).
+    #             "packed_num_points": n,      # num of rows in gt_database.bin.
     #            }
 
     # save each gt box points separately and all gt info in a
-    create_groundtruth_database("KITTI", root_path, Path(root_path) / "kitti_infos_train.pkl", gt_aug_with_context=cfg.my_paras.gt_aug_with_context)
+    create_groundtruth_database("KITTI", root_path, Path(root_path) / "kitti_infos_train.pkl", gt_aug_with_context=cfg.my_paras.gt_aug_with_context,
+                                num_workers=num_workers)
+
+    # memory-mapped info stores next to the pickles (kitti_infos_train/, ..., dbinfos_train/), to be used as
+    # info_path / db_info_path in the config instead of the .pkl, see det3d/datasets/utils/info_store.py.
+    for info_name in ["kitti_infos_train", "kitti_infos_val", "kitti_infos_trainval", "kitti_infos_test", "dbinfos_train",
+                      "dbinfos_enlarged_train"]:
+        info_path = Path(root_path) / (info_name + ".pkl")
+        if info_path.exists():
+            convert_infos_to_store(info_path, class_names=cfg.class_names)
 
 '''
 def nuscenes_data_prep(root_path, version, nsweeps=10):
@@ -1,22 +1,85 @@
-n = 500
-import time
-t1 = time.time()
-for i in range(n):
-    coll_mat = prep.box_collision_test(total_bv, total_bv)   # todo: too slow here
-t2 = time.time()
-print((t2-t1)/n)
-
-import det3d.core.iou3d.iou3d_utils as iou3d
-import torch
-boxes_torch = torch.from_numpy(boxes).float()
-t1 = time.time()
-for i in range(n):
-    x2 = iou3d.boxes_iou_bev_cpu(boxes_torch, boxes_torch)
-t2 = time.time()
-print((t2 - t1) / n)
-
-t1 = time.time()
-for i in range(n):
-    x3 = iou3d.boxes_iou_bev_gpu(boxes_torch.cuda(), boxes_torch.cuda())
-t2 = time.time()
-print((t2 - t1) / n)
\ No newline at end of file
+'''
+    Benchmark the bev box collision tests used by GT-AUG (sample_class_v2) and noise_per_object:
+    the original all-pairs box_collision_test, the sort-and-sweep + sat box_collision_test_sweep and its parallel
+    version. Checks the sat tests on REGRESSION_CASES, that the sweep and its parallel version give the same collision
+    matrix, and counts the pairs where box_collision_test differs: it misses the overlaps of boxes with collinear edges
+    (no strict edge crossing, no corner strictly inside), and contacts at float precision may go either way.
+
+    python tools/time_analyze.py --num_boxes 30 45 100 500 [--with_iou3d]
+'''
+import numpy as np
+from det3d.core.bbox import box_np_ops
+from det3d.core.sampler import preprocess as prep
+
+from benchmark_utils import benchmark_parser, timeit
+
+
+def parse_args():
+    parser = benchmark_parser("benchmark bev box collision tests", num_runs=200)
+    parser.add_argument("--num_boxes", type=int, nargs="+", default=[30, 45, 100, 500])
+    parser.add_argument("--with_iou3d", action="store_true", help="also time iou3d boxes_iou_bev_cpu/gpu (needs the cuda ops)")
+    return parser.parse_args()
+
+
+# (box, qbox, collision), [x, y, z, w, l, h, ry]: box_collision_test gives False on the first four.
+REGRESSION_CASES = [
+    ([6, 9, 0, 1.6, 3.9, 1.5, 0], [6, 6, 0, 1.6, 3.9, 1.5, 0], True),       # collinear long edges, 0.9 m overlap
+    ([6, 6, 0, 1.6, 3.9, 1.5, 0], [7, 6, 0, 1.6, 3.9, 1.5, 0], True),       # collinear short edges, 0.6 m overlap
+    ([6, 6, 0, 1.6, 3.9, 1.5, 0], [6, 6, 0, 1.6, 3.9, 1.5, 0], True),       # same box
+    ([6, 6, 0, 2, 4, 1.5, 0], [6, 7, 0, 2, 2, 1.5, 0], True),               # inside, sharing three edges
+    ([0, 0, 0, 2, 4, 1.5, 0], [1.5, 3.5, 0, 2, 4, 1.5, 0], True),           # corner overlap
+    ([0, 0, 0, 2, 4, 1.5, 0], [0, 4, 0, 2, 4, 1.5, 0], False),              # touching edges
+    ([0, 0, 0, 2, 4, 1.5, 0], [2, 4, 0, 2, 4, 1.5, 0], False),              # touching corners
+    ([0, 0, 0, 2, 4, 1.5, 0], [3, 0, 0, 2, 4, 1.5, 0.3], False),
+]
+
+
+def check_regression_cases():
+    for box, qbox, expected in REGRESSION_CASES:
+        boxes = np.array([box, qbox], dtype=np.float32)
+        bv = box_np_ops.center_to_corner_box2d(boxes[:, 0:2], boxes[:, 3:5], boxes[:, -1])
+        for collision_test in [prep.box_collision_test_sweep, prep.box_collision_test_sweep_parallel]:
+            assert collision_test(bv, bv)[0, 1] == expected, (box, qbox, expected)
+    print(f"{len(REGRESSION_CASES)} regression cases ok")
+
+
+def random_boxes(num_boxes, rng):
+    # cars in the kitti range, [x, y, z, w, l, h, ry]; density grows with num_boxes so that many of them collide.
+    centers = rng.uniform([0, -40, -2], [70.4, 40, 0], (num_boxes, 3))
+    sizes = rng.uniform([1.4, 3.2, 1.3], [2.0, 4.8, 1.8], (num_boxes, 3))
+    rots = rng.uniform(-np.pi, np.pi, (num_boxes, 1))
+    return np.concatenate([centers, sizes, rots], axis=1).astype(np.float32)
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    check_regression_cases()
+    for num_boxes in args.num_boxes:
+        boxes = random_boxes(num_boxes, rng)
+        total_bv = box_np_ops.center_to_corner_box2d(boxes[:, 0:2], boxes[:, 3:5], boxes[:, -1])
+
+        t_old, coll_old = timeit(lambda: prep.box_collision_test(total_bv, total_bv), args.num_runs, warmup=True)
+        t_sweep, coll_sweep = timeit(lambda: prep.box_collision_test_sweep(total_bv, total_bv), args.num_runs, warmup=True)
+        t_parallel, coll_parallel = timeit(lambda: prep.box_collision_test_sweep_parallel(total_bv, total_bv), args.num_runs, warmup=True)
+        # self pairs are ignored by all callers (box_collision_test never reports a box colliding with its copy).
+        diag = np.arange(num_boxes)
+        for coll_mat in [coll_old, coll_sweep, coll_parallel]:
+            coll_mat[diag, diag] = False
+        same = np.array_equal(coll_sweep, coll_parallel)
+        print(f"{num_boxes:4d} boxes ({coll_sweep.sum() // 2:4d} collided pairs) | all pairs {t_old:8.3f} ms | "
+              f"sweep {t_sweep:8.3f} ms | sweep parallel {t_parallel:8.3f} ms | identical {same} | "
+              f"all pairs differs on {(coll_old != coll_sweep).sum() // 2} pairs")
+
+        if args.with_iou3d:
+            import det3d.core.iou3d.iou3d_utils as iou3d
+            import torch
+
+            boxes_torch = torch.from_numpy(boxes).float()
+            t_cpu, _ = timeit(lambda: iou3d.boxes_iou_bev_cpu(boxes_torch, boxes_torch), args.num_runs, warmup=True)
+            t_gpu, _ = timeit(lambda: iou3d.boxes_iou_bev_gpu(boxes_torch.cuda(), boxes_torch.cuda()), args.num_runs, warmup=True)
+            print(f"{num_boxes:4d} boxes | iou3d bev cpu {t_cpu:8.3f} ms | iou3d bev gpu {t_gpu:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()